@@ -0,0 +1,123 @@
+"""Tunes the indexes of the order data database for the queries written by the assistant.
+
+Replays a query log written by the query_order_data extension (set ORDER_DATA_QUERY_LOG_PATH
+to enable it), proposes a covering index for each query, creates the candidates and keeps
+those that make at least one query faster. Reports the latency of each query before and after.
+
+You would typically run this script every now and then, as usage drifts, then redeploy
+the database (see src/copilot_sdk_flow/agent_arch/extensions/data/).
+"""
+
+import os
+import sys
+import shutil
+import sqlite3
+import logging
+import argparse
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "copilot_sdk_flow"))
+
+from agent_arch.extensions.order_data.config import OrderDataConfiguration
+from agent_arch.extensions.order_data.indexing import (
+    IndexAdvisor,
+    connect_read_only,
+    load_queries,
+)
+
+
+def get_arg_parser(parser: argparse.ArgumentParser = None) -> argparse.ArgumentParser:
+    """Get the argument parser for the script."""
+    if parser is None:
+        parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        "--query-log",
+        type=str,
+        required=True,
+        help="Path to the query log (JSON lines) to replay",
+    )
+    parser.add_argument(
+        "--db",
+        type=str,
+        default=OrderDataConfiguration.from_env().DB_PATH,
+        help="Path to the SQLite database to tune",
+    )
+    parser.add_argument("--table", type=str, default="order_data")
+    parser.add_argument(
+        "--max-columns",
+        type=int,
+        default=8,
+        help="Maximum number of columns of an index",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of timed runs of each query, the median is kept",
+    )
+    parser.add_argument(
+        "--min-speedup",
+        type=float,
+        default=1.1,
+        help="Minimum speedup of a query for its index to be kept",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Evaluate the indexes on a copy of the database, leaving it untouched",
+    )
+
+    return parser
+
+
+def main():
+    """Replay the query log, tune the indexes and print a report."""
+    logging.basicConfig(level=logging.INFO)
+
+    parser = get_arg_parser()
+    args = parser.parse_args()
+
+    queries = load_queries(args.query_log)
+    logging.info(f"Loaded {len(queries)} distinct queries from {args.query_log}")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = args.db
+        if args.dry_run:
+            db_path = os.path.join(temp_dir, os.path.basename(args.db))
+            shutil.copyfile(args.db, db_path)
+
+        conn = sqlite3.connect(db_path)
+        # the logged queries are replayed read-only, only the advisor writes
+        read_conn = connect_read_only(conn)
+        advisor = IndexAdvisor(
+            conn,
+            table=args.table,
+            max_columns=args.max_columns,
+            repeat=args.repeat,
+            min_speedup=args.min_speedup,
+            read_conn=read_conn,
+        )
+        report = advisor.advise(list(queries))
+        read_conn.close()
+        conn.close()
+
+    print(f"{'runs':>5} {'before (ms)':>12} {'after (ms)':>11} {'speedup':>8}  index")
+    for entry in sorted(report, key=lambda entry: -queries[entry["sql_query"]]):
+        index = "-"
+        if entry["index"]:
+            index = f"{entry['index']} ({', '.join(entry['index_columns'])})"
+            index += "" if entry["kept"] else " [dropped]"
+        print(
+            f"{queries[entry['sql_query']]:>5} {entry['before'] * 1000:>12.2f}"
+            f" {entry['after'] * 1000:>11.2f} {entry['speedup']:>7.2f}x  {index}"
+        )
+        print(f"      {entry['sql_query']}")
+
+    kept = sorted({entry["index"] for entry in report if entry["kept"]})
+    action = "would be kept" if args.dry_run else "kept"
+    logging.info(f"{len(kept)} indexes {action}: {kept}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""Benchmarks the query_order_data extension on synthetic datasets, for capacity planning.
+
+For each dataset size (--rows), generates a synthetic order data database (see
+src/generate_order_data.py), with its rollups and its Parquet export, then for each
+configuration (--config) runs a mix of the queries the assistant writes through
+`query_order_data` and reports:
+- the latency of the queries: p50, p95 and p99, in milliseconds,
+- the throughput, in queries per second, with --concurrency queries in flight,
+- the peak resident memory of the process running them,
+- the maximum number of queries waiting for a worker of the extension.
+
+Each run happens in a fresh process, configured through ORDER_DATA_<name> environment
+variables as the extension is in production, so that runs don't share caches or memory.
+The result cache is disabled unless --cache is passed, to measure the engines.
+Datasets are kept in --work-dir, to be reused by the next runs, if one is given.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import sqlite3
+import tempfile
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "copilot_sdk_flow"))
+
+from agent_arch.extensions.order_data.config import OrderDataConfiguration
+from agent_arch.extensions.order_data.convert import export_to_parquet
+from agent_arch.extensions.order_data.query_log import read_query_log
+from agent_arch.extensions.order_data.rollups import build_rollup, get_dimension_sets
+from agent_arch.extensions.order_data.synthetic import (
+    create_order_data,
+    get_query_mix,
+)
+
+DEFAULT_CONFIGS = [
+    "sqlite:ENGINE=sqlite,ROLLUPS_ENABLED=false",
+    "sqlite-rollups:ENGINE=sqlite,ROLLUPS_ENABLED=true",
+    "duckdb:ENGINE=duckdb",
+]
+
+
+def get_arg_parser(parser: argparse.ArgumentParser = None) -> argparse.ArgumentParser:
+    """Get the argument parser for the script."""
+    if parser is None:
+        parser = argparse.ArgumentParser(
+            description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+        )
+
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[10_000, 1_000_000],
+        help="Sizes of the synthetic datasets, e.g. 10_000 1_000_000 100_000_000",
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        action="append",
+        help="A configuration to benchmark, as name:FIELD=value,FIELD=value with the"
+        f" fields of ORDER_DATA_<FIELD>, can be repeated (default: {DEFAULT_CONFIGS})",
+    )
+    parser.add_argument(
+        "--queries",
+        type=int,
+        default=500,
+        help="Number of queries run for each dataset and configuration",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=20,
+        help="Number of queries run before the measured ones",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of queries in flight at a time",
+    )
+    parser.add_argument(
+        "--query-log",
+        type=str,
+        default=None,
+        help="Replay the queries of a query log (ORDER_DATA_QUERY_LOG_PATH) instead"
+        " of the synthetic query mix",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Keep the result cache of the extension enabled",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        default=None,
+        help="Directory to keep the datasets in, and reuse them from (default: temporary)",
+    )
+    parser.add_argument("--start-year", type=int, default=2019)
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Path of a JSON lines file to append the results to",
+    )
+
+    return parser
+
+
+def parse_config(spec: str) -> tuple:
+    """Parses a configuration given as name:FIELD=value,FIELD=value."""
+    name, _, settings = spec.partition(":")
+    env = {}
+    for setting in filter(None, settings.split(",")):
+        field, _, value = setting.partition("=")
+        field = field.strip().upper()
+        if field not in OrderDataConfiguration.model_fields:
+            raise ValueError(f"Unknown setting {field} in configuration {name}")
+        env[f"ORDER_DATA_{field}"] = value.strip()
+    return name, env
+
+
+def prepare_dataset(
+    work_dir: str, n_rows: int, args: argparse.Namespace, parquet: bool
+) -> Dict[str, str]:
+    """Generates a dataset with its rollups, and its Parquet export if needed,
+    unless they already exist in the work directory.
+
+    Returns:
+        dict: The ORDER_DATA_DB_PATH and ORDER_DATA_PARQUET_PATH of the dataset.
+    """
+    name = f"order_data_{n_rows}_{args.start_year}_{args.years}_{args.seed}"
+    db_path = os.path.join(work_dir, f"{name}.db")
+    parquet_path = os.path.join(work_dir, f"{name}.parquet")
+
+    if not os.path.exists(db_path):
+        partial_path = db_path + ".partial"
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        create_order_data(
+            partial_path,
+            n_rows,
+            start_year=args.start_year,
+            years=args.years,
+            seed=args.seed,
+        )
+        conn = sqlite3.connect(partial_path)
+        for dimensions in get_dimension_sets(
+            OrderDataConfiguration().ROLLUP_DIMENSION_SETS
+        ):
+            build_rollup(conn, dimensions)
+        conn.close()
+        os.replace(partial_path, db_path)
+
+    if parquet and not os.path.exists(parquet_path):
+        export_to_parquet(db_path, parquet_path + ".partial")
+        os.replace(parquet_path + ".partial", parquet_path)
+
+    return {"ORDER_DATA_DB_PATH": db_path, "ORDER_DATA_PARQUET_PATH": parquet_path}
+
+
+def get_peak_memory() -> Optional[int]:
+    """Gets the peak resident memory of the process, in bytes, None if unknown."""
+    try:
+        # unlike ru_maxrss on Linux, not inherited from the parent process
+        with open("/proc/self/status", encoding="ascii") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+async def run_queries(query_order_data, queries: List[str], concurrency: int) -> tuple:
+    """Runs queries through the extension, concurrency at a time.
+
+    Returns:
+        tuple: The latency of each query, the number of errors, the total duration.
+    """
+    pending = list(reversed(queries))
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while pending:
+            sql_query = pending.pop()
+            start = time.perf_counter()
+            result = await query_order_data(sql_query)
+            latencies.append(time.perf_counter() - start)
+            if result.startswith("Error:"):
+                errors += 1
+                logging.debug(f"{result} for query: {sql_query}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def run_workload(
+    env: Dict[str, str], queries: List[str], warmup: int, concurrency: int
+) -> dict:
+    """Runs a workload through the extension configured by env, in a fresh process."""
+    logging.basicConfig(level=logging.WARNING)
+    os.environ.update(env)
+    start = time.perf_counter()
+    extension = importlib.import_module("agent_arch.extensions.query_order_data")
+    setup_time = time.perf_counter() - start
+
+    asyncio.run(run_queries(extension.query_order_data, queries[:warmup], concurrency))
+    latencies, errors, duration = asyncio.run(
+        run_queries(extension.query_order_data, queries[warmup:], concurrency)
+    )
+    return {
+        "setup_time": setup_time,
+        "latencies": latencies,
+        "errors": errors,
+        "duration": duration,
+        "peak_memory": get_peak_memory(),
+        **extension.get_query_stats(),
+    }
+
+
+def get_percentile(sorted_values: List[float], percentile: float) -> float:
+    """Gets a percentile of sorted values, by the nearest rank method."""
+    rank = max(int(-(-percentile * len(sorted_values) // 100)), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def main():
+    """Run the benchmark and print a summary table."""
+    logging.basicConfig(level=logging.INFO)
+
+    parser = get_arg_parser()
+    args = parser.parse_args()
+
+    if args.queries < 1:
+        parser.error("--queries must be at least 1")
+
+    configs = [parse_config(spec) for spec in args.config or DEFAULT_CONFIGS]
+    parquet = any(env.get("ORDER_DATA_ENGINE") == "duckdb" for _, env in configs)
+
+    if args.query_log:
+        logged = [entry["sql_query"] for entry in read_query_log(args.query_log)]
+        if not logged:
+            parser.error(f"No queries in {args.query_log}")
+        n_queries = args.warmup + args.queries
+        queries = (logged * (n_queries // len(logged) + 1))[:n_queries]
+    else:
+        queries = get_query_mix(
+            args.warmup + args.queries, args.start_year, args.years, args.seed
+        )
+
+    temp_dir = None
+    work_dir = args.work_dir
+    if work_dir is None:
+        temp_dir = tempfile.TemporaryDirectory()
+        work_dir = temp_dir.name
+    os.makedirs(work_dir, exist_ok=True)
+
+    print(
+        f"{'rows':>12} {'config':>16} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}"
+        f" {'queries/s':>10} {'peak (MiB)':>11} {'queued':>7} {'errors':>7}"
+    )
+    try:
+        for n_rows in args.rows:
+            logging.info(f"Preparing a dataset of {n_rows} rows in {work_dir}")
+            dataset = prepare_dataset(work_dir, n_rows, args, parquet)
+
+            for name, config_env in configs:
+                env = {"ORDER_DATA_QUERY_LOG_PATH": "", **dataset}
+                if not args.cache:
+                    env["ORDER_DATA_CACHE_MAX_ENTRIES"] = "0"
+                env.update(config_env)
+
+                # one fresh process per run, spawned to not inherit the datasets
+                context = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(1, mp_context=context) as executor:
+                    try:
+                        result = executor.submit(
+                            run_workload, env, queries, args.warmup, args.concurrency
+                        ).result()
+                    except Exception as e:
+                        logging.error(f"{name} failed on {n_rows} rows: {e}")
+                        continue
+
+                latencies = sorted(result["latencies"])
+                report = {
+                    "rows": n_rows,
+                    "config": name,
+                    "env": config_env,
+                    "queries": len(latencies),
+                    "concurrency": args.concurrency,
+                    "cache": args.cache,
+                    "p50": get_percentile(latencies, 50),
+                    "p95": get_percentile(latencies, 95),
+                    "p99": get_percentile(latencies, 99),
+                    "throughput": len(latencies) / result["duration"],
+                    "peak_memory": result["peak_memory"],
+                    "setup_time": result["setup_time"],
+                    "errors": result["errors"],
+                    "max_queue_depth": result["executor"]["max_queue_depth"],
+                    "avg_wait_ms": result["executor"]["avg_wait_ms"],
+                }
+                peak = report["peak_memory"]
+                print(
+                    f"{n_rows:>12} {name:>16} {report['p50'] * 1000:>9.2f}"
+                    f" {report['p95'] * 1000:>9.2f} {report['p99'] * 1000:>9.2f}"
+                    f" {report['throughput']:>10.1f}"
+                    f" {peak / 2**20 if peak else float('nan'):>11.1f}"
+                    f" {report['max_queue_depth']:>7}"
+                    f" {report['errors']:>7}",
+                    flush=True,
+                )
+                if args.output:
+                    with open(args.output, "a", encoding="utf-8") as output_file:
+                        output_file.write(json.dumps(report) + "\n")
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
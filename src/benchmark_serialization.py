@@ -0,0 +1,155 @@
+"""Benchmarks the serialization of query results to JSON, cursor vs pandas.
+
+Builds a temporary SQLite database shaped like order_data, then runs a query
+returning 10, 10k and 1M rows through the serializers of the query_order_data extension,
+checks that they produce the same output and reports their latency and peak memory:
+- pandas: `pd.read_sql(...).to_json(orient="records")`, as done originally,
+- cursor: rows encoded straight from the sqlite cursor,
+- hybrid: cursor, handing results of --pandas-min-rows rows or more over to pandas.
+"""
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import logging
+import argparse
+import tempfile
+import functools
+import tracemalloc
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "copilot_sdk_flow"))
+
+from agent_arch.extensions.order_data.serialization import (
+    query_to_json,
+    query_to_json_pandas,
+)
+
+CATEGORIES = ["Electronics", "Clothing", "Home/Garden", "Sports", "Toys", "Books"]
+
+
+def get_arg_parser(parser: argparse.ArgumentParser = None) -> argparse.ArgumentParser:
+    """Get the argument parser for the script."""
+    if parser is None:
+        parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[10, 10_000, 1_000_000],
+        help="Number of rows returned by each benchmarked query",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of runs of each query, the best latency is kept",
+    )
+    parser.add_argument(
+        "--pandas-min-rows",
+        type=int,
+        default=500,
+        help="Size from which the hybrid serializer uses pandas",
+    )
+
+    return parser
+
+
+def create_database(db_path: str, n_rows: int):
+    """Creates a table with n_rows rows shaped like order_data."""
+    random.seed(0)
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "CREATE TABLE order_data (Year INTEGER, Month INTEGER, Day INTEGER,"
+            " main_category TEXT, Number_of_Orders INTEGER,"
+            " Sum_of_Order_Value_USD REAL, Sum_of_Discount_Percentage REAL)"
+        )
+        conn.executemany(
+            "INSERT INTO order_data VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    random.randint(2020, 2024),
+                    random.randint(1, 12),
+                    random.randint(1, 28),
+                    random.choice(CATEGORIES),
+                    random.randint(0, 500),
+                    random.uniform(0, 100_000),
+                    random.uniform(0, 50) if random.random() < 0.8 else None,
+                )
+                for _ in range(n_rows)
+            ),
+        )
+
+
+def measure(function, conn: sqlite3.Connection, sql_query: str, repeat: int):
+    """Gets the best latency, the peak memory and the output of a serializer."""
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(conn, sql_query)
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(conn, sql_query)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(latencies), peak, result
+
+
+def measure_import_time(module: str) -> float:
+    """Gets the time it takes to import a module in a fresh interpreter."""
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    output = subprocess.check_output([sys.executable, "-c", code], text=True)
+    return float(output)
+
+
+def main():
+    """Run the benchmark and print a summary table."""
+    logging.basicConfig(level=logging.INFO)
+
+    parser = get_arg_parser()
+    args = parser.parse_args()
+
+    logging.info(f"import pandas: {measure_import_time('pandas'):.3f}s")
+
+    serializers = {
+        "pandas": query_to_json_pandas,
+        "cursor": query_to_json,
+        "hybrid": functools.partial(
+            query_to_json, pandas_min_rows=args.pandas_min_rows
+        ),
+    }
+
+    print(
+        f"{'rows':>10} {'serializer':>10} {'latency (s)':>12} {'peak (MiB)':>11} {'speedup':>8}"
+    )
+    for n_rows in args.rows:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = os.path.join(temp_dir, "order_data.db")
+            create_database(db_path, n_rows)
+            sql_query = "SELECT * FROM order_data"
+
+            conn = sqlite3.connect(db_path)
+            # warm up the page cache and the pandas import
+            measure(query_to_json_pandas, conn, sql_query, 1)
+            results = {
+                name: measure(function, conn, sql_query, args.repeat)
+                for name, function in serializers.items()
+            }
+            conn.close()
+
+        pandas_latency, _, pandas_result = results["pandas"]
+        for name, (latency, peak, result) in results.items():
+            assert result == pandas_result, f"{name} output differs for {n_rows} rows"
+            print(
+                f"{n_rows:>10} {name:>10} {latency:>12.4f} {peak / 2**20:>11.1f}"
+                f" {pandas_latency / latency:>7.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Builds the rollup tables of the order data database.
+
+Each rollup holds the sums of the measures of order_data grouped by a set of dimensions.
+The query_order_data extension rewrites the queries it can onto the smallest rollup
+able to answer them (see src/copilot_sdk_flow/agent_arch/extensions/order_data/rollups.py).
+
+Rollups are ignored by the extension once order_data changes, so run this script again
+after each update of the database. With --check, the queries of CHECK_QUERIES are also
+run on the base table and rewritten onto the rollups, and their results compared.
+"""
+
+import os
+import sys
+import math
+import sqlite3
+import logging
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "copilot_sdk_flow"))
+
+from agent_arch.extensions.order_data.config import OrderDataConfiguration
+from agent_arch.extensions.order_data.rollups import (
+    QueryRewriter,
+    build_rollup,
+    get_dimension_sets,
+)
+
+# queries whose results must be the same on the rollups as on the base table
+CHECK_QUERIES = [
+    "SELECT Month, SUM(Sum_of_Order_Value_USD) AS total FROM order_data WHERE Year = 2023 GROUP BY Month",
+    "SELECT main_category, SUM(Number_of_Orders) FROM order_data WHERE Year = 2022 AND Month = 3 GROUP BY main_category",
+    "SELECT Year, AVG(Sum_of_Discount_Percentage) avg_disc, COUNT(*), COUNT(Number_of_Orders) FROM order_data GROUP BY Year ORDER BY avg_disc DESC",
+    "SELECT Day_of_Week, SUM(Number_of_Orders) / SUM(Sum_of_Order_Value_USD) AS ratio FROM order_data GROUP BY Day_of_Week HAVING SUM(Number_of_Orders) > 10",
+    "SELECT MIN(Year), MAX(Month), COUNT(DISTINCT main_category) FROM order_data",
+    "SELECT COUNT(*) FROM order_data WHERE Year = 1900",
+    "SELECT Year, SUM(Number_of_Orders) FROM order_data WHERE Number_of_Orders > 5 GROUP BY Year",
+    # select aliases shadowing a measure, which SQLite reads from the rows outside of ORDER BY
+    "SELECT Month, SUM(Number_of_Orders) AS Number_of_Orders FROM order_data WHERE Number_of_Orders > 5 GROUP BY Month",
+    "SELECT Month, SUM(Number_of_Orders) Number_of_Orders FROM order_data WHERE Number_of_Orders > 5 GROUP BY Month",
+    "SELECT Month, SUM(Number_of_Orders) AS Number_of_Orders FROM order_data GROUP BY Month HAVING Number_of_Orders > 5",
+    "SELECT Month, SUM(Number_of_Orders) AS Number_of_Orders FROM order_data GROUP BY Month ORDER BY Number_of_Orders DESC",
+    "SELECT CASE WHEN Month <= 6 THEN 'H1' ELSE 'H2' END AS half, SUM(Sum_of_Shipping_Cost_USD) FROM order_data WHERE Year = 2022 GROUP BY half",
+]
+
+
+def get_arg_parser(parser: argparse.ArgumentParser = None) -> argparse.ArgumentParser:
+    """Get the argument parser for the script."""
+    if parser is None:
+        parser = argparse.ArgumentParser(description=__doc__)
+
+    config = OrderDataConfiguration.from_env()
+    parser.add_argument(
+        "--db",
+        type=str,
+        default=config.DB_PATH,
+        help="Path to the SQLite database",
+    )
+    parser.add_argument(
+        "--dimension-sets",
+        type=str,
+        default=config.ROLLUP_DIMENSION_SETS,
+        help="Dimensions of the rollups to build, e.g. 'Year,Month;Day_of_Week'",
+    )
+    parser.add_argument("--table", type=str, default="order_data")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Check that the queries rewritten onto the rollups return the same results",
+    )
+
+    return parser
+
+
+def main():
+    """Build (or rebuild) the rollup tables."""
+    logging.basicConfig(level=logging.INFO)
+
+    parser = get_arg_parser()
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    for dimensions in get_dimension_sets(args.dimension_sets):
+        rollup = build_rollup(conn, dimensions, table=args.table)
+        logging.info(
+            f"Built {rollup.table} ({rollup.row_count} rows) over {rollup.dimensions}"
+        )
+    if args.check and not check_rollups(conn, args.table):
+        conn.close()
+        sys.exit(1)
+    conn.close()
+
+
+def is_same_result(rows: list, other_rows: list) -> bool:
+    """Compares the rows of two results, floats up to rounding errors."""
+    if len(rows) != len(other_rows):
+        return False
+    for row, other_row in zip(rows, other_rows):
+        for value, other_value in zip(row, other_row):
+            if isinstance(value, float) and isinstance(other_value, (int, float)):
+                if not math.isclose(value, other_value, rel_tol=1e-9, abs_tol=1e-9):
+                    return False
+            elif value != other_value:
+                return False
+    return True
+
+
+def check_rollups(conn: sqlite3.Connection, table: str = "order_data") -> bool:
+    """Runs the queries of CHECK_QUERIES on the base table and onto the rollups.
+
+    Returns:
+        bool: True if all the queries returned the same results.
+    """
+    rewriter = QueryRewriter(table)
+    same = True
+    for sql_query in CHECK_QUERIES:
+        sql_query = sql_query.replace("order_data", table)
+        rewritten_query = rewriter.rewrite(conn, sql_query, db_version=table)
+        if rewritten_query == sql_query:
+            logging.info(f"Not rewritten: {sql_query}")
+            continue
+        if is_same_result(
+            conn.execute(sql_query).fetchall(),
+            conn.execute(rewritten_query).fetchall(),
+        ):
+            logging.info(f"Same results: {rewritten_query}")
+        else:
+            logging.error(f"Different results: {sql_query} -> {rewritten_query}")
+            same = False
+    return same
+
+
+if __name__ == "__main__":
+    main()
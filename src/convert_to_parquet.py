@@ -0,0 +1,62 @@
+"""Converts the order data SQLite database to a Parquet file, for the duckdb engine.
+
+Set ORDER_DATA_ENGINE=duckdb (and ORDER_DATA_PARQUET_PATH if not the default) to have
+the query_order_data extension query the Parquet file instead of the SQLite database.
+Requires the optional duckdb and pyarrow packages (pip install duckdb pyarrow).
+"""
+
+import os
+import sys
+import logging
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "copilot_sdk_flow"))
+
+from agent_arch.extensions.order_data.config import OrderDataConfiguration
+from agent_arch.extensions.order_data.convert import export_to_parquet
+
+
+def get_arg_parser(parser: argparse.ArgumentParser = None) -> argparse.ArgumentParser:
+    """Get the argument parser for the script."""
+    if parser is None:
+        parser = argparse.ArgumentParser(description=__doc__)
+
+    config = OrderDataConfiguration.from_env()
+    parser.add_argument(
+        "--db",
+        type=str,
+        default=config.DB_PATH,
+        help="Path to the SQLite database to convert",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=config.PARQUET_PATH,
+        help="Path to the Parquet file to write",
+    )
+    parser.add_argument("--table", type=str, default="order_data")
+    parser.add_argument(
+        "--row-group-size",
+        type=int,
+        default=122_880,
+        help="Number of rows per row group, DuckDB scans row groups in parallel",
+    )
+
+    return parser
+
+
+def main():
+    """Convert the SQLite database to Parquet."""
+    logging.basicConfig(level=logging.INFO)
+
+    parser = get_arg_parser()
+    args = parser.parse_args()
+
+    total_rows = export_to_parquet(
+        args.db, args.output, table=args.table, row_group_size=args.row_group_size
+    )
+    logging.info(f"Converted {total_rows} rows of {args.table} to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,228 @@
 import os
+import asyncio
 import logging
+import weakref
+import threading
+import importlib.util
+import httpx
 from openai import AzureOpenAI, AsyncAzureOpenAI
+from openai import DEFAULT_TIMEOUT
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from typing import Union
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+from azure.identity.aio import (
+    get_bearer_token_provider as get_async_bearer_token_provider,
+)
+from typing import Dict, Tuple, Union
 from promptflow.tracing import trace
 
+# process-wide pool of clients, keyed by (endpoint, api_version, auth_mode)
+# a flex flow worker serves many chat turns, so we create each client (and its
+# underlying connection pool, credential and token cache) only once per process
+_CLIENTS: Dict[Tuple[str, str, str], AzureOpenAI] = {}
+_CLIENTS_LOCK = threading.Lock()
+_HTTP_CLIENT: httpx.Client = None
+_CREDENTIAL: DefaultAzureCredential = None
+# async clients are bound to the event loop they're first used from (their connection
+# pool and credential hold its futures), so they're pooled per event loop, the same way
+_ASYNC_POOLS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _get_http_client_settings() -> dict:
+    """Gets the settings of the connection pool shared by the clients."""
+    # HTTP/2 requires the optional h2 package (pip install httpx[http2])
+    return dict(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("AZURE_OPENAI_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(
+                os.getenv("AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20")
+            ),
+            keepalive_expiry=float(os.getenv("AZURE_OPENAI_KEEPALIVE_EXPIRY", "60")),
+        ),
+        timeout=DEFAULT_TIMEOUT,
+    )
+
+
+def _get_http_client() -> httpx.Client:
+    """Gets the httpx client shared by all the AzureOpenAI clients of this process.
+
+    Must be called while holding _CLIENTS_LOCK.
+    """
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None:
+        settings = _get_http_client_settings()
+        logging.info(f"Creating shared http client ({settings})")
+        _HTTP_CLIENT = httpx.Client(**settings)
+    return _HTTP_CLIENT
+
+
+def _get_async_pool() -> dict:
+    """Gets the pool of async clients of the running event loop, created on first use.
+
+    Must be called while holding _CLIENTS_LOCK, from the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _ASYNC_POOLS:
+        _ASYNC_POOLS[loop] = {"clients": {}, "http_client": None, "credential": None}
+    return _ASYNC_POOLS[loop]
+
+
+def _get_async_http_client(pool: dict) -> httpx.AsyncClient:
+    """Gets the httpx client shared by all the AsyncAzureOpenAI clients of a pool.
+
+    Must be called while holding _CLIENTS_LOCK.
+    """
+    if pool["http_client"] is None:
+        settings = _get_http_client_settings()
+        logging.info(f"Creating shared async http client ({settings})")
+        pool["http_client"] = httpx.AsyncClient(**settings)
+    return pool["http_client"]
+
+
+def _get_credential() -> DefaultAzureCredential:
+    """Gets the credential shared by all the AAD clients of this process.
+
+    Must be called while holding _CLIENTS_LOCK.
+    """
+    global _CREDENTIAL
+    if _CREDENTIAL is None:
+        _CREDENTIAL = DefaultAzureCredential()
+    return _CREDENTIAL
+
+
+def _get_async_credential(pool: dict) -> AsyncDefaultAzureCredential:
+    """Gets the credential shared by all the async AAD clients of a pool.
+
+    Must be called while holding _CLIENTS_LOCK.
+    """
+    if pool["credential"] is None:
+        pool["credential"] = AsyncDefaultAzureCredential()
+    return pool["credential"]
 
-@trace
-def get_azure_openai_client(
-    stream: bool = False, azure_endpoint: str = None, api_version: str = None
-) -> Union[AzureOpenAI, AsyncAzureOpenAI]:
-    """Gets an AzureOpenAI client."""
 
+def _get_pool_key(azure_endpoint: str = None, api_version: str = None):
+    """Gets the (endpoint, api_version, auth_mode) key of a client in the pool."""
     # check if the azure_endpoint is provided or in the environment variables
     assert (
         azure_endpoint is not None or "AZURE_OPENAI_ENDPOINT" in os.environ
     ), "azure_endpoint is None, AZURE_OPENAI_ENDPOINT environment variable is required"
 
-    # create an AzureOpenAI client using AAD or key based auth
-    if "AZURE_OPENAI_API_KEY" in os.environ:
-        logging.warning(
-            "Using key-based authentification, instead we recommend using Azure AD authentification instead."
-        )
-        aoai_client = AzureOpenAI(
-            azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
-            api_key=os.environ["AZURE_OPENAI_API_KEY"],
-            api_version=api_version
-            or os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview"),
-        )
-    else:
-        logging.info("Using Azure AD authentification [recommended]")
-        credential = DefaultAzureCredential()
-        token_provider = get_bearer_token_provider(
-            credential, "https://cognitiveservices.azure.com/.default"
-        )
-        aoai_client = AzureOpenAI(
-            azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
-            api_version=api_version
-            or os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview"),
-            azure_ad_token_provider=token_provider,
-        )
-    return aoai_client
+    return (
+        azure_endpoint or os.environ["AZURE_OPENAI_ENDPOINT"],
+        api_version or os.getenv("AZURE_OPENAI_API_VERSION", "2024-05-01-preview"),
+        "key" if "AZURE_OPENAI_API_KEY" in os.environ else "aad",
+    )
+
+
+@trace
+def get_azure_openai_client(
+    stream: bool = False, azure_endpoint: str = None, api_version: str = None
+) -> Union[AzureOpenAI, AsyncAzureOpenAI]:
+    """Gets an AzureOpenAI client from the process-wide pool.
+
+    Clients are created once per (endpoint, api_version, auth mode) and share
+    a single keep-alive connection pool, they are safe to use across threads.
+    """
+    pool_key = _get_pool_key(azure_endpoint, api_version)
+    azure_endpoint, api_version, auth_mode = pool_key
+
+    with _CLIENTS_LOCK:
+        if pool_key in _CLIENTS:
+            return _CLIENTS[pool_key]
+
+        # create an AzureOpenAI client using AAD or key based auth
+        if auth_mode == "key":
+            logging.warning(
+                "Using key-based authentification, instead we recommend using Azure AD authentification instead."
+            )
+            aoai_client = AzureOpenAI(
+                azure_endpoint=azure_endpoint,
+                api_key=os.environ["AZURE_OPENAI_API_KEY"],
+                api_version=api_version,
+                http_client=_get_http_client(),
+            )
+        else:
+            logging.info("Using Azure AD authentification [recommended]")
+            token_provider = get_bearer_token_provider(
+                _get_credential(), "https://cognitiveservices.azure.com/.default"
+            )
+            aoai_client = AzureOpenAI(
+                azure_endpoint=azure_endpoint,
+                api_version=api_version,
+                azure_ad_token_provider=token_provider,
+                http_client=_get_http_client(),
+            )
+
+        _CLIENTS[pool_key] = aoai_client
+        return aoai_client
+
+
+@trace
+def get_async_azure_openai_client(
+    azure_endpoint: str = None, api_version: str = None
+) -> AsyncAzureOpenAI:
+    """Gets an AsyncAzureOpenAI client from the pool of the running event loop.
+
+    Clients are created once per event loop and (endpoint, api_version, auth mode),
+    and share a single keep-alive connection pool per event loop, they must only be
+    used from the event loop they were got from.
+    """
+    pool_key = _get_pool_key(azure_endpoint, api_version)
+    azure_endpoint, api_version, auth_mode = pool_key
+
+    with _CLIENTS_LOCK:
+        pool = _get_async_pool()
+        if pool_key in pool["clients"]:
+            return pool["clients"][pool_key]
+
+        # create an AsyncAzureOpenAI client using AAD or key based auth
+        if auth_mode == "key":
+            logging.warning(
+                "Using key-based authentification, instead we recommend using Azure AD authentification instead."
+            )
+            aoai_client = AsyncAzureOpenAI(
+                azure_endpoint=azure_endpoint,
+                api_key=os.environ["AZURE_OPENAI_API_KEY"],
+                api_version=api_version,
+                http_client=_get_async_http_client(pool),
+            )
+        else:
+            logging.info("Using Azure AD authentification [recommended]")
+            token_provider = get_async_bearer_token_provider(
+                _get_async_credential(pool),
+                "https://cognitiveservices.azure.com/.default",
+            )
+            aoai_client = AsyncAzureOpenAI(
+                azure_endpoint=azure_endpoint,
+                api_version=api_version,
+                azure_ad_token_provider=token_provider,
+                http_client=_get_async_http_client(pool),
+            )
+
+        pool["clients"][pool_key] = aoai_client
+        return aoai_client
+
+
+def close_azure_openai_clients():
+    """Closes all the pooled sync clients and their shared connection pool."""
+    global _HTTP_CLIENT
+    with _CLIENTS_LOCK:
+        _CLIENTS.clear()
+        if _HTTP_CLIENT is not None:
+            _HTTP_CLIENT.close()
+            _HTTP_CLIENT = None
+
+
+async def aclose_azure_openai_clients():
+    """Closes the pooled async clients of the running event loop
+    and their shared connection pool."""
+    with _CLIENTS_LOCK:
+        pool = _ASYNC_POOLS.pop(asyncio.get_running_loop(), None)
+    if pool is None:
+        return
+    if pool["http_client"] is not None:
+        await pool["http_client"].aclose()
+    if pool["credential"] is not None:
+        await pool["credential"].close()
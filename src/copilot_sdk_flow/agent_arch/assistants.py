@@ -0,0 +1,83 @@
+"""Caches the assistant definitions retrieved from the Assistants API.
+
+The orchestrator only needs the assistant id to start a run, which is known from
+the configuration, so the definition is only retrieved when actually needed,
+and then kept for ASSISTANT_CACHE_TTL seconds."""
+
+import os
+import time
+import logging
+import threading
+from typing import Dict, Tuple
+from openai import AzureOpenAI, AsyncAzureOpenAI
+from openai.types.beta.assistant import Assistant
+
+
+class AssistantCache:
+    """Caches assistant definitions by id, for a limited time."""
+
+    def __init__(self, ttl: float):
+        """Initializes a new assistant cache.
+
+        Args:
+            ttl (float): How long a definition is kept, in seconds.
+        """
+        self.ttl = ttl
+        self.assistants: Dict[str, Tuple[float, Assistant]] = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, assistant_id: str) -> Assistant:
+        with self._lock:
+            entry = self.assistants.get(assistant_id)
+            if entry is None:
+                return None
+            retrieved_at, assistant = entry
+            if time.monotonic() - retrieved_at >= self.ttl:
+                del self.assistants[assistant_id]
+                return None
+            return assistant
+
+    def _store(self, assistant: Assistant):
+        with self._lock:
+            self.assistants[assistant.id] = (time.monotonic(), assistant)
+
+    def get(self, client: AzureOpenAI, assistant_id: str) -> Assistant:
+        """Gets an assistant definition, retrieving it if not cached."""
+        assistant = self._lookup(assistant_id)
+        if assistant is None:
+            logging.info(f"Retrieving assistant with id: {assistant_id}")
+            assistant = client.beta.assistants.retrieve(assistant_id)
+            self._store(assistant)
+        return assistant
+
+    async def aget(self, client: AsyncAzureOpenAI, assistant_id: str) -> Assistant:
+        """Gets an assistant definition, retrieving it if not cached."""
+        assistant = self._lookup(assistant_id)
+        if assistant is None:
+            logging.info(f"Retrieving assistant with id: {assistant_id}")
+            assistant = await client.beta.assistants.retrieve(assistant_id)
+            self._store(assistant)
+        return assistant
+
+    def invalidate(self, assistant_id: str = None):
+        """Drops an assistant definition from the cache, or all of them."""
+        with self._lock:
+            if assistant_id is None:
+                self.assistants.clear()
+            else:
+                self.assistants.pop(assistant_id, None)
+
+
+_ASSISTANT_CACHE = None
+_ASSISTANT_CACHE_LOCK = threading.Lock()
+
+
+def get_assistant_cache() -> AssistantCache:
+    """Gets the assistant cache of the process."""
+    global _ASSISTANT_CACHE
+    with _ASSISTANT_CACHE_LOCK:
+        if _ASSISTANT_CACHE is None:
+            _ASSISTANT_CACHE = AssistantCache(
+                ttl=float(os.getenv("ASSISTANT_CACHE_TTL", "300"))
+            )
+        return _ASSISTANT_CACHE
@@ -9,8 +9,13 @@ class Configuration(BaseModel):
     AZURE_OPENAI_ENDPOINT: str
     AZURE_OPENAI_ASSISTANT_ID: str
     ORCHESTRATOR_MAX_WAITING_TIME: int = 60
+    ORCHESTRATOR_STREAMING: bool = True
+    ORCHESTRATOR_MAX_CONCURRENT_TOOL_CALLS: int = 4
+    # what the next turn does with a run left running past ORCHESTRATOR_MAX_WAITING_TIME:
+    # "resume" sends what it produced since, "cancel" cancels it if the turn asks something new
+    ORCHESTRATOR_PENDING_RUN_POLICY: str = "resume"
     AZURE_OPENAI_API_KEY: Optional[str] = None
-    AZURE_OPENAI_API_VERSION: Optional[str] = "2024-02-15-preview"
+    AZURE_OPENAI_API_VERSION: Optional[str] = "2024-05-01-preview"
 
     @classmethod
     def from_env_and_context(cls, context: Dict[str, str]):
@@ -36,8 +41,24 @@ class Configuration(BaseModel):
                 or os.getenv("ORCHESTRATOR_MAX_WAITING_TIME")
                 or "60"
             ),
+            ORCHESTRATOR_STREAMING=str(
+                context.get("ORCHESTRATOR_STREAMING")
+                or os.getenv("ORCHESTRATOR_STREAMING")
+                or "true"
+            ).lower()
+            in ["true", "1", "yes"],
+            ORCHESTRATOR_MAX_CONCURRENT_TOOL_CALLS=int(
+                context.get("ORCHESTRATOR_MAX_CONCURRENT_TOOL_CALLS")
+                or os.getenv("ORCHESTRATOR_MAX_CONCURRENT_TOOL_CALLS")
+                or "4"
+            ),
+            ORCHESTRATOR_PENDING_RUN_POLICY=str(
+                context.get("ORCHESTRATOR_PENDING_RUN_POLICY")
+                or os.getenv("ORCHESTRATOR_PENDING_RUN_POLICY")
+                or "resume"
+            ).lower(),
             AZURE_OPENAI_API_KEY=os.getenv("AZURE_OPENAI_API_KEY"),
             AZURE_OPENAI_API_VERSION=os.getenv(
-                "AZURE_OPENAI_API_VERSION", "2024-02-15-preview"
+                "AZURE_OPENAI_API_VERSION", "2024-05-01-preview"
             ),
         )
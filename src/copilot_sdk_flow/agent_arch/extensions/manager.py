@@ -2,20 +2,166 @@
 The ExtensionsManager class manages those extensions for the Orchestrator."""
 
 import os
+import ast
+import glob
+import time
 import inspect
+import importlib
 import json
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
 from promptflow.tracing import trace
-from typing import Any
+from types import MappingProxyType
+from typing import Any, Dict, Mapping
 import asyncio
-import inspect
+
+
+class ExtensionRuntime:
+    """Runs the extensions of the process.
+
+    Async extensions invoked from sync code are scheduled on a long-lived event loop
+    running in a dedicated thread, instead of creating a new loop per invocation.
+    Sync extensions invoked from async code run on a thread pool shared with that loop.
+    """
+
+    def __init__(self, max_workers: int = None):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="extension"
+        )
+        self.loop = None
+        self.thread = None
+        self._lock = threading.Lock()
+
+        # scheduling overhead of the invocations, in seconds
+        self.invocations = 0
+        self.total_overhead = 0.0
+        self.max_overhead = 0.0
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        """Gets the event loop of the runtime, starting it on first use."""
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.loop.set_default_executor(self.executor)
+                self.thread = threading.Thread(
+                    target=self.loop.run_forever, name="extension-loop", daemon=True
+                )
+                self.thread.start()
+            return self.loop
+
+    def record_overhead(self, name: str, overhead: float):
+        """Records the time between scheduling an invocation and its start."""
+        with self._lock:
+            self.invocations += 1
+            self.total_overhead += overhead
+            self.max_overhead = max(self.max_overhead, overhead)
+        logging.debug(f"Extension {name} scheduling overhead: {overhead * 1e6:.0f}us")
+
+    def get_stats(self) -> dict:
+        """Gets the scheduling overhead statistics of the runtime."""
+        with self._lock:
+            return {
+                "invocations": self.invocations,
+                "avg_overhead_us": (
+                    self.total_overhead / self.invocations * 1e6
+                    if self.invocations
+                    else 0.0
+                ),
+                "max_overhead_us": self.max_overhead * 1e6,
+            }
+
+    def run_coroutine(self, name: str, function, **extension_args) -> Any:
+        """Runs an async extension on the runtime loop and waits for its result."""
+        loop = self.get_loop()
+        if threading.current_thread() is self.thread:
+            raise RuntimeError(
+                f"Extension {name} can't be invoked synchronously from the extension loop, use ainvoke instead."
+            )
+
+        scheduled_at = time.perf_counter()
+
+        async def run():
+            self.record_overhead(name, time.perf_counter() - scheduled_at)
+            return await function(**extension_args)
+
+        future = Future()
+
+        def on_done(task: asyncio.Task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def schedule():
+            loop.create_task(run()).add_done_callback(on_done)
+
+        # the task is created in the caller's context (ex: tracing)
+        loop.call_soon_threadsafe(schedule, context=contextvars.copy_context())
+        return future.result()
+
+    async def run_in_executor(self, name: str, function, **extension_args) -> Any:
+        """Runs a sync extension on the shared thread pool from the running loop."""
+        scheduled_at = time.perf_counter()
+        context = contextvars.copy_context()
+
+        def run():
+            self.record_overhead(name, time.perf_counter() - scheduled_at)
+            return context.run(function, **extension_args)
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+
+
+_RUNTIME = None
+_RUNTIME_LOCK = threading.Lock()
+
+
+def get_extension_runtime() -> ExtensionRuntime:
+    """Gets the extension runtime of the process."""
+    global _RUNTIME
+    with _RUNTIME_LOCK:
+        if _RUNTIME is None:
+            _RUNTIME = ExtensionRuntime(
+                max_workers=int(os.getenv("EXTENSIONS_MAX_WORKERS", "8"))
+            )
+        return _RUNTIME
 
 
 class Extension:
     """Represents an extension that can be invoked by the assistant."""
 
-    def __init__(self, name, function):
+    def __init__(self, name, function=None, module: str = None, spec: dict = None):
+        """Initializes an extension.
+
+        Args:
+            name (str): The name of the extension, as called by the assistant.
+            function (callable): The function implementing the extension.
+            module (str): The module to import the function `name` from on first use,
+                if function is not provided.
+            spec (dict): The function tool spec of the extension.
+        """
+        assert (
+            function is not None or module is not None
+        ), "Either function or module is required"
         self.name = name
-        self.function = function
+        self.module = module
+        self.spec = spec
+        self._function = function
+        self._lock = threading.Lock()
+
+    @property
+    def function(self):
+        """The function implementing the extension, imported on first use."""
+        if self._function is None:
+            with self._lock:
+                if self._function is None:
+                    logging.info(f"Importing extension {self.name} from {self.module}")
+                    module = importlib.import_module(self.module)
+                    self._function = getattr(module, self.name)
+        return self._function
 
     @trace
     def invoke(self, **extension_args) -> Any:
@@ -29,27 +175,172 @@ class Extension:
         """
         # test if the function is async
         if inspect.iscoroutinefunction(self.function):
-            function_response = asyncio.run(self.function(**extension_args))
+            function_response = get_extension_runtime().run_coroutine(
+                self.name, self.function, **extension_args
+            )
         else:
             function_response = self.function(**extension_args)
 
         return function_response
 
+    @trace
+    async def ainvoke(self, **extension_args) -> Any:
+        """Invokes the extension with the provided arguments from an event loop.
+
+        Async extensions are awaited in the running loop, sync extensions
+        are run on the thread pool of the extension runtime so they don't block it.
+
+        Args:
+            **extension_args: The arguments to pass to the extension.
+
+        Returns:
+            Any: The response from the extension.
+        """
+        if inspect.iscoroutinefunction(self.function):
+            return await self.function(**extension_args)
+
+        return await get_extension_runtime().run_in_executor(
+            self.name, self.function, **extension_args
+        )
+
+
+def validate_extension_spec(spec: dict, module_path: str):
+    """Checks that the parameters of a function tool spec agree with the signature
+    of the function implementing it, without importing its module.
+
+    Args:
+        spec (dict): The function tool spec, with the name of the function.
+        module_path (str): The path to the python module defining the function.
+
+    Raises:
+        ValueError: if the function is missing or its signature doesn't match the spec.
+    """
+    with open(module_path) as f:
+        tree = ast.parse(f.read(), filename=module_path)
+
+    function_def = next(
+        (
+            node
+            for node in tree.body
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+            and node.name == spec["name"]
+        ),
+        None,
+    )
+    if function_def is None:
+        raise ValueError(f"Function {spec['name']} not found in {module_path}")
+
+    # list the parameters of the function, and which ones have no default
+    args = function_def.args
+    positional_args = args.posonlyargs + args.args
+    params = [arg.arg for arg in positional_args + args.kwonlyargs]
+    required_params = [
+        arg.arg for arg in positional_args[: len(positional_args) - len(args.defaults)]
+    ] + [
+        arg.arg
+        for arg, default in zip(args.kwonlyargs, args.kw_defaults)
+        if default is None
+    ]
+
+    spec_params = spec.get("parameters", {}).get("properties", {})
+    spec_required = spec.get("parameters", {}).get("required", [])
+
+    unknown_params = [
+        param for param in spec_params if param not in params and args.kwarg is None
+    ]
+    if unknown_params:
+        raise ValueError(
+            f"Extension {spec['name']}: spec parameters {unknown_params} are not accepted by the function"
+        )
+    missing_params = [param for param in required_params if param not in spec_required]
+    if missing_params:
+        raise ValueError(
+            f"Extension {spec['name']}: function parameters {missing_params} are not required by the spec"
+        )
+
+
+def discover_extensions(directory: str, package: str) -> Dict[str, Extension]:
+    """Discovers the extensions of a directory from their spec.
+
+    Each `<name>.json` function tool spec is paired with the function `<name>`
+    of the module `<name>.py`, which is imported on the first invocation.
+
+    Args:
+        directory (str): The directory containing the specs and modules.
+        package (str): The package name of the directory.
+
+    Returns:
+        Dict[str, Extension]: The extensions by name.
+    """
+    extensions = {}
+    for spec_file in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(spec_file) as f:
+            spec = json.load(f)
+        if "name" not in spec or "parameters" not in spec:
+            # not a function tool spec
+            continue
+
+        module_path = os.path.join(directory, spec["name"] + ".py")
+        if not os.path.exists(module_path):
+            raise ValueError(f"No module found for extension spec {spec_file}")
+        validate_extension_spec(spec, module_path)
+
+        extensions[spec["name"]] = Extension(
+            name=spec["name"], module=f"{package}.{spec['name']}", spec=spec
+        )
+        logging.info(f"Discovered extension {spec['name']} from {spec_file}")
+
+    return extensions
+
+
+_EXTENSIONS = None
+_EXTENSIONS_LOCK = threading.Lock()
+
+
+def load_extensions() -> Mapping[str, Extension]:
+    """Discovers the extensions of this package, once per process.
+
+    If EXTENSIONS_WARM_START is enabled, the extension modules are also
+    imported in the background right away instead of on first invocation.
+
+    Returns:
+        Mapping[str, Extension]: A read-only table of the extensions by name.
+    """
+    global _EXTENSIONS
+    with _EXTENSIONS_LOCK:
+        if _EXTENSIONS is None:
+            _EXTENSIONS = MappingProxyType(
+                discover_extensions(
+                    os.path.dirname(os.path.abspath(__file__)), __package__
+                )
+            )
+            if os.getenv("EXTENSIONS_WARM_START", "false").lower() in [
+                "true",
+                "1",
+                "yes",
+            ]:
+                threading.Thread(
+                    target=lambda: [
+                        extension.function for extension in _EXTENSIONS.values()
+                    ],
+                    name="extensions-warm-start",
+                    daemon=True,
+                ).start()
+        return _EXTENSIONS
+
 
 class ExtensionsManager:
     """Manages the extensions that can be invoked by the system."""
 
     def __init__(self, config):
-        self.extensions = {}
+        self.extensions = MappingProxyType({})
 
     def load(self):
-        """Loads the extensions into the manager."""
-        from .query_order_data import query_order_data
+        """Loads the extensions into the manager.
 
-        self.extensions["query_order_data"] = Extension(
-            name="query_order_data",
-            function=query_order_data,
-        )
+        Extensions are discovered once per process, so this is only costly on first call.
+        """
+        self.extensions = load_extensions()
 
     def get_extension(self, name: str) -> Extension:
         """Gets an extension by its name."""
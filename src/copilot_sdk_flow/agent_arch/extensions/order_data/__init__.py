@@ -0,0 +1 @@
+"""Building blocks of the query_order_data extension."""
@@ -0,0 +1,107 @@
+"""A bounded cache of query results, keyed by the normalized SQL text.
+
+The assistant tends to issue the same handful of aggregate queries across users,
+so results are kept in memory (LRU, bounded by entry count and bytes, with a TTL)
+and dropped as soon as the database file changes."""
+
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# splits a query into string literals / quoted identifiers, and the rest
+_QUOTED_RE = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|\[[^\]]*\])")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_sql(sql_query: str) -> str:
+    """Normalizes the whitespace of a query outside of quoted parts,
+    and strips its trailing semicolons.
+
+    Case is kept as is, since it shows in the column names of the results."""
+    parts = _QUOTED_RE.split(sql_query.strip().rstrip(";").strip())
+    return "".join(
+        part if i % 2 else _WHITESPACE_RE.sub(" ", part) for i, part in enumerate(parts)
+    )
+
+
+def get_db_version(db_path: str) -> Tuple[int, int, int]:
+    """Gets a cheap fingerprint of the database file, which changes when it's written to."""
+    stat = os.stat(db_path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class QueryResultCache:
+    """LRU cache of query results, bounded by entry count and bytes, with a TTL.
+
+    The whole cache is invalidated when the version of the database changes."""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        """Initializes a new cache.
+
+        Args:
+            max_entries (int): Maximum number of results kept, 0 disables the cache.
+            max_bytes (int): Maximum total size of the results kept.
+            ttl (float): How long a result is kept, in seconds.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.db_version = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _check_version(self, db_version):
+        if db_version != self.db_version:
+            self.entries.clear()
+            self.size = 0
+            self.db_version = db_version
+
+    def _pop(self, key: str):
+        _, result = self.entries.pop(key)
+        self.size -= len(result)
+
+    def get(self, sql_query: str, db_version) -> Optional[str]:
+        """Gets the cached result of a query, if any."""
+        key = normalize_sql(sql_query)
+        with self._lock:
+            self._check_version(db_version)
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] >= self.ttl:
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, sql_query: str, db_version, result: str):
+        """Caches the result of a query, evicting the least recently used ones."""
+        if self.max_entries <= 0 or len(result) > self.max_bytes:
+            return
+        key = normalize_sql(sql_query)
+        with self._lock:
+            self._check_version(db_version)
+            if key in self.entries:
+                self._pop(key)
+            self.entries[key] = (time.monotonic(), result)
+            self.size += len(result)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+
+    def get_stats(self) -> dict:
+        """Gets the hit/miss counters and the current size of the cache."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
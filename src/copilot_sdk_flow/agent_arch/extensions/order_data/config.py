@@ -0,0 +1,68 @@
+import os
+from pydantic import BaseModel
+
+_DEFAULT_DB_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "data",
+    "order_data.db",
+)
+
+
+_DEFAULT_PARQUET_PATH = os.path.join(
+    os.path.dirname(_DEFAULT_DB_PATH), "order_data.parquet"
+)
+
+
+class OrderDataConfiguration(BaseModel):
+    """Settings of the query_order_data extension,
+    each can be overridden by an ORDER_DATA_<name> environment variable."""
+
+    # "sqlite" queries DB_PATH, "duckdb" queries PARQUET_PATH
+    ENGINE: str = "sqlite"
+    DB_PATH: str = _DEFAULT_DB_PATH
+    PARQUET_PATH: str = _DEFAULT_PARQUET_PATH
+    # threads and memory of the duckdb engine, all cores and its default when not set
+    DUCKDB_THREADS: int = 0
+    DUCKDB_MEMORY_LIMIT: str = ""
+    CACHE_MAX_ENTRIES: int = 256
+    CACHE_MAX_BYTES: int = 16 * 1024 * 1024
+    CACHE_TTL: float = 600.0
+    POOL_SIZE: int = 8
+    # queries run on threads of their own, at most this many at a time
+    MAX_CONCURRENT_QUERIES: int = 4
+    # queries are rejected when this many are already waiting to run, 0 for no limit
+    MAX_QUEUED_QUERIES: int = 64
+    POOL_IMMUTABLE: bool = False
+    POOL_MMAP_SIZE: int = 256 * 1024 * 1024
+    POOL_CACHE_SIZE_KB: int = 64 * 1024
+    # "cursor" encodes the rows straight from sqlite, "pandas" goes through a DataFrame
+    SERIALIZER: str = "cursor"
+    # the cursor serializer hands results this large over to pandas, 0 never does
+    SERIALIZER_PANDAS_MIN_ROWS: int = 500
+    # larger results are truncated, and summarized for the assistant, 0 for no limit
+    RESULT_MAX_ROWS: int = 200
+    RESULT_MAX_BYTES: int = 32 * 1024
+    # rows of a truncated result fetched for its summary, the others aren't fetched
+    RESULT_SUMMARY_MAX_ROWS: int = 10_000
+    # queries running longer are interrupted, 0 for no limit
+    QUERY_TIMEOUT: float = 10.0
+    # queries joining more full table scans are rejected, 0 to skip the check
+    PREFLIGHT_MAX_FULL_SCANS: int = 1
+    # queries run are appended to this JSON lines file, for the index advisor
+    QUERY_LOG_PATH: str = ""
+    # queries are rewritten onto the rollup tables built with src/build_rollups.py
+    ROLLUPS_ENABLED: bool = True
+    # the dimensions of the rollups built by default, sets separated by ";"
+    ROLLUP_DIMENSION_SETS: str = (
+        "Year,Month;Year,Month,main_category;Year,main_category,sub_category;Day_of_Week"
+    )
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            **{
+                field: os.environ[f"ORDER_DATA_{field}"]
+                for field in cls.model_fields
+                if f"ORDER_DATA_{field}" in os.environ
+            }
+        )
@@ -0,0 +1,71 @@
+"""Exports the order_data table of a SQLite database to a Parquet file,
+for the duckdb engine (see engines.py).
+
+Columns keep the type they are declared with in SQLite, so that both engines
+return the same JSON; dates stored as text stay text. Requires the optional
+pyarrow package (pip install pyarrow)."""
+
+import logging
+import sqlite3
+
+from .serialization import FETCH_SIZE
+
+# parquet types of the SQLite type affinities, see https://www.sqlite.org/datatype3.html
+_AFFINITY_TYPES = {
+    "INT": "int64",
+    "REAL": "float64",
+    "FLOA": "float64",
+    "DOUB": "float64",
+}
+
+
+def get_parquet_type(declared_type: str) -> str:
+    """Gets the parquet type of a column from its declared SQLite type."""
+    declared_type = declared_type.upper()
+    for affinity, parquet_type in _AFFINITY_TYPES.items():
+        if affinity in declared_type:
+            return parquet_type
+    return "string"
+
+
+def export_to_parquet(
+    db_path: str,
+    parquet_path: str,
+    table: str = "order_data",
+    row_group_size: int = 122_880,
+) -> int:
+    """Exports a table to a Parquet file, one row group at a time.
+
+    Returns:
+        int: The number of rows exported.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    columns = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+    schema = pa.schema(
+        [(column[1], get_parquet_type(column[2] or "")) for column in columns]
+    )
+    cursor = conn.execute(f'SELECT * FROM "{table}"')
+
+    total_rows = 0
+    with pq.ParquetWriter(parquet_path, schema, compression="zstd") as writer:
+        while True:
+            rows = []
+            while len(rows) < row_group_size:
+                batch = cursor.fetchmany(FETCH_SIZE)
+                if not batch:
+                    break
+                rows.extend(batch)
+            if not rows:
+                break
+            arrays = [
+                pa.array(values, type=field.type)
+                for values, field in zip(zip(*rows), schema)
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            total_rows += len(rows)
+            logging.info(f"Exported {total_rows} rows to {parquet_path}")
+    conn.close()
+    return total_rows
@@ -0,0 +1,196 @@
+"""Query engines the query_order_data extension can run on, selected by ORDER_DATA_ENGINE.
+
+- sqlite: the order_data table of a SQLite database, read with a pool of read-only
+  connections, with rollups, pre-flight checks and deadlines.
+- duckdb: a Parquet file (see src/convert_to_parquet.py) exposed as an order_data view
+  of an in-process DuckDB database, which scans its columns on all cores.
+  Requires the optional duckdb package (pip install duckdb).
+
+Both return their results in the same JSON format, through the result governor, and
+their errors with the same message. Their SQL dialects differ though, for instance `/`
+is a float division in DuckDB even between integers: the assistant is told about it in
+the description of the tool (see get_tool_spec and src/create_assistant.py)."""
+
+import copy
+import logging
+import sqlite3
+import threading
+
+from .cache import get_db_version
+from .config import OrderDataConfiguration
+from .governor import ResultGovernor, get_execution_error
+from .guard import QueryGuard, QueryTimeoutError
+from .pool import SQLiteConnectionPool
+from .rollups import QueryRewriter
+
+# appended to the description of the tool for the engines whose SQL isn't SQLite's
+DIALECT_NOTES = {
+    "duckdb": (
+        "The table is queried with DuckDB, whose SQL differs from SQLite's:\n"
+        "# `/` is a float division even between integers, `//` an integer division\n"
+        "# Date is text, cast it to use date functions,"
+        " e.g. strftime(CAST(Date AS DATE), '%Y-%m')"
+    ),
+}
+
+
+def get_tool_spec(spec: dict, engine: str) -> dict:
+    """Gets the function tool spec of query_order_data (query_order_data.json)
+    telling the assistant the SQL dialect of an engine."""
+    if engine not in DIALECT_NOTES:
+        return spec
+    spec = copy.deepcopy(spec)
+    description = spec["description"].replace(
+        "in a SQLite table", f"in a {engine} table"
+    )
+    spec["description"] = f"{description}\n\n{DIALECT_NOTES[engine]}"
+    return spec
+
+
+def get_governor(config: OrderDataConfiguration) -> ResultGovernor:
+    """Gets the result governor of a configuration."""
+    return ResultGovernor(
+        max_rows=config.RESULT_MAX_ROWS,
+        max_bytes=config.RESULT_MAX_BYTES,
+        summary_max_rows=config.RESULT_SUMMARY_MAX_ROWS,
+        pandas_min_rows=(
+            1 if config.SERIALIZER == "pandas" else config.SERIALIZER_PANDAS_MIN_ROWS
+        ),
+    )
+
+
+class QueryEngine:
+    """Runs queries against order_data and encodes their results as JSON."""
+
+    def __init__(self, config: OrderDataConfiguration):
+        self.config = config
+        self.governor = get_governor(config)
+
+    def get_version(self):
+        """Gets a fingerprint of the data, which changes when it's updated."""
+        raise NotImplementedError()
+
+    def query_to_json(self, sql_query: str, db_version) -> str:
+        """Runs a query and encodes its results as JSON."""
+        raise NotImplementedError()
+
+    def close(self):
+        """Releases the resources of the engine."""
+        pass
+
+
+class SQLiteEngine(QueryEngine):
+    """Runs queries on a SQLite database, onto rollups when possible."""
+
+    def __init__(self, config: OrderDataConfiguration):
+        super().__init__(config)
+        self.pool = SQLiteConnectionPool(
+            config.DB_PATH,
+            pool_size=config.POOL_SIZE,
+            immutable=config.POOL_IMMUTABLE,
+            mmap_size=config.POOL_MMAP_SIZE,
+            cache_size_kb=config.POOL_CACHE_SIZE_KB,
+        )
+        self.rewriter = QueryRewriter()
+        self.guard = QueryGuard(
+            timeout=config.QUERY_TIMEOUT,
+            max_full_scans=config.PREFLIGHT_MAX_FULL_SCANS,
+        )
+
+    def get_version(self):
+        return get_db_version(self.config.DB_PATH)
+
+    def query_to_json(self, sql_query: str, db_version) -> str:
+        with self.pool.connection(db_version) as conn:
+            if self.config.ROLLUPS_ENABLED:
+                rewritten_query = self.rewriter.rewrite(conn, sql_query, db_version)
+                if rewritten_query != sql_query:
+                    try:
+                        with self.guard.guard(conn, rewritten_query):
+                            return self.governor.query_to_json(conn, rewritten_query)
+                    except sqlite3.DatabaseError as e:
+                        logging.warning(
+                            f"Query rewritten onto a rollup failed ({e}), running it as is"
+                        )
+
+            with self.guard.guard(conn, sql_query):
+                return self.governor.query_to_json(conn, sql_query)
+
+    def close(self):
+        self.pool.close()
+
+
+class DuckDBEngine(QueryEngine):
+    """Runs queries on a Parquet file with DuckDB, multi-threaded."""
+
+    def __init__(self, config: OrderDataConfiguration):
+        super().__init__(config)
+        try:
+            import duckdb
+        except ImportError as e:
+            raise ImportError(
+                "ORDER_DATA_ENGINE=duckdb requires the duckdb package: pip install duckdb"
+            ) from e
+        self.error_class = duckdb.Error
+
+        settings = {}
+        if config.DUCKDB_THREADS:
+            settings["threads"] = config.DUCKDB_THREADS
+        if config.DUCKDB_MEMORY_LIMIT:
+            settings["memory_limit"] = config.DUCKDB_MEMORY_LIMIT
+        self.database = duckdb.connect(":memory:", config=settings)
+        self.parquet_path = config.PARQUET_PATH
+        quoted_path = self.parquet_path.replace("'", "''")
+        self.database.execute(
+            f"CREATE VIEW order_data AS SELECT * FROM read_parquet('{quoted_path}')"
+        )
+        # each thread queries the database through its own cursor
+        self._local = threading.local()
+
+    def get_version(self):
+        return get_db_version(self.parquet_path)
+
+    def get_cursor(self):
+        """Gets the cursor of the current thread."""
+        cursor = getattr(self._local, "cursor", None)
+        if cursor is None:
+            cursor = self._local.cursor = self.database.cursor()
+        return cursor
+
+    def query_to_json(self, sql_query: str, db_version) -> str:
+        cursor = self.get_cursor()
+        timer = None
+        if self.config.QUERY_TIMEOUT:
+            timer = threading.Timer(self.config.QUERY_TIMEOUT, cursor.interrupt)
+            timer.start()
+        try:
+            return self.governor.query_to_json(cursor, sql_query)
+        except Exception as e:
+            if timer is None or timer.is_alive():
+                if isinstance(e, self.error_class):
+                    # reported to the assistant as the errors of the sqlite engine
+                    raise get_execution_error(sql_query, e) from e
+                raise
+            logging.warning(
+                f"Query interrupted after {self.config.QUERY_TIMEOUT}s: {sql_query}"
+            )
+            raise QueryTimeoutError(self.config.QUERY_TIMEOUT) from e
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def close(self):
+        self.database.close()
+
+
+ENGINES = {"sqlite": SQLiteEngine, "duckdb": DuckDBEngine}
+
+
+def create_engine(config: OrderDataConfiguration) -> QueryEngine:
+    """Creates the query engine selected by the configuration."""
+    if config.ENGINE not in ENGINES:
+        raise ValueError(
+            f"Unknown ORDER_DATA_ENGINE {config.ENGINE}, expected one of {list(ENGINES)}"
+        )
+    logging.info(f"Using {config.ENGINE} query engine")
+    return ENGINES[config.ENGINE](config)
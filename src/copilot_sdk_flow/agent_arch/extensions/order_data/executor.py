@@ -0,0 +1,118 @@
+"""Runs the blocking database work of the extension off the event loop.
+
+query_order_data is a coroutine, awaited on the event loop serving the conversations.
+Its queries block for as long as they run, so they are handed over to a thread pool
+of its own: at most max_workers queries run at a time, on as many threads, others wait
+in a queue of at most max_queued queries, and further ones are rejected right away
+rather than piling up. The depth of the queue and the time waited in it are recorded."""
+
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+
+class QueryQueueFullError(Exception):
+    """Raised when too many queries are already waiting to run."""
+
+
+class QueryExecutor:
+    """Bounded thread pool running the queries of the extension."""
+
+    def __init__(self, max_workers: int = 4, max_queued: int = 64):
+        """Initializes a new executor.
+
+        Args:
+            max_workers (int): Maximum number of queries running at the same time.
+            max_queued (int): Maximum number of queries waiting for a worker,
+                0 for no limit.
+        """
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="order-data"
+        )
+        self._lock = threading.Lock()
+
+        self.queued = 0
+        self.running = 0
+        self.submitted = 0
+        self.started = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _start(self, submitted_at: float):
+        """Records that a query left the queue for a worker."""
+        wait = time.perf_counter() - submitted_at
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.started += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        if wait > 0.1:
+            logging.debug(f"Query waited {wait * 1000:.0f}ms for a worker")
+
+    def _finish(self):
+        with self._lock:
+            self.running -= 1
+
+    async def run(self, function, *args) -> Any:
+        """Runs a blocking function on the pool, in the caller's context (ex: tracing).
+
+        Raises:
+            QueryQueueFullError: If max_queued queries are already waiting.
+        """
+        with self._lock:
+            if self.max_queued and self.queued >= self.max_queued:
+                self.rejected += 1
+                raise QueryQueueFullError(
+                    f"Too many queries waiting to run ({self.queued}), try again later"
+                )
+            self.queued += 1
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queued)
+
+        submitted_at = time.perf_counter()
+        context = contextvars.copy_context()
+
+        def run():
+            self._start(submitted_at)
+            try:
+                return context.run(function, *args)
+            finally:
+                self._finish()
+
+        def on_done(future: Future):
+            # a query cancelled before it started never left the queue
+            if future.cancelled():
+                with self._lock:
+                    self.queued -= 1
+
+        future = self.executor.submit(run)
+        future.add_done_callback(on_done)
+        return await asyncio.wrap_future(future)
+
+    def get_stats(self) -> dict:
+        """Gets the current and maximum depth of the queue, and the time waited in it."""
+        with self._lock:
+            return {
+                "queued": self.queued,
+                "running": self.running,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "max_queue_depth": self.max_queue_depth,
+                "avg_wait_ms": (
+                    self.total_wait / self.started * 1000 if self.started else 0.0
+                ),
+                "max_wait_ms": self.max_wait * 1000,
+            }
+
+    def close(self):
+        """Waits for the running queries, cancelling the queued ones."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
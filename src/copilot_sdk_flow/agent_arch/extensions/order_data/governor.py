@@ -0,0 +1,245 @@
+"""Caps the size of the query results returned to the assistant.
+
+A careless `SELECT * FROM order_data` would otherwise be materialized in memory,
+encoded and submitted as a tool output in full. Only the first rows of a result
+are kept; the next ones are streamed from the cursor into per-column summaries, and the
+assistant gets a truncation notice telling it how to refine its query. Rows beyond the
+summarized ones are never fetched, as reading them all could take longer than the
+query is allowed to run: the notice only tells there are more."""
+
+import json
+import sqlite3
+from typing import Any, Dict, List, Sequence, Tuple
+
+from .serialization import (
+    FETCH_SIZE,
+    iter_records_json,
+    rows_to_json,
+    rows_to_json_pandas,
+)
+
+# number of distinct values counted per text column before giving up
+MAX_DISTINCT_VALUES = 1000
+
+# values of different types are ordered as in sqlite: numbers, text, then blobs
+_TYPE_RANKS = {int: 0, float: 0, str: 1, bytes: 2}
+
+
+class ColumnSummary:
+    """Running summary of the values of a column: counts, range and mean."""
+
+    def __init__(self):
+        self.count = 0
+        self.nulls = 0
+        self.numbers = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.distinct = set()
+        self.too_many_distinct = False
+
+    def update(self, value: Any):
+        """Adds a value to the summary."""
+        if value is None:
+            self.nulls += 1
+            return
+        self.count += 1
+        if isinstance(value, (int, float)):
+            self.numbers += 1
+            self.total += value
+        elif not self.too_many_distinct:
+            self.distinct.add(value)
+            if len(self.distinct) > MAX_DISTINCT_VALUES:
+                self.too_many_distinct = True
+                self.distinct.clear()
+        key = (_TYPE_RANKS.get(type(value), 3), value)
+        if self.min is None or key < self.min:
+            self.min = key
+        if self.max is None or key > self.max:
+            self.max = key
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Gets the summary, in a JSON serializable form."""
+        summary = {"count": self.count, "nulls": self.nulls}
+        if self.count:
+            summary["min"] = _to_json_value(self.min[1])
+            summary["max"] = _to_json_value(self.max[1])
+        if self.numbers:
+            summary["mean"] = self.total / self.numbers
+        if self.count > self.numbers:
+            summary["distinct"] = (
+                f">{MAX_DISTINCT_VALUES}"
+                if self.too_many_distinct
+                else len(self.distinct)
+            )
+        return summary
+
+
+def _to_json_value(value: Any) -> Any:
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    if isinstance(value, float) and value - value != 0.0:
+        return None
+    return value
+
+
+def get_execution_error(sql_query: str, error: Exception) -> sqlite3.DatabaseError:
+    """Gets the error raised for a query that failed, with the same message as
+    `pd.read_sql`, whatever the engine that ran it."""
+    return sqlite3.DatabaseError(f"Execution failed on sql '{sql_query}': {error}")
+
+
+class ResultGovernor:
+    """Runs queries and encodes their results as JSON, within row and byte limits.
+
+    Results within the limits are encoded as a JSON array of records, as usual.
+    Larger results are truncated to their first rows, and returned as a JSON object
+    with the row counts, a summary of each column and a note for the assistant."""
+
+    def __init__(
+        self,
+        max_rows: int = 0,
+        max_bytes: int = 0,
+        summary_max_rows: int = 0,
+        pandas_min_rows: int = 0,
+    ):
+        """Initializes a new governor.
+
+        Args:
+            max_rows (int): Maximum number of rows returned, 0 for no limit.
+            max_bytes (int): Maximum size of the JSON returned, 0 for no limit.
+            summary_max_rows (int): Maximum number of rows of a truncated result
+                fetched and summarized, the others aren't fetched, 0 for no limit.
+            pandas_min_rows (int): Results with at least this many rows are encoded
+                with pandas, 0 never uses pandas.
+        """
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.summary_max_rows = summary_max_rows
+        self.pandas_min_rows = pandas_min_rows
+
+    def encode(self, columns: Sequence[str], rows: Sequence[Tuple]) -> str:
+        """Encodes rows as a JSON array of records."""
+        if self.pandas_min_rows and len(rows) >= self.pandas_min_rows:
+            return rows_to_json_pandas(columns, rows)
+        return rows_to_json(columns, rows)
+
+    def query_to_json(self, conn: sqlite3.Connection, sql_query: str) -> str:
+        """Runs a query and encodes its results as JSON, within the limits.
+
+        Errors are raised with the same message as `pd.read_sql`.
+        """
+        try:
+            cursor = conn.execute(sql_query)
+            if cursor.description is None:
+                return "[]"
+            columns = [description[0] for description in cursor.description]
+            # fetch one row more than allowed, to know if there are more
+            rows = self.fetch_head(cursor)
+            if not self.max_rows or len(rows) <= self.max_rows:
+                result = self.encode(columns, rows)
+                if not self.max_bytes or len(result) <= self.max_bytes:
+                    return result
+
+            summaries = [ColumnSummary() for _ in columns]
+            limit = self.summary_max_rows
+            summarized_rows = self.summarize(summaries, rows[:limit] if limit else rows)
+            total_rows = len(rows)
+            more_rows = False
+            if self.max_rows and len(rows) > self.max_rows:
+                # fetch the next rows up to summary_max_rows, then only check there are more
+                while not limit or total_rows < limit:
+                    size = FETCH_SIZE
+                    if limit:
+                        size = min(size, limit - total_rows)
+                    batch = cursor.fetchmany(size)
+                    if not batch:
+                        break
+                    summarized_rows += self.summarize(summaries, batch)
+                    total_rows += len(batch)
+                else:
+                    more_rows = cursor.fetchone() is not None
+        except sqlite3.Error as e:
+            raise get_execution_error(sql_query, e)
+
+        return self.truncate(
+            columns, rows, total_rows, summarized_rows, summaries, more_rows
+        )
+
+    def fetch_head(self, cursor: sqlite3.Cursor) -> List[Tuple]:
+        """Fetches the rows that can be returned, plus one if there are more."""
+        rows = []
+        while not self.max_rows or len(rows) <= self.max_rows:
+            size = FETCH_SIZE
+            if self.max_rows:
+                size = min(size, self.max_rows + 1 - len(rows))
+            batch = cursor.fetchmany(size)
+            if not batch:
+                break
+            rows.extend(batch)
+        return rows
+
+    def summarize(self, summaries: List[ColumnSummary], rows: Sequence[Tuple]) -> int:
+        """Adds rows to the column summaries and returns their count."""
+        for row in rows:
+            for summary, value in zip(summaries, row):
+                summary.update(value)
+        return len(rows)
+
+    def truncate(
+        self,
+        columns: Sequence[str],
+        rows: Sequence[Tuple],
+        total_rows: int,
+        summarized_rows: int,
+        summaries: List[ColumnSummary],
+        more_rows: bool = False,
+    ) -> str:
+        """Encodes the first rows of a result that exceeds the limits,
+        with a notice telling the assistant how to refine its query.
+
+        Args:
+            total_rows (int): The number of rows fetched.
+            more_rows (bool): Whether the result has more rows than fetched.
+        """
+        if self.max_rows:
+            rows = rows[: self.max_rows]
+        notice = {
+            "truncated": True,
+            "total_rows": f">{total_rows}" if more_rows else total_rows,
+            "returned_rows": len(rows),
+            "note": self.get_note(total_rows, len(rows), more_rows),
+            "summarized_rows": summarized_rows,
+            "columns": {
+                column: summary.to_dict() for column, summary in zip(columns, summaries)
+            },
+        }
+        # the notice can only get shorter once the returned rows are known
+        size = len(json.dumps(notice)) + len(',"rows":[]')
+
+        # keep as many whole rows as fit within the byte limit
+        chunks = []
+        for chunk in iter_records_json(columns, rows, chunk_size=1):
+            if chunk in ("[", "]"):
+                continue
+            if self.max_bytes and size + len(chunk) > self.max_bytes:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        if chunks:
+            chunks[0] = chunks[0].lstrip(",")
+
+        notice["returned_rows"] = len(chunks)
+        notice["note"] = self.get_note(total_rows, len(chunks), more_rows)
+        return json.dumps(notice)[:-1] + ',"rows":[' + "".join(chunks) + "]}"
+
+    def get_note(
+        self, total_rows: int, returned_rows: int, more_rows: bool = False
+    ) -> str:
+        """Gets the note telling the assistant how to refine its query."""
+        return (
+            f"The query returned {'more than ' if more_rows else ''}{total_rows} rows,"
+            f" only the first {returned_rows}"
+            " are included. Refine the query to return fewer rows, e.g. aggregate"
+            " them with GROUP BY, filter them with WHERE or add a LIMIT."
+        )
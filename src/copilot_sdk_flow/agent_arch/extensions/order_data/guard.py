@@ -0,0 +1,121 @@
+"""Keeps the queries written by the assistant from pinning a worker.
+
+Queries are checked before running with `EXPLAIN QUERY PLAN`, which rejects those
+nesting full table scans (e.g. a cross join of order_data with itself), and run
+with a deadline enforced by sqlite's progress handler, which interrupts them.
+Either way the assistant gets an error telling it to retry with a cheaper query."""
+
+import re
+import time
+import logging
+import sqlite3
+from contextlib import contextmanager
+from typing import List
+
+# the progress handler is called every this many sqlite virtual machine instructions
+PROGRESS_INSTRUCTIONS = 10_000
+
+_SCAN_RE = re.compile(r"^SCAN (\S+)")
+_MATERIALIZE_RE = re.compile(r"^(?:MATERIALIZE|CO-ROUTINE) (\S+)")
+
+
+class QueryRejectedError(Exception):
+    """Raised when a query is too expensive to be run."""
+
+    pass
+
+
+class QueryTimeoutError(Exception):
+    """Raised when a query is interrupted for running past its deadline."""
+
+    def __init__(self, timeout: float):
+        super().__init__(
+            f"Query cancelled, it ran for more than {timeout}s."
+            " Retry with a cheaper query: filter with WHERE, aggregate with"
+            " GROUP BY, and avoid joining order_data with itself."
+        )
+
+
+def get_full_scans(conn: sqlite3.Connection, sql_query: str) -> List[List[str]]:
+    """Gets the tables fully scanned by a query, grouped by nesting level.
+
+    Tables scanned at the same level are joined with nested loops, so the number of
+    rows visited is the product of their sizes. Scans of constant rows and of
+    materialized subqueries are not counted."""
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql_query}").fetchall()
+    materialized = {
+        match.group(1)
+        for _, _, _, detail in plan
+        if (match := _MATERIALIZE_RE.match(detail))
+    }
+    scans = {}
+    for _, parent, _, detail in plan:
+        match = _SCAN_RE.match(detail)
+        if match and match.group(1) not in materialized | {"CONSTANT"}:
+            scans.setdefault(parent, []).append(match.group(1))
+    return list(scans.values())
+
+
+class QueryGuard:
+    """Checks the plan of queries and enforces their deadline."""
+
+    def __init__(self, timeout: float = 0, max_full_scans: int = 0):
+        """Initializes a new guard.
+
+        Args:
+            timeout (float): Maximum running time of a query in seconds, 0 for no limit.
+            max_full_scans (int): Maximum number of full table scans joined together
+                in a query, 0 to skip the check.
+        """
+        self.timeout = timeout
+        self.max_full_scans = max_full_scans
+
+    def check(self, conn: sqlite3.Connection, sql_query: str):
+        """Checks the plan of a query before running it.
+
+        Raises:
+            QueryRejectedError: If the query joins too many full table scans.
+        """
+        if not self.max_full_scans:
+            return
+        try:
+            full_scans = get_full_scans(conn, sql_query)
+        except sqlite3.Error:
+            # invalid queries are left for the execution to report
+            return
+        for tables in full_scans:
+            if len(tables) > self.max_full_scans:
+                raise QueryRejectedError(
+                    f"Query rejected, it joins full scans of {', '.join(tables)}"
+                    f" (at most {self.max_full_scans} allowed), which would visit"
+                    " the product of their row counts. Retry with a cheaper query:"
+                    " join on indexed columns, filter with WHERE, or aggregate each"
+                    " side with GROUP BY before joining."
+                )
+
+    @contextmanager
+    def guard(self, conn: sqlite3.Connection, sql_query: str):
+        """Checks a query, then interrupts it if it's still running past the timeout.
+
+        Raises:
+            QueryRejectedError: If the query joins too many full table scans.
+            QueryTimeoutError: If the query was interrupted.
+        """
+        self.check(conn, sql_query)
+        if not self.timeout:
+            yield
+            return
+
+        deadline = time.monotonic() + self.timeout
+        conn.set_progress_handler(
+            lambda: time.monotonic() > deadline, PROGRESS_INSTRUCTIONS
+        )
+        try:
+            yield
+        except sqlite3.DatabaseError as e:
+            if time.monotonic() <= deadline:
+                raise
+            logging.warning(f"Query interrupted after {self.timeout}s: {sql_query}")
+            raise QueryTimeoutError(self.timeout) from e
+        finally:
+            conn.set_progress_handler(None, 0)
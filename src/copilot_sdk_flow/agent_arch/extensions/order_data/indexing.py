@@ -0,0 +1,310 @@
+"""Proposes and creates covering indexes for the queries written by the assistant.
+
+The assistant is told that every query is an aggregation grouped by some of the date
+and category columns, but which ones it filters and groups by drifts with usage.
+For each logged query, the columns it filters on (equality first, then range), groups
+and orders by, and reads are found, and a covering index is proposed in that order.
+Candidates are created, checked against `EXPLAIN QUERY PLAN` and timed, and only
+the ones used by at least one query that got faster are kept.
+
+The logged queries were written by the model, so they're replayed on a read-only
+connection, only the advisor itself creates and drops indexes."""
+
+import re
+import time
+import urllib.parse
+import hashlib
+import logging
+import sqlite3
+import statistics
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .cache import normalize_sql
+from .query_log import read_query_log
+
+# prefix of the names of the indexes created by the advisor
+INDEX_PREFIX = "ix_advisor_"
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_CLAUSE_RE = re.compile(
+    r"\b(WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|UNION|INTERSECT|EXCEPT)\b",
+    re.IGNORECASE,
+)
+
+
+def connect_read_only(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """Opens a read-only connection to the database of a connection."""
+    db_path = conn.execute("PRAGMA database_list").fetchone()[2]
+    if not db_path:
+        raise ValueError("Queries can only be replayed on a database file")
+    read_conn = sqlite3.connect(f"file:{urllib.parse.quote(db_path)}?mode=ro", uri=True)
+    read_conn.execute("PRAGMA query_only = ON")
+    return read_conn
+
+
+def get_table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    """Gets the column names of a table."""
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+
+def get_query_columns(sql_query: str, columns: Sequence[str]) -> Dict[str, List[str]]:
+    """Finds which columns of a table a query filters, groups and orders by, and reads.
+
+    This is a heuristic on the text of the query, not a parser, the candidates it
+    leads to are checked against the query plan anyway.
+
+    Returns:
+        dict: The columns, by role: "equality", "range", "group_by", "order_by"
+            and "other", each column appearing only once, in the first role found.
+    """
+    text = _STRING_RE.sub("''", sql_query)
+    roles = {"equality": [], "range": [], "group_by": [], "order_by": [], "other": []}
+    found = set()
+
+    def add(role: str, column: str):
+        if column not in found:
+            found.add(column)
+            roles[role].append(column)
+
+    # split the query into clauses: the select list, WHERE, GROUP BY, etc.
+    parts = _CLAUSE_RE.split(text)
+    clauses = [("SELECT", parts[0])] + [
+        (re.sub(r"\s+", " ", parts[i].upper()), parts[i + 1])
+        for i in range(1, len(parts) - 1, 2)
+    ]
+    for clause, body in clauses:
+        if clause == "WHERE":
+            for column in columns:
+                quoted = rf"(?:\b{column}\b|\"{column}\")"
+                if re.search(rf"{quoted}\s*(?:=|==|\bIN\b|\bIS\b)", body, re.I):
+                    add("equality", column)
+            for column in columns:
+                quoted = rf"(?:\b{column}\b|\"{column}\")"
+                if re.search(rf"{quoted}\s*(?:<|>|\bBETWEEN\b|\bLIKE\b)", body, re.I):
+                    add("range", column)
+        elif clause in ("GROUP BY", "ORDER BY"):
+            role = clause.lower().replace(" ", "_")
+            for column in _find_columns(body, columns):
+                add(role, column)
+    for column in _find_columns(text, columns):
+        add("other", column)
+    return roles
+
+
+def _find_columns(text: str, columns: Sequence[str]) -> List[str]:
+    """Finds the columns mentioned in a piece of query, in order of appearance."""
+    positions = []
+    for column in columns:
+        match = re.search(rf"(?:\b{column}\b|\"{column}\")", text, re.IGNORECASE)
+        if match:
+            positions.append((match.start(), column))
+    return [column for _, column in sorted(positions)]
+
+
+def propose_index(
+    sql_query: str, columns: Sequence[str], max_columns: int = 8
+) -> Optional[Tuple[str, ...]]:
+    """Proposes the columns of a covering index for a query.
+
+    The columns are ordered as the planner can use them: equality filters,
+    then group by and order by columns, then a range filter, then the other
+    columns read, which make the index covering.
+
+    Returns:
+        tuple: The columns of the index, None if the query would not benefit from one.
+    """
+    roles = get_query_columns(sql_query, columns)
+    key = roles["equality"] + roles["group_by"] + roles["order_by"] + roles["range"]
+    if not key:
+        return None
+    index_columns = key + roles["other"]
+    if len(index_columns) > max_columns:
+        # too wide to be covering, an index on the key columns still helps
+        index_columns = key[:max_columns]
+    return tuple(index_columns)
+
+
+def get_index_name(table: str, index_columns: Sequence[str]) -> str:
+    """Gets a stable name for an index created by the advisor."""
+    digest = hashlib.sha1(",".join(index_columns).encode("utf-8")).hexdigest()[:10]
+    return f"{INDEX_PREFIX}{table}_{digest}"
+
+
+def get_plan(conn: sqlite3.Connection, sql_query: str) -> List[str]:
+    """Gets the details of the query plan of a query."""
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql_query}")]
+
+
+def time_query(conn: sqlite3.Connection, sql_query: str, repeat: int = 5) -> float:
+    """Gets the median running time of a query, in seconds, after a warm up run."""
+    conn.execute(sql_query).fetchall()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(sql_query).fetchall()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def load_queries(query_log_path: str) -> Counter:
+    """Loads the successful queries of a query log, with how many times each was run.
+
+    Queries are deduplicated on their normalized text."""
+    queries = Counter()
+    originals = {}
+    for entry in read_query_log(query_log_path):
+        if entry.get("error"):
+            continue
+        key = normalize_sql(entry["sql_query"])
+        originals.setdefault(key, entry["sql_query"])
+        queries[originals[key]] += 1
+    return queries
+
+
+class IndexAdvisor:
+    """Proposes, creates and evaluates covering indexes for a set of queries."""
+
+    def __init__(
+        self,
+        conn: sqlite3.Connection,
+        table: str = "order_data",
+        max_columns: int = 8,
+        repeat: int = 5,
+        min_speedup: float = 1.1,
+        read_conn: sqlite3.Connection = None,
+    ):
+        """Initializes a new advisor.
+
+        Args:
+            conn (sqlite3.Connection): A writable connection to the database,
+                only used to create and drop the indexes.
+            table (str): The table to index.
+            max_columns (int): Maximum number of columns of an index.
+            repeat (int): Number of timed runs of each query.
+            min_speedup (float): Minimum speedup of a query for an index to be kept.
+            read_conn (sqlite3.Connection): A read-only connection to the database
+                the queries are replayed on, see connect_read_only by default.
+        """
+        self.conn = conn
+        self.read_conn = read_conn or connect_read_only(conn)
+        self.table = table
+        self.columns = get_table_columns(conn, table)
+        self.max_columns = max_columns
+        self.repeat = repeat
+        self.min_speedup = min_speedup
+
+    def get_advisor_indexes(self) -> List[str]:
+        """Gets the names of the indexes previously created by the advisor."""
+        return [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?"
+                " AND name LIKE ?",
+                (self.table, f"{INDEX_PREFIX}%"),
+            )
+        ]
+
+    def propose(self, queries: Sequence[str]) -> Dict[str, Tuple[str, ...]]:
+        """Proposes an index for each query, candidates that are a prefix
+        of another one are dropped since the longer one serves them as well.
+
+        Returns:
+            dict: The columns of each candidate index, by index name.
+        """
+        candidates = set()
+        for sql_query in queries:
+            index_columns = propose_index(sql_query, self.columns, self.max_columns)
+            if index_columns:
+                candidates.add(index_columns)
+        candidates = [
+            candidate
+            for candidate in candidates
+            if not any(
+                other != candidate and other[: len(candidate)] == candidate
+                for other in candidates
+            )
+        ]
+        return {
+            get_index_name(self.table, candidate): candidate
+            for candidate in sorted(candidates)
+        }
+
+    def time_queries(self, queries: Sequence[str]) -> Dict[str, Optional[float]]:
+        """Times each query, None for the queries that fail."""
+        timings = {}
+        for sql_query in queries:
+            try:
+                timings[sql_query] = time_query(self.read_conn, sql_query, self.repeat)
+            except sqlite3.Error as e:
+                logging.warning(f"Skipping query that failed ({e}): {sql_query}")
+                timings[sql_query] = None
+        return timings
+
+    def get_used_index(
+        self, sql_query: str, index_names: Sequence[str]
+    ) -> Optional[str]:
+        """Gets which of the given indexes the plan of a query uses, if any."""
+        for detail in get_plan(self.read_conn, sql_query):
+            for index_name in index_names:
+                if re.search(rf"\bINDEX {index_name}\b", detail):
+                    return index_name
+        return None
+
+    def advise(self, queries: Sequence[str]) -> List[dict]:
+        """Creates the candidate indexes, times the queries before and after,
+        and keeps only the indexes that made at least one query faster.
+
+        Indexes previously created by the advisor are dropped first, so that
+        the queries are timed against the table as it was originally, and
+        evaluated again along with the new candidates.
+
+        Args:
+            queries (list): The queries to tune the table for.
+
+        Returns:
+            list: A report of each query: its timings, the index it uses and its speedup.
+        """
+        for index_name in self.get_advisor_indexes():
+            self.conn.execute(f'DROP INDEX "{index_name}"')
+        self.conn.commit()
+
+        before = self.time_queries(queries)
+        queries = [sql_query for sql_query in queries if before[sql_query] is not None]
+        candidates = self.propose(queries)
+        logging.info(f"Proposed {len(candidates)} indexes: {candidates}")
+
+        for index_name, index_columns in candidates.items():
+            quoted_columns = ", ".join(f'"{column}"' for column in index_columns)
+            self.conn.execute(
+                f'CREATE INDEX "{index_name}" ON "{self.table}" ({quoted_columns})'
+            )
+        self.conn.execute(f'ANALYZE "{self.table}"')
+        # visible to the queries replayed on the read-only connection
+        self.conn.commit()
+
+        after = self.time_queries(queries)
+        report = []
+        useful = set()
+        for sql_query in queries:
+            index_name = self.get_used_index(sql_query, list(candidates))
+            speedup = before[sql_query] / after[sql_query] if after[sql_query] else None
+            if index_name and speedup and speedup >= self.min_speedup:
+                useful.add(index_name)
+            report.append(
+                {
+                    "sql_query": sql_query,
+                    "before": before[sql_query],
+                    "after": after[sql_query],
+                    "speedup": speedup,
+                    "index": index_name,
+                    "index_columns": candidates.get(index_name),
+                }
+            )
+
+        for index_name in set(candidates) - useful:
+            self.conn.execute(f'DROP INDEX "{index_name}"')
+        self.conn.commit()
+        for entry in report:
+            entry["kept"] = entry["index"] in useful
+        return report
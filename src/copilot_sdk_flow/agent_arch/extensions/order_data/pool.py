@@ -0,0 +1,98 @@
+"""Read-only connections to the order data SQLite database, one per thread.
+
+A single connection shared across threads serializes every query, so each worker
+thread gets its own connection, opened in read-only mode with pragmas tuned
+for analytical reads."""
+
+import logging
+import sqlite3
+import threading
+import urllib.parse
+from contextlib import contextmanager
+
+
+class SQLiteConnectionPool:
+    """Pool of read-only SQLite connections, one per thread.
+
+    At most pool_size connections are in use at the same time, other threads
+    wait for one of them to be released."""
+
+    def __init__(
+        self,
+        db_path: str,
+        pool_size: int = 8,
+        immutable: bool = False,
+        mmap_size: int = 256 * 1024 * 1024,
+        cache_size_kb: int = 64 * 1024,
+    ):
+        """Initializes a new pool.
+
+        Args:
+            db_path (str): The path to the database file.
+            pool_size (int): Maximum number of connections in use at the same time.
+            immutable (bool): Opens the database as immutable, which skips all locking
+                but is only safe if the file is never modified while the pool is open.
+            mmap_size (int): Bytes of the database to memory map.
+            cache_size_kb (int): Size of the page cache of each connection, in KiB.
+        """
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.uri = f"file:{urllib.parse.quote(db_path)}?mode=ro" + (
+            "&immutable=1" if immutable else ""
+        )
+        self.pragmas = [
+            "PRAGMA query_only = ON",
+            f"PRAGMA mmap_size = {int(mmap_size)}",
+            f"PRAGMA cache_size = -{int(cache_size_kb)}",
+            "PRAGMA temp_store = MEMORY",
+        ]
+        self._semaphore = threading.BoundedSemaphore(pool_size)
+        self._local = threading.local()
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        logging.info(
+            f"Opening connection to {self.uri} in thread {threading.current_thread().name}"
+        )
+        conn = sqlite3.connect(self.uri, uri=True)
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        with self._lock:
+            self._connections.add(conn)
+        return conn
+
+    def _discard(self, conn: sqlite3.Connection):
+        with self._lock:
+            self._connections.discard(conn)
+        conn.close()
+
+    @contextmanager
+    def connection(self, db_version=None):
+        """Gets the connection of the current thread.
+
+        Args:
+            db_version: The current version of the database file, the connection
+                is reopened if it was opened on another version (ex: file replaced).
+        """
+        with self._semaphore:
+            conn = getattr(self._local, "conn", None)
+            if conn is not None and self._local.db_version != db_version:
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._local.conn = self._open()
+                self._local.db_version = db_version
+            yield conn
+
+    def close(self):
+        """Closes all the connections of the pool."""
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                # connections can only be closed from the thread that created them
+                # in older sqlite3 versions, they'll be closed when collected
+                pass
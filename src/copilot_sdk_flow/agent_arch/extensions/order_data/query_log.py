@@ -0,0 +1,61 @@
+"""Logs the queries written by the assistant, to tune the database offline.
+
+Each query run by the extension is appended to a JSON lines file, with its duration
+and outcome. The log is replayed by the index advisor (see src/advise_indexes.py)
+to keep the database indexed for the queries the assistant actually writes."""
+
+import json
+import time
+import logging
+import threading
+from typing import Iterator, Optional
+
+
+class QueryLog:
+    """Appends the queries run by the extension to a JSON lines file."""
+
+    def __init__(self, path: str):
+        """Initializes a new query log.
+
+        Args:
+            path (str): The path of the log file, an empty path disables the log.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        sql_query: str,
+        duration: float,
+        cached: bool = False,
+        error: Optional[str] = None,
+    ):
+        """Appends a query to the log, failures to write it are only logged."""
+        if not self.path:
+            return
+        entry = json.dumps(
+            {
+                "timestamp": time.time(),
+                "sql_query": sql_query,
+                "duration": duration,
+                "cached": cached,
+                "error": error,
+            }
+        )
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as log_file:
+                log_file.write(entry + "\n")
+        except OSError as e:
+            logging.warning(f"Could not write to query log {self.path}: {e}")
+
+
+def read_query_log(path: str) -> Iterator[dict]:
+    """Reads the entries of a query log, skipping the lines that can't be parsed."""
+    with open(path, encoding="utf-8") as log_file:
+        for line in log_file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(entry, dict) and entry.get("sql_query"):
+                yield entry
@@ -0,0 +1,462 @@
+"""Pre-aggregated rollups of order_data, and the rewriting of queries onto them.
+
+Most questions hit a few aggregation shapes (totals by month, by category, by day
+of week). For each configured set of dimensions, a rollup table holds the sums of
+all the measures grouped by these dimensions, with the counts needed to compute
+averages. Queries that only filter and group by dimensions of a rollup, and only
+aggregate measures with SUM, TOTAL, AVG or COUNT, are rewritten onto the smallest
+rollup that can answer them; all the others run on the base table as written.
+
+Rollups are built offline (see src/build_rollups.py) since the extension only opens
+the database read-only, and are ignored once the base table has changed: the catalog
+records a fingerprint of the base table (its row count, last rowid and the totals of
+its measures), so appends, deletions and updates of the measures are detected. Updates
+that only move rows between dimension values, keeping these totals, are not."""
+
+import re
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+# the columns of order_data that queries filter and group by, the others are measures
+DIMENSIONS = (
+    "Year",
+    "Month",
+    "Day",
+    "Date",
+    "Day_of_Week",
+    "main_category",
+    "sub_category",
+    "product_type",
+)
+
+CATALOG_TABLE = "rollup_catalog"
+ROW_COUNT_COLUMN = "_row_count"
+
+_KEYWORDS = set(
+    """ALL AND AS ASC BETWEEN BY CASE CAST COLLATE DESC DISTINCT ELSE END ESCAPE FALSE
+    FROM GLOB GROUP HAVING IN INTEGER IS LIKE LIMIT NOCASE NOT NULL NUMERIC OFFSET OR
+    ORDER REAL SELECT TEXT THEN TRUE WHEN WHERE""".split()
+)
+# keywords that make a query too complex to be rewritten
+_UNSUPPORTED_KEYWORDS = set(
+    "EXCEPT EXISTS FILTER INTERSECT JOIN OVER RECURSIVE UNION WINDOW WITH".split()
+)
+_AGGREGATES = {"SUM", "TOTAL", "AVG", "COUNT", "MIN", "MAX"}
+_CLAUSES = {"WHERE", "GROUP", "HAVING", "ORDER", "LIMIT"}
+
+_TOKEN_RE = re.compile(
+    r"""
+    (?P<space>\s+|--[^\n]*|/\*.*?\*/)
+    |(?P<string>'(?:[^']|'')*')
+    |(?P<quoted>"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])
+    |(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    |(?P<name>[A-Za-z_][A-Za-z0-9_$]*)
+    |(?P<op><=|>=|<>|!=|==|\|\||<<|>>|[-+*/%<>=~&|(),.;?:@$])
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+class Token(NamedTuple):
+    kind: str
+    text: str
+    start: int
+    end: int
+
+    @property
+    def name(self) -> Optional[str]:
+        """The identifier this token stands for, unquoted, if any."""
+        if self.kind == "name":
+            return self.text
+        if self.kind == "quoted":
+            return self.text[1:-1]
+        return None
+
+
+class Rollup(NamedTuple):
+    table: str
+    dimensions: Tuple[str, ...]
+    row_count: int
+
+
+def tokenize(sql_query: str) -> Optional[List[Token]]:
+    """Splits a query into tokens, without whitespace and comments.
+
+    Returns:
+        list: The tokens, None if the query can't be tokenized.
+    """
+    tokens = []
+    position = 0
+    while position < len(sql_query):
+        match = _TOKEN_RE.match(sql_query, position)
+        if match is None:
+            return None
+        if match.lastgroup != "space":
+            tokens.append(Token(match.lastgroup, match.group(), *match.span()))
+        position = match.end()
+    return tokens
+
+
+def get_rollup_table(dimensions: Sequence[str]) -> str:
+    """Gets the name of the rollup table of a set of dimensions."""
+    return "rollup_" + "_".join(dimension.lower() for dimension in dimensions)
+
+
+def get_dimension_sets(dimension_sets: str) -> List[List[str]]:
+    """Parses sets of dimensions separated by ";", e.g. "Year,Month;Day_of_Week"."""
+    parsed = []
+    for dimension_set in dimension_sets.split(";"):
+        dimensions = [
+            dimension.strip() for dimension in dimension_set.split(",") if dimension
+        ]
+        if dimensions:
+            parsed.append(dimensions)
+    return parsed
+
+
+def get_measures(conn: sqlite3.Connection, table: str = "order_data") -> List[str]:
+    """Gets the columns of the base table that are summed up in the rollups."""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+    return [column for column in columns if column not in DIMENSIONS]
+
+
+def get_base_fingerprint(conn: sqlite3.Connection, table: str = "order_data") -> str:
+    """Gets a fingerprint of the rows of the base table, from their count, the last rowid
+    and the totals of the measures, which a rollup built from other rows wouldn't match.
+    """
+    aggregates = ["COUNT(*)", "MAX(rowid)"]
+    aggregates += [f'TOTAL("{measure}")' for measure in get_measures(conn, table)]
+    row = conn.execute(f'SELECT {", ".join(aggregates)} FROM "{table}"').fetchone()
+    return hashlib.sha1(json.dumps(row).encode("utf-8")).hexdigest()
+
+
+def build_rollup(
+    conn: sqlite3.Connection, dimensions: Sequence[str], table: str = "order_data"
+) -> Rollup:
+    """Builds (or rebuilds) the rollup of a set of dimensions, and records it
+    in the catalog along with the fingerprint of the base table it was built from."""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+    unknown = set(dimensions) - set(columns)
+    if unknown:
+        raise ValueError(f"Unknown columns in rollup dimensions: {sorted(unknown)}")
+    measures = get_measures(conn, table)
+
+    rollup_table = get_rollup_table(dimensions)
+    quoted_dimensions = ", ".join(f'"{dimension}"' for dimension in dimensions)
+    aggregates = [f'COUNT(*) AS "{ROW_COUNT_COLUMN}"']
+    for measure in measures:
+        aggregates.append(f'SUM("{measure}") AS "{measure}"')
+        aggregates.append(f'COUNT("{measure}") AS "_count_{measure}"')
+
+    catalog_columns = {
+        row[1] for row in conn.execute(f"PRAGMA table_info({CATALOG_TABLE})")
+    }
+    if catalog_columns and "base_fingerprint" not in catalog_columns:
+        # a catalog from before the fingerprints, whose rollups can't be checked
+        logging.warning(f"Dropping {CATALOG_TABLE}, rebuild all the rollups")
+        conn.execute(f"DROP TABLE {CATALOG_TABLE}")
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {CATALOG_TABLE} (name TEXT PRIMARY KEY,"
+        " dimensions TEXT, row_count INTEGER, base_fingerprint TEXT, built_at REAL)"
+    )
+    conn.execute(f'DROP TABLE IF EXISTS "{rollup_table}"')
+    conn.execute(
+        f'CREATE TABLE "{rollup_table}" AS SELECT {quoted_dimensions},'
+        f' {", ".join(aggregates)} FROM "{table}" GROUP BY {quoted_dimensions}'
+    )
+    conn.execute(
+        f'CREATE INDEX "{rollup_table}_dimensions" ON "{rollup_table}"'
+        f" ({quoted_dimensions})"
+    )
+    row_count = conn.execute(f'SELECT COUNT(*) FROM "{rollup_table}"').fetchone()[0]
+    base_fingerprint = get_base_fingerprint(conn, table)
+    conn.execute(
+        f"INSERT OR REPLACE INTO {CATALOG_TABLE} VALUES (?, ?, ?, ?, ?)",
+        (rollup_table, ",".join(dimensions), row_count, base_fingerprint, time.time()),
+    )
+    conn.commit()
+    return Rollup(rollup_table, tuple(dimensions), row_count)
+
+
+def load_rollups(conn: sqlite3.Connection, table: str = "order_data") -> List[Rollup]:
+    """Loads the rollups of the catalog that are up to date with the base table."""
+    try:
+        catalog = conn.execute(
+            f"SELECT name, dimensions, row_count, base_fingerprint FROM {CATALOG_TABLE}"
+        ).fetchall()
+    except sqlite3.OperationalError as e:
+        # no rollups were built, or not since the fingerprints
+        if "no such table" not in str(e):
+            logging.warning(f"Ignoring the rollups, rebuild them: {e}")
+        return []
+    if not catalog:
+        return []
+    base_fingerprint = get_base_fingerprint(conn, table)
+
+    rollups = []
+    for name, dimensions, row_count, rollup_base_fingerprint in catalog:
+        if rollup_base_fingerprint != base_fingerprint:
+            logging.warning(
+                f"Ignoring rollup {name}, {table} changed since it was built"
+            )
+            continue
+        rollups.append(Rollup(name, tuple(dimensions.split(",")), row_count))
+    return sorted(rollups, key=lambda rollup: rollup.row_count)
+
+
+class QueryRewriter:
+    """Rewrites queries on the base table onto the smallest rollup that can answer them."""
+
+    def __init__(self, table: str = "order_data"):
+        """Initializes a new rewriter.
+
+        Args:
+            table (str): The base table.
+        """
+        self.table = table
+        self.rollups: List[Rollup] = []
+        # the columns of the base table, lowercase, which select aliases can shadow
+        self.columns = set()
+        self.db_version = None
+        self._lock = threading.Lock()
+
+    def get_rollups(self, conn: sqlite3.Connection, db_version) -> List[Rollup]:
+        """Gets the rollups available, reloading them when the database changes."""
+        with self._lock:
+            if db_version != self.db_version:
+                self.rollups = load_rollups(conn, self.table)
+                self.columns = {
+                    row[1].lower()
+                    for row in conn.execute(f'PRAGMA table_info("{self.table}")')
+                }
+                self.db_version = db_version
+                if self.rollups:
+                    logging.info(f"Loaded rollups: {self.rollups}")
+            return self.rollups
+
+    def rewrite(self, conn: sqlite3.Connection, sql_query: str, db_version) -> str:
+        """Rewrites a query onto the smallest rollup that can answer it.
+
+        Returns:
+            str: The rewritten query, or the query as is if no rollup can answer it.
+        """
+        rollups = self.get_rollups(conn, db_version)
+        if not rollups:
+            return sql_query
+        query = sql_query.strip().rstrip(";").strip()
+        analysis = self.analyze(query, self.columns)
+        if analysis is None:
+            return sql_query
+        dimensions, replacements = analysis
+        for rollup in rollups:
+            if dimensions <= set(rollup.dimensions):
+                return self.apply(query, replacements, rollup.table)
+        return sql_query
+
+    def analyze(
+        self, query: str, columns: set = frozenset()
+    ) -> Optional[Tuple[set, Dict[Tuple[int, int], Optional[str]]]]:
+        """Checks whether a query has a shape rollups can answer.
+
+        Args:
+            query (str): The query, without its trailing semicolon.
+            columns (set): The columns of the base table, lowercase.
+
+        Returns:
+            tuple: The dimensions the query uses, and the replacements to make
+                by (start, end) span of the query, None if it can't be rewritten.
+        """
+        tokens = tokenize(query)
+        if not tokens or tokens[0].text.upper() != "SELECT":
+            return None
+        upper = [
+            token.text.upper() if token.kind == "name" else None for token in tokens
+        ]
+        if _UNSUPPORTED_KEYWORDS & set(upper) or upper.count("SELECT") != 1:
+            return None
+        if any(token.text in (";", ".", "?", ":", "@", "$") for token in tokens):
+            return None
+
+        # the query must read the base table only, without an alias
+        if "FROM" not in upper:
+            return None
+        from_index = upper.index("FROM")
+        if from_index + 1 >= len(tokens) or tokens[from_index + 1].name != self.table:
+            return None
+        if from_index + 2 < len(tokens) and upper[from_index + 2] not in (
+            "WHERE",
+            "GROUP",
+            "HAVING",
+            "ORDER",
+            "LIMIT",
+        ):
+            return None
+        table_token = tokens[from_index + 1]
+        # the table is replaced by the rollup chosen
+        replacements = {(table_token.start, table_token.end): None}
+
+        items = self.get_select_items(tokens, from_index)
+        aliases = {
+            tokens[end].name
+            for start, end in items
+            if self.has_alias(tokens, start, end)
+        }
+        dimensions = set()
+        rewritten_items = set()
+        aggregated = False
+        clause = None
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if upper[i] in _CLAUSES:
+                clause = upper[i]
+            if token.text == "*" and (
+                tokens[i - 1].text == ","
+                or upper[i - 1] in ("SELECT", "DISTINCT", "ALL")
+            ):
+                # SELECT * reads rows, not aggregates
+                return None
+            if token.name is None or i == from_index + 1:
+                i += 1
+                continue
+            is_call = i + 1 < len(tokens) and tokens[i + 1].text == "("
+            if is_call and upper[i] in _AGGREGATES:
+                end = self.find_closing(tokens, i + 1)
+                if end is None:
+                    return None
+                replacement = self.rewrite_aggregate(tokens, i, end, dimensions)
+                if replacement is None:
+                    return None
+                span = (token.start, tokens[end].end)
+                if replacement != query[span[0] : span[1]]:
+                    replacements[span] = replacement
+                    if i < from_index:
+                        rewritten_items.update(
+                            item for item in items if item[0] <= i <= item[1]
+                        )
+                aggregated = True
+                i = end + 1
+                continue
+            if is_call or upper[i] in _KEYWORDS or upper[i - 1] == "AS":
+                # a function, a keyword or an alias
+                pass
+            elif token.name in DIMENSIONS:
+                dimensions.add(token.name)
+            elif token.name not in aliases:
+                # a measure outside of an aggregate, or an unknown name
+                return None
+            elif i > from_index and (
+                clause == "WHERE"
+                or (clause != "ORDER" and token.name.lower() in columns)
+            ):
+                # a select alias filtered on, or shadowing a column of the base table:
+                # outside of ORDER BY, SQLite reads the column of the rows, not the alias
+                return None
+            i += 1
+
+        if not aggregated and "GROUP" not in upper:
+            return None
+
+        # keep the names of the select items as written, they show in the results
+        for start, end in rewritten_items:
+            if not self.has_alias(tokens, start, end):
+                text = query[tokens[start].start : tokens[end].end]
+                alias = text.replace('"', '""')
+                position = tokens[end].end
+                replacements[(position, position)] = f' AS "{alias}"'
+        return dimensions, replacements
+
+    def rewrite_aggregate(
+        self, tokens: List[Token], i: int, end: int, dimensions: set
+    ) -> Optional[str]:
+        """Rewrites an aggregate call over the base table into one over a rollup.
+
+        Returns:
+            str: The aggregate over the rollup, None if it can't be computed from it.
+        """
+        function = tokens[i].text.upper()
+        arguments = tokens[i + 2 : end]
+        if function == "COUNT" and [token.text for token in arguments] == ["*"]:
+            return f'COALESCE(SUM("{ROW_COUNT_COLUMN}"), 0)'
+        distinct = bool(arguments) and arguments[0].text.upper() == "DISTINCT"
+        if distinct:
+            arguments = arguments[1:]
+        if len(arguments) != 1 or arguments[0].name is None:
+            return None
+        column = arguments[0].name
+        if column in DIMENSIONS:
+            # a rollup has the same distinct values, and extremes, of its dimensions
+            if (function in ("MIN", "MAX") and not distinct) or (
+                function == "COUNT" and distinct
+            ):
+                dimensions.add(column)
+                distinct_text = "DISTINCT " if distinct else ""
+                return f'{tokens[i].text}({distinct_text}"{column}")'
+            return None
+        if distinct or column.upper() in _KEYWORDS:
+            return None
+        if function in ("SUM", "TOTAL"):
+            return f'{tokens[i].text}("{column}")'
+        if function == "COUNT":
+            return f'COALESCE(SUM("_count_{column}"), 0)'
+        if function == "AVG":
+            return f'(CAST(SUM("{column}") AS REAL) / SUM("_count_{column}"))'
+        # MIN and MAX of a measure can't be computed from sums
+        return None
+
+    def find_closing(self, tokens: List[Token], i: int) -> Optional[int]:
+        """Finds the index of the parenthesis closing the one at index i."""
+        depth = 0
+        for j in range(i, len(tokens)):
+            if tokens[j].text == "(":
+                depth += 1
+            elif tokens[j].text == ")":
+                depth -= 1
+                if depth == 0:
+                    return j
+        return None
+
+    def get_select_items(
+        self, tokens: List[Token], from_index: int
+    ) -> List[Tuple[int, int]]:
+        """Gets the first and last tokens of each item of the select list."""
+        start = 2 if tokens[1].text.upper() in ("DISTINCT", "ALL") else 1
+        items = []
+        depth = 0
+        for j in range(start, from_index):
+            if tokens[j].text == "(":
+                depth += 1
+            elif tokens[j].text == ")":
+                depth -= 1
+            elif tokens[j].text == "," and depth == 0:
+                items.append((start, j - 1))
+                start = j + 1
+        items.append((start, from_index - 1))
+        return items
+
+    def has_alias(self, tokens: List[Token], start: int, end: int) -> bool:
+        """Checks whether a select item ends with an alias."""
+        if end - start < 1 or tokens[end].name is None:
+            return False
+        return tokens[end - 1].text.upper() == "AS" or tokens[end - 1].text == ")"
+
+    def apply(
+        self,
+        query: str,
+        replacements: Dict[Tuple[int, int], Optional[str]],
+        table: str,
+    ) -> str:
+        """Applies the replacements to the spans of a query, None standing for the table."""
+        parts = []
+        position = 0
+        for (start, end), text in sorted(replacements.items()):
+            parts.append(query[position:start])
+            parts.append(f'"{table}"' if text is None else text)
+            position = end
+        parts.append(query[position:])
+        return "".join(parts)
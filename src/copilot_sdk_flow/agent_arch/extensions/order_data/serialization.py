@@ -0,0 +1,192 @@
+"""Encodes query results to JSON straight from the sqlite cursor, without pandas.
+
+The output is byte for byte the one of `pd.read_sql(...).to_json(orient="records")`,
+which is what the assistant has always been given:
+- a column holding numbers and NULLs only is a float column, so its integers show
+  as `1.0` and its NULLs (and infinities) as `null`,
+- a column holding any text is an object column, values are written as they are,
+- floats are rounded to 10 decimals, or written with `%.10g` when too large or small,
+- strings are ASCII only, with `/` escaped as `\\/`."""
+
+import sqlite3
+from decimal import Decimal
+from json.encoder import encode_basestring_ascii
+from typing import Any, Callable, Iterable, Iterator, List, Sequence, Tuple
+
+# rows are fetched from the cursor in batches of this size
+FETCH_SIZE = 1000
+
+# precision and thresholds of the double encoder of pandas (ujson)
+_DOUBLE_PRECISION = 10
+_POW10 = 10.0**_DOUBLE_PRECISION
+_THRES_MAX = 1e16 - 1
+_THRES_MIN = 1e-15
+
+
+def encode_float(value: float) -> str:
+    """Encodes a float the way pandas does, rounded to 10 decimals."""
+    if value - value != 0.0:
+        # nan or infinity
+        return "null"
+    neg = value < 0
+    if neg:
+        value = -value
+    if value > _THRES_MAX or (value != 0.0 and value < _THRES_MIN):
+        return "%.10g" % (-value if neg else value)
+
+    whole = int(value)
+    tmp = (value - whole) * _POW10
+    frac = int(tmp)
+    diff = tmp - frac
+    if diff > 0.5 or (diff == 0.5 and (frac == 0 or frac & 1)):
+        frac += 1
+    if frac >= _POW10:
+        frac = 0
+        whole += 1
+
+    if frac:
+        text = f"{whole}.{frac:010d}".rstrip("0")
+    else:
+        text = f"{whole}.0"
+    return "-" + text if neg else text
+
+
+def encode_str(value: str) -> str:
+    """Encodes a string the way pandas does, ASCII only and with `/` escaped."""
+    if "\x7f" in value:
+        # unlike json, ujson leaves DEL as is
+        parts = [encode_str(part)[1:-1] for part in value.split("\x7f")]
+        return '"' + "\x7f".join(parts) + '"'
+    return encode_basestring_ascii(value).replace("/", "\\/")
+
+
+def encode_value(value: Any) -> str:
+    """Encodes a value of an object column."""
+    if value is None:
+        return "null"
+    if isinstance(value, str):
+        return encode_str(value)
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (float, Decimal)):
+        return encode_float(float(value))
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, bytes):
+        return encode_str(value.decode("utf-8", errors="replace"))
+    # e.g. dates, returned by other engines than sqlite
+    return encode_str(str(value))
+
+
+def _encode_float_or_null(value: Any) -> str:
+    return "null" if value is None else encode_float(float(value))
+
+
+def get_column_encoder(values: Sequence[Any]) -> Callable[[Any], str]:
+    """Infers the type of a column, the way pandas does, and picks its encoder."""
+    kinds = set(map(type, values))
+    if not kinds or kinds == {int}:
+        return str
+    if kinds == {str}:
+        return encode_str
+    if kinds <= {int, float, Decimal, type(None)} and kinds != {type(None)}:
+        return _encode_float_or_null
+    return encode_value
+
+
+def iter_records_json(
+    columns: Sequence[str], rows: Sequence[Tuple], chunk_size: int = FETCH_SIZE
+) -> Iterator[str]:
+    """Encodes rows as a JSON array of records, in chunks of chunk_size rows.
+
+    Values are encoded column by column, then laid out in records with a template,
+    which keeps most of the work out of the Python interpreter loop.
+
+    Raises:
+        ValueError: If the column names are not unique.
+    """
+    if len(set(columns)) != len(columns):
+        raise ValueError("DataFrame columns must be unique for orient='records'.")
+    if not rows:
+        yield "[]"
+        return
+
+    values = list(zip(*rows))
+    encoders = [get_column_encoder(column_values) for column_values in values]
+    template = (
+        "{"
+        + ",".join(
+            encode_str(str(column)).replace("%", "%%") + ":%s" for column in columns
+        )
+        + "}"
+    )
+
+    yield "["
+    for start in range(0, len(rows), chunk_size):
+        encoded = zip(
+            *(
+                map(encode, column_values[start : start + chunk_size])
+                for encode, column_values in zip(encoders, values)
+            )
+        )
+        chunk = ",".join(map(template.__mod__, encoded))
+        yield chunk if start == 0 else "," + chunk
+    yield "]"
+
+
+def rows_to_json(columns: Sequence[str], rows: Iterable[Tuple]) -> str:
+    """Encodes rows as a JSON array of records."""
+    if not isinstance(rows, Sequence):
+        rows = list(rows)
+    return "".join(iter_records_json(columns, rows))
+
+
+def rows_to_json_pandas(columns: Sequence[str], rows: Sequence[Tuple]) -> str:
+    """Encodes rows as a JSON array of records with pandas, as `pd.read_sql` would."""
+    import pandas as pd
+
+    df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+    return df.to_json(orient="records")
+
+
+def fetch_rows(cursor: sqlite3.Cursor) -> Tuple[List[str], List[Tuple]]:
+    """Fetches the column names and all the rows of an executed query."""
+    if cursor.description is None:
+        return [], []
+    columns = [description[0] for description in cursor.description]
+    rows = []
+    while True:
+        batch = cursor.fetchmany(FETCH_SIZE)
+        if not batch:
+            return columns, rows
+        rows.extend(batch)
+
+
+def query_to_json(
+    conn: sqlite3.Connection, sql_query: str, pandas_min_rows: int = 0
+) -> str:
+    """Runs a query and encodes its results as a JSON array of records.
+
+    Errors are raised with the same message as `pd.read_sql`.
+
+    Args:
+        conn (sqlite3.Connection): The connection to run the query on.
+        sql_query (str): The query.
+        pandas_min_rows (int): Results with at least this many rows are encoded
+            with pandas, whose C encoder wins on large results, 0 never uses pandas.
+    """
+    try:
+        cursor = conn.execute(sql_query)
+        columns, rows = fetch_rows(cursor)
+    except sqlite3.Error as e:
+        raise sqlite3.DatabaseError(f"Execution failed on sql '{sql_query}': {e}")
+    if pandas_min_rows and len(rows) >= pandas_min_rows:
+        return rows_to_json_pandas(columns, rows)
+    return rows_to_json(columns, rows)
+
+
+def query_to_json_pandas(conn: sqlite3.Connection, sql_query: str) -> str:
+    """Runs a query and encodes its results with pandas, as done originally."""
+    import pandas as pd
+
+    return pd.read_sql(sql_query, conn).to_json(orient="records")
@@ -0,0 +1,416 @@
+"""Generates synthetic order_data datasets and query workloads, for capacity planning.
+
+The datasets have the schema of the order_data table (see query_order_data.json),
+at any scale, with realistic distributions:
+- each row holds the orders of one product type on one day, on one sales channel
+  at large scales, so that the table can grow past the number of days x product types,
+- rows are spread over the days with a yearly growth, a seasonality peaking in
+  November and December and a weekly cycle, and appended in date order,
+- the popularity of the product types follows a Zipf law, their price a lognormal law,
+- the counts are binomial draws among the orders, e.g. returns depend on the category.
+
+The workloads are aggregations grouped by date and category columns, the queries
+the assistant is told to write. Requires numpy, installed along with pandas."""
+
+import sqlite3
+import logging
+import datetime
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+# the columns of order_data and their declared types, in order
+COLUMNS = [
+    ("Number_of_Orders", "INTEGER"),
+    ("Sum_of_Order_Value_USD", "REAL"),
+    ("Sum_of_Number_of_Items", "REAL"),
+    ("Number_of_Orders_with_Discount", "INTEGER"),
+    ("Sum_of_Discount_Percentage", "REAL"),
+    ("Sum_of_Shipping_Cost_USD", "REAL"),
+    ("Number_of_Orders_Returned", "INTEGER"),
+    ("Number_of_Orders_Cancelled", "INTEGER"),
+    ("Sum_of_Time_to_Fulfillment", "REAL"),
+    ("Number_of_Orders_Repeat_Customers", "INTEGER"),
+    ("Year", "INTEGER"),
+    ("Month", "INTEGER"),
+    ("Day", "INTEGER"),
+    ("Date", "TIMESTAMP"),
+    ("Day_of_Week", "INTEGER"),
+    ("main_category", "TEXT"),
+    ("sub_category", "TEXT"),
+    ("product_type", "TEXT"),
+]
+
+# main category: (return rate, median price in USD, {sub category: [product types]})
+CATEGORIES: Dict[str, tuple] = {
+    "Electronics": (
+        0.08,
+        180.0,
+        {
+            "Phones": ["Smartphones", "Cases", "Chargers"],
+            "Computers": ["Laptops", "Monitors", "Keyboards", "Mice"],
+            "Audio": ["Headphones", "Speakers", "Earbuds"],
+        },
+    ),
+    "Clothing": (
+        0.15,
+        45.0,
+        {
+            "Women": ["Dresses", "Tops", "Jeans", "Shoes"],
+            "Men": ["Shirts", "Trousers", "Jackets", "Shoes"],
+            "Kids": ["T-Shirts", "Pajamas", "Shoes"],
+        },
+    ),
+    "Home & Garden": (
+        0.06,
+        60.0,
+        {
+            "Kitchen": ["Cookware", "Cutlery", "Small Appliances"],
+            "Furniture": ["Chairs", "Tables", "Shelves"],
+            "Garden": ["Tools", "Plants", "Grills"],
+        },
+    ),
+    "Sports": (
+        0.07,
+        55.0,
+        {
+            "Fitness": ["Yoga Mats", "Weights", "Resistance Bands"],
+            "Outdoor": ["Tents", "Backpacks", "Bikes"],
+        },
+    ),
+    "Toys": (
+        0.04,
+        30.0,
+        {
+            "Games": ["Board Games", "Puzzles", "Card Games"],
+            "Building": ["Blocks", "Models"],
+            "Dolls": ["Dolls", "Action Figures"],
+        },
+    ),
+    "Books": (
+        0.02,
+        18.0,
+        {
+            "Fiction": ["Novels", "Comics"],
+            "Non-Fiction": ["Biographies", "Cookbooks", "Travel Guides"],
+            "Education": ["Textbooks", "Picture Books"],
+        },
+    ),
+    "Beauty": (
+        0.03,
+        25.0,
+        {
+            "Skincare": ["Moisturizers", "Cleansers", "Sunscreens"],
+            "Makeup": ["Lipsticks", "Foundations"],
+        },
+    ),
+    "Grocery": (
+        0.01,
+        35.0,
+        {
+            "Beverages": ["Coffee", "Tea", "Juices"],
+            "Snacks": ["Chips", "Chocolate", "Nuts"],
+        },
+    ),
+}
+
+# relative volume of orders by month, peaking with the holiday season
+MONTH_SEASONALITY = [0.8, 0.75, 0.85, 0.9, 0.95, 0.95, 0.9, 0.95, 0.95, 1.05, 1.4, 1.6]
+# relative volume of orders by day of week, Monday is 0
+WEEKDAY_SEASONALITY = [0.95, 0.9, 0.9, 0.95, 1.05, 1.15, 1.1]
+
+
+def get_product_types(seed: int = 0) -> List[dict]:
+    """Gets the product types with their category, popularity, price and return rate.
+
+    The popularity of the product types follows a Zipf law, in a random order
+    set by the seed, and their median price is drawn around the one of their category.
+    """
+    rng = np.random.default_rng(seed)
+    product_types = []
+    for main_category, (return_rate, price, sub_categories) in CATEGORIES.items():
+        for sub_category, names in sub_categories.items():
+            for product_type in names:
+                product_types.append(
+                    {
+                        "main_category": main_category,
+                        "sub_category": sub_category,
+                        "product_type": product_type,
+                        "price": price * rng.lognormal(0.0, 0.5),
+                        "return_rate": return_rate,
+                    }
+                )
+    ranks = rng.permutation(len(product_types)) + 1
+    weights = 1.0 / ranks**1.1
+    for product, weight in zip(product_types, weights / weights.sum()):
+        product["popularity"] = weight
+    return product_types
+
+
+def get_days(start_year: int, years: int) -> List[datetime.date]:
+    """Gets the days of the dataset."""
+    start = datetime.date(start_year, 1, 1)
+    end = datetime.date(start_year + years, 1, 1)
+    return [start + datetime.timedelta(days) for days in range((end - start).days)]
+
+
+def get_day_weights(days: List[datetime.date], growth: float = 0.15) -> np.ndarray:
+    """Gets the relative volume of orders of each day, normalized to a mean of 1."""
+    start_year = days[0].year
+    weights = np.array(
+        [
+            (1 + growth) ** (day.year - start_year)
+            * MONTH_SEASONALITY[day.month - 1]
+            * WEEKDAY_SEASONALITY[day.weekday()]
+            for day in days
+        ]
+    )
+    return weights / weights.mean()
+
+
+def generate_rows(
+    n_rows: int,
+    start_year: int = 2019,
+    years: int = 5,
+    seed: int = 0,
+    chunk_size: int = 1_000_000,
+    orders_per_row: float = 20.0,
+) -> Iterator[List[tuple]]:
+    """Generates the rows of a synthetic order_data table, in date order.
+
+    Args:
+        n_rows (int): The number of rows to generate.
+        start_year (int): The year of the first day of the dataset.
+        years (int): The number of years covered by the dataset.
+        seed (int): The seed of the random generator, the same seed gives the same rows.
+        chunk_size (int): The approximate number of rows generated at a time.
+        orders_per_row (float): The average number of orders of a row on an average day.
+
+    Yields:
+        list: The next rows, as tuples of values in the order of COLUMNS.
+    """
+    rng = np.random.default_rng(seed)
+    products = get_product_types(seed)
+    days = get_days(start_year, years)
+    day_weights = get_day_weights(days)
+
+    popularity = np.array([product["popularity"] for product in products])
+    prices = np.array([product["price"] for product in products])
+    return_rates = np.array([product["return_rate"] for product in products])
+    # popular product types get more rows, and to a lesser extent bigger ones
+    row_scale = np.sqrt(popularity / popularity.mean())
+    categories = [
+        (product["main_category"], product["sub_category"], product["product_type"])
+        for product in products
+    ]
+    dates = [
+        (day.year, day.month, day.day, day.isoformat(), day.weekday()) for day in days
+    ]
+    black_friday = np.array(
+        [day.month == 11 and 23 <= day.day <= 29 and day.weekday() == 4 for day in days]
+    )
+
+    rows_per_day = rng.multinomial(n_rows, day_weights / day_weights.sum())
+    ends = np.cumsum(rows_per_day)
+    first_day = 0
+    while first_day < len(days):
+        # the days of the chunk: at least one, and about chunk_size rows
+        offset = ends[first_day - 1] if first_day else 0
+        last_day = max(
+            int(np.searchsorted(ends, offset + chunk_size, side="right")), first_day + 1
+        )
+        last_day = min(last_day, len(days))
+        day = np.repeat(
+            np.arange(first_day, last_day), rows_per_day[first_day:last_day]
+        )
+        first_day = last_day
+        size = len(day)
+        if not size:
+            continue
+
+        product = rng.choice(len(products), size=size, p=popularity)
+        order = np.lexsort((product, day))
+        day, product = day[order], product[order]
+
+        mean_orders = orders_per_row * day_weights[day] * row_scale[product]
+        orders = 1 + rng.poisson(np.maximum(mean_orders - 1, 0.1))
+        value = orders * prices[product] * rng.lognormal(0.0, 0.25, size)
+        items = orders * rng.uniform(1.0, 3.5, size)
+        discount_rate = np.where(black_friday[day], 0.6, 0.2)
+        discounted = rng.binomial(orders, discount_rate)
+        discount = discounted * rng.uniform(5.0, 30.0, size)
+        shipping = orders * rng.gamma(2.0, 3.0, size)
+        returned = rng.binomial(orders, return_rates[product])
+        cancelled = rng.binomial(orders, 0.02)
+        fulfillment = orders * rng.gamma(2.0, 1.5, size)
+        repeat_customers = rng.binomial(orders, 0.35)
+
+        measures = [
+            orders.tolist(),
+            np.round(value, 2).tolist(),
+            items.tolist(),
+            discounted.tolist(),
+            discount.tolist(),
+            np.round(shipping, 2).tolist(),
+            returned.tolist(),
+            cancelled.tolist(),
+            fulfillment.tolist(),
+            repeat_customers.tolist(),
+        ]
+        yield [
+            (*values, *dates[d], *categories[p])
+            for (*values, d, p) in zip(*measures, day.tolist(), product.tolist())
+        ]
+
+
+def create_order_data(
+    db_path: str,
+    n_rows: int,
+    table: str = "order_data",
+    start_year: int = 2019,
+    years: int = 5,
+    seed: int = 0,
+    chunk_size: int = 1_000_000,
+) -> int:
+    """Creates a table of synthetic order data in a SQLite database.
+
+    The database is written without a journal, a failure leaves it unusable.
+
+    Raises:
+        ValueError: If the table already exists.
+
+    Returns:
+        int: The number of rows created.
+    """
+    conn = sqlite3.connect(db_path)
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    if exists:
+        conn.close()
+        raise ValueError(f"Table {table} already exists in {db_path}")
+
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    definitions = ", ".join(f"{name} {column_type}" for name, column_type in COLUMNS)
+    conn.execute(f'CREATE TABLE "{table}" ({definitions})')
+    placeholders = ", ".join("?" for _ in COLUMNS)
+
+    total_rows = 0
+    for rows in generate_rows(n_rows, start_year, years, seed, chunk_size):
+        conn.executemany(f'INSERT INTO "{table}" VALUES ({placeholders})', rows)
+        conn.commit()
+        total_rows += len(rows)
+        logging.info(f"Generated {total_rows}/{n_rows} rows in {db_path}")
+    conn.close()
+    return total_rows
+
+
+# templates of the workload, with their relative frequency
+QUERY_TEMPLATES = [
+    (
+        5,
+        "SELECT AVG(Sum_of_Order_Value_USD) AS Avg_Sales FROM order_data"
+        " WHERE Year = {year} AND Month = {month}",
+    ),
+    (
+        4,
+        "SELECT Month, SUM(Sum_of_Order_Value_USD) AS Total_Sales FROM order_data"
+        " WHERE Year = {year} GROUP BY Month ORDER BY Total_Sales DESC",
+    ),
+    (
+        4,
+        "SELECT main_category, SUM(Number_of_Orders) AS Orders FROM order_data"
+        " WHERE Year = {year} GROUP BY main_category ORDER BY Orders DESC",
+    ),
+    (
+        3,
+        "SELECT Year, Month, SUM(Sum_of_Order_Value_USD) AS Sales,"
+        " SUM(Number_of_Orders) AS Orders FROM order_data"
+        " WHERE main_category = '{main_category}' GROUP BY Year, Month ORDER BY Year, Month",
+    ),
+    (
+        3,
+        "SELECT product_type, SUM(Sum_of_Order_Value_USD) AS Sales FROM order_data"
+        " WHERE main_category = '{main_category}' AND Date BETWEEN '{start_date}' AND '{end_date}'"
+        " GROUP BY product_type ORDER BY Sales DESC LIMIT 10",
+    ),
+    (
+        2,
+        "SELECT main_category, sub_category,"
+        " SUM(Number_of_Orders_Returned) * 1.0 / SUM(Number_of_Orders) AS Return_Rate"
+        " FROM order_data WHERE Year = {year} GROUP BY main_category, sub_category"
+        " ORDER BY Return_Rate DESC",
+    ),
+    (
+        2,
+        "SELECT Year, SUM(Sum_of_Discount_Percentage) / SUM(Number_of_Orders_with_Discount)"
+        " AS Avg_Discount FROM order_data GROUP BY Year ORDER BY Year",
+    ),
+    (
+        2,
+        "SELECT Day_of_Week, AVG(Number_of_Orders) AS Avg_Orders FROM order_data"
+        " GROUP BY Day_of_Week ORDER BY Day_of_Week",
+    ),
+    (
+        2,
+        "SELECT Date, SUM(Sum_of_Order_Value_USD) AS Sales FROM order_data"
+        " WHERE Year = {year} AND Month = {month} GROUP BY Date ORDER BY Date",
+    ),
+    (
+        1,
+        "SELECT Year, Month, SUM(Sum_of_Time_to_Fulfillment) / SUM(Number_of_Orders)"
+        " AS Avg_Fulfillment_Time, SUM(Sum_of_Shipping_Cost_USD) AS Shipping_Cost"
+        " FROM order_data WHERE sub_category = '{sub_category}'"
+        " GROUP BY Year, Month ORDER BY Year, Month",
+    ),
+    (
+        1,
+        "SELECT Year, SUM(Number_of_Orders_Repeat_Customers) * 1.0 / SUM(Number_of_Orders)"
+        " AS Repeat_Rate, SUM(Number_of_Orders_Cancelled) AS Cancelled FROM order_data"
+        " GROUP BY Year ORDER BY Year",
+    ),
+]
+
+
+def get_query_mix(
+    n_queries: int,
+    start_year: int = 2019,
+    years: int = 5,
+    seed: int = 0,
+    templates: Optional[list] = None,
+) -> List[str]:
+    """Gets a representative mix of the queries written by the assistant.
+
+    Args:
+        n_queries (int): The number of queries.
+        start_year (int): The first year of the dataset queried.
+        years (int): The number of years of the dataset queried.
+        seed (int): The seed of the random generator.
+        templates (list): The (weight, template) of the queries, QUERY_TEMPLATES by default.
+
+    Returns:
+        list: The queries, with their parameters drawn at random.
+    """
+    rng = np.random.default_rng(seed)
+    templates = templates or QUERY_TEMPLATES
+    weights = np.array([weight for weight, _ in templates], dtype=float)
+    main_categories = list(CATEGORIES)
+    sub_categories = sorted({sub for _, _, subs in CATEGORIES.values() for sub in subs})
+
+    queries = []
+    for index in rng.choice(len(templates), size=n_queries, p=weights / weights.sum()):
+        start_date = datetime.date(
+            start_year + int(rng.integers(years)), int(rng.integers(1, 13)), 1
+        )
+        end_date = start_date + datetime.timedelta(int(rng.integers(7, 92)))
+        parameters = {
+            "year": start_year + int(rng.integers(years)),
+            "month": int(rng.integers(1, 13)),
+            "main_category": main_categories[int(rng.integers(len(main_categories)))],
+            "sub_category": sub_categories[int(rng.integers(len(sub_categories)))],
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat(),
+        }
+        queries.append(templates[index][1].format(**parameters))
+    return queries
@@ -1,28 +1,60 @@
-"""This module contains an extension to query a local SQLite database for our demo."""
+"""This module contains an extension to query a local SQLite database (or its Parquet export) for our demo."""
 
 import os
+import time
 from promptflow.tracing import trace
 
-import sqlite3
-import pandas as pd
 import asyncio
 
-_DB_CONN = sqlite3.connect(
-    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "order_data.db"),
-    check_same_thread=False,
+from .order_data.config import OrderDataConfiguration
+from .order_data.cache import QueryResultCache
+from .order_data.engines import create_engine
+from .order_data.executor import QueryExecutor
+from .order_data.query_log import QueryLog
+
+_CONFIG = OrderDataConfiguration.from_env()
+
+_ENGINE = create_engine(_CONFIG)
+
+_RESULT_CACHE = QueryResultCache(
+    max_entries=_CONFIG.CACHE_MAX_ENTRIES,
+    max_bytes=_CONFIG.CACHE_MAX_BYTES,
+    ttl=_CONFIG.CACHE_TTL,
+)
+
+_QUERY_LOG = QueryLog(_CONFIG.QUERY_LOG_PATH)
+
+# queries block, they run on threads so that the event loop keeps serving
+_EXECUTOR = QueryExecutor(
+    max_workers=_CONFIG.MAX_CONCURRENT_QUERIES,
+    max_queued=_CONFIG.MAX_QUEUED_QUERIES,
 )
 
 
 @trace
 async def query_order_data(sql_query: str) -> str:
     """Run a SQL query against table `order_data` and return the results in JSON format."""
-    global _DB_CONN
+    start_time = time.perf_counter()
+    db_version = _ENGINE.get_version()
+    result = _RESULT_CACHE.get(sql_query, db_version)
+    if result is not None:
+        _QUERY_LOG.record(sql_query, time.perf_counter() - start_time, cached=True)
+        return result
+
     try:
-        df = pd.read_sql(sql_query, _DB_CONN)
+        result = await _EXECUTOR.run(_ENGINE.query_to_json, sql_query, db_version)
     except Exception as e:
+        _QUERY_LOG.record(sql_query, time.perf_counter() - start_time, error=str(e))
         return f"Error: {e}"
 
-    return df.to_json(orient="records")
+    _QUERY_LOG.record(sql_query, time.perf_counter() - start_time)
+    _RESULT_CACHE.put(sql_query, db_version, result)
+    return result
+
+
+def get_query_stats() -> dict:
+    """Gets the metrics of the queue of queries and of the result cache."""
+    return {"executor": _EXECUTOR.get_stats(), "cache": _RESULT_CACHE.get_stats()}
 
 
 async def main():
@@ -0,0 +1,248 @@
+"""Mirrors the messages of the threads locally, to send only what they don't have yet.
+
+The client sends the whole conversation with each turn (chat_history), while the thread
+of the session already holds all of it but the new message. Each turn, the conversation
+as the client sees it (its messages, then the reply) is recorded in a SQLite database,
+one row per message with a hash of its content, so that the next turn can tell which
+messages of its history are already on the thread and add only the others to the run.
+
+Rows also hold a hash of the conversation up to each message, so that a client which
+lost its session_id but sends the same history finds its thread back, rather than
+having the whole history posted to a new thread. A thread is only found back by a
+history covering all of it, up to a reply. As the same history can be sent by different
+clients, finding threads back is opt-in (see SessionManager.find_session).
+
+The database can be shared by the worker processes of a host (WAL journal). Threads
+not updated for max_age seconds are forgotten when it's opened."""
+
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS thread_messages (
+    session_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    chain_hash TEXT NOT NULL,
+    message_id TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (session_id, position)
+);
+CREATE INDEX IF NOT EXISTS thread_messages_chain_hash
+    ON thread_messages (chain_hash);
+"""
+
+
+def get_content_hasher(role: str):
+    """Gets a hash object for the content of a message of a role,
+    to be updated with the content encoded in UTF-8."""
+    return hashlib.sha1(role.encode("utf-8") + b"\n")
+
+
+def get_content_hash(message: dict) -> str:
+    """Gets a hash of the role and content of a message,
+    unless given in its content_hash (see get_content_hasher)."""
+    if "content_hash" in message:
+        return message["content_hash"]
+    content = message["content"]
+    if not isinstance(content, str):
+        content = json.dumps(content, default=str)
+    hasher = get_content_hasher(message["role"])
+    hasher.update(content.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def get_chain_hashes(messages: List[dict]) -> List[str]:
+    """Gets a hash of the conversation up to each message."""
+    chain_hashes = []
+    chain_hash = ""
+    for message in messages:
+        chain_hash = hashlib.sha1(
+            (chain_hash + get_content_hash(message)).encode("ascii")
+        ).hexdigest()
+        chain_hashes.append(chain_hash)
+    return chain_hashes
+
+
+def get_conversation_key(messages: List[dict]) -> Optional[str]:
+    """Gets a hash of a whole conversation, None if it's empty."""
+    chain_hashes = get_chain_hashes(messages)
+    return chain_hashes[-1] if chain_hashes else None
+
+
+class ThreadMirror:
+    """Keeps the hashes of the messages of each thread in a SQLite database."""
+
+    def __init__(self, path: str, max_age: float = 30 * 24 * 3600):
+        """Initializes a new mirror.
+
+        Args:
+            path (str): The path of the SQLite database, an empty path disables the mirror.
+            max_age (float): Time after which a thread not updated is forgotten,
+                in seconds, 0 to keep them all.
+        """
+        self.path = path
+        self.max_age = max_age
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Opens the database on first use, creating its table if needed."""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            if self.max_age:
+                with conn:
+                    conn.execute(
+                        "DELETE FROM thread_messages WHERE session_id IN"
+                        " (SELECT session_id FROM thread_messages GROUP BY session_id"
+                        " HAVING MAX(updated_at) < ?)",
+                        (time.time() - self.max_age,),
+                    )
+            self._conn = conn
+        return self._conn
+
+    def get_hashes(self, session_id: str) -> List[str]:
+        """Gets the content hashes of the messages mirrored for a thread, in order."""
+        if not self.path or not session_id:
+            return []
+        try:
+            with self._lock:
+                rows = (
+                    self._connect()
+                    .execute(
+                        "SELECT content_hash FROM thread_messages"
+                        " WHERE session_id = ? ORDER BY position",
+                        (session_id,),
+                    )
+                    .fetchall()
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"Could not read thread mirror {self.path}: {e}")
+            return []
+        return [row[0] for row in rows]
+
+    def find_session(self, messages: List[dict]) -> Tuple[Optional[str], int]:
+        """Finds the thread holding the longest part of a conversation, from its start.
+
+        Returns:
+            tuple: The id of the thread, None if there's none, and the number of
+                messages of the conversation it holds. The thread holds nothing else,
+                and its last message is a reply.
+        """
+        if not self.path or not messages:
+            return None, 0
+        chain_hashes = get_chain_hashes(messages)
+        try:
+            with self._lock:
+                row = (
+                    self._connect()
+                    .execute(
+                        f"SELECT session_id, chain_hash FROM thread_messages AS t"
+                        f" WHERE chain_hash IN ({', '.join('?' * len(chain_hashes))})"
+                        " AND role = 'assistant'"
+                        " AND position = (SELECT MAX(position) FROM thread_messages"
+                        " WHERE session_id = t.session_id)"
+                        " ORDER BY position DESC, updated_at DESC LIMIT 1",
+                        chain_hashes,
+                    )
+                    .fetchone()
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"Could not read thread mirror {self.path}: {e}")
+            return None, 0
+        if row is None:
+            return None, 0
+        session_id, chain_hash = row
+        return session_id, chain_hashes.index(chain_hash) + 1
+
+    def record(
+        self, session_id: str, messages: List[dict], message_id: Optional[str] = None
+    ):
+        """Records the messages of a thread as the client sees them, replacing the
+        mirrored messages from the first one that differs.
+
+        Args:
+            session_id (str): The id of the thread.
+            messages (List[dict]): The messages of the conversation, from its start.
+            message_id (str): The id of the last message on the thread, if known.
+        """
+        if not self.path or not session_id:
+            return
+        content_hashes = [get_content_hash(message) for message in messages]
+        chain_hashes = get_chain_hashes(messages)
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    mirrored = [
+                        row[0]
+                        for row in conn.execute(
+                            "SELECT content_hash FROM thread_messages"
+                            " WHERE session_id = ? ORDER BY position",
+                            (session_id,),
+                        )
+                    ]
+                    start = get_common_length(mirrored, content_hashes)
+                    conn.execute(
+                        "DELETE FROM thread_messages WHERE session_id = ? AND position >= ?",
+                        (session_id, start),
+                    )
+                    conn.executemany(
+                        "INSERT INTO thread_messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [
+                            (
+                                session_id,
+                                position,
+                                messages[position]["role"],
+                                content_hashes[position],
+                                chain_hashes[position],
+                                message_id if position == len(messages) - 1 else None,
+                                now,
+                            )
+                            for position in range(start, len(messages))
+                        ],
+                    )
+        except sqlite3.Error as e:
+            logging.warning(f"Could not write to thread mirror {self.path}: {e}")
+
+    def clear(self, session_id: str):
+        """Forgets the messages of a thread."""
+        if not self.path or not session_id:
+            return
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    conn.execute(
+                        "DELETE FROM thread_messages WHERE session_id = ?",
+                        (session_id,),
+                    )
+        except sqlite3.Error as e:
+            logging.warning(f"Could not write to thread mirror {self.path}: {e}")
+
+    def close(self):
+        """Closes the database."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def get_common_length(hashes: List[str], other_hashes: List[str]) -> int:
+    """Gets the number of leading hashes two lists have in common."""
+    length = 0
+    for content_hash, other_hash in zip(hashes, other_hashes):
+        if content_hash != other_hash:
+            break
+        length += 1
+    return length
@@ -1,12 +1,23 @@
 import time
+import asyncio
 import logging
 import json
 import base64
+import httpx
+import hashlib
+import traceback
+import contextvars
+import openai
+from concurrent.futures import ThreadPoolExecutor
+from openai.types.beta.assistant import Assistant
+from openai.types.beta.thread import Thread
 
 from promptflow.tracing import trace
 
 # local imports
 from agent_arch.config import Configuration
+from agent_arch.assistants import get_assistant_cache
+from agent_arch.sync import RunDeltaSync, AsyncRunDeltaSync
 from agent_arch.messages import (
     TextResponse,
     ImageResponse,
@@ -15,8 +26,35 @@ from agent_arch.messages import (
     StepNotification,
 )
 
+# statuses of a run that won't change anymore
+FINAL_RUN_STATUSES = ("completed", "cancelled", "failed", "expired", "incomplete")
+# a read of the run stream that outlasts its timeout (the time left to the turn)
+STREAM_TIMEOUT_ERRORS = (openai.APITimeoutError, httpx.TimeoutException)
+
+
+def get_message_key(message: dict) -> str:
+    """Gets a fingerprint of a message, to recognize it when it's sent again."""
+    return hashlib.sha1(
+        json.dumps(message, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+async def aiter_until(stream, deadline: float):
+    """Iterates over an async stream, raising asyncio.TimeoutError
+    if waiting for its next event would outlast the deadline."""
+    events = stream.__aiter__()
+    while True:
+        try:
+            yield await asyncio.wait_for(
+                events.__anext__(), max(deadline - time.time(), 0)
+            )
+        except StopAsyncIteration:
+            return
+
 
 class Orchestrator:
+    delta_sync_class = RunDeltaSync
+
     def __init__(self, config: Configuration, client, session, extensions):
         self.client = client
         self.config = config
@@ -24,68 +62,419 @@ class Orchestrator:
         self.extensions = extensions
 
         # getting the Assistant API specific constructs
-        logging.info(
-            f"Retrieving assistant with id: {config.AZURE_OPENAI_ASSISTANT_ID}"
-        )
-        self.assistant = self.client.beta.assistants.retrieve(
-            self.config.AZURE_OPENAI_ASSISTANT_ID
-        )
-        self.thread = self.session.thread
+        # runs only need the assistant id, its definition is retrieved on demand
+        self.assistant_id = self.config.AZURE_OPENAI_ASSISTANT_ID
 
         logging.info(f"Orchestrator initialized with session_id: {session.id}")
 
         self.run = None
-        self.last_step_id = None
-        self.last_message_id = None
+
+        # cursors of the steps and messages already processed
+        self.sync = self.delta_sync_class(self.client, self.session.id)
+
+        # number of calls to the API made by the orchestrator itself
+        self.api_calls = 0
+
+        # messages for which the text has already been sent as deltas
+        self.streamed_message_ids = set()
+
+        # the last message added to the thread by the run, see leave_run
+        self.run_message_key = None
+
+    @property
+    def last_step_id(self):
+        return self.sync.last_step_id
+
+    @last_step_id.setter
+    def last_step_id(self, value):
+        self.sync.last_step_id = value
+
+    @property
+    def last_message_id(self):
+        return self.sync.last_message_id
+
+    @last_message_id.setter
+    def last_message_id(self, value):
+        self.sync.last_message_id = value
+
+    def count_api_calls(self) -> int:
+        """Gets the number of API calls spent on the run so far."""
+        return self.api_calls + self.sync.api_calls
+
+    def get_assistant(self) -> Assistant:
+        """Gets the definition of the assistant, from the process-wide cache."""
+        return get_assistant_cache().get(self.client, self.assistant_id)
 
     @trace
     def run_loop(self):
+        """Runs the assistant on the thread until the run reaches a final status.
+
+        Consumes the run event stream when ORCHESTRATOR_STREAMING is enabled,
+        and falls back to polling if the stream could not be started.
+
+        A run the previous turn left running is resumed or cancelled first."""
+        try:
+            pending_run, resume = self.take_pending_run()
+            if pending_run is not None:
+                if resume:
+                    if not self.resume_run(pending_run):
+                        return
+                else:
+                    self.cancel_run(pending_run)
+                if not self.session.pending_messages:
+                    return self.completed()
+
+            if self.config.ORCHESTRATOR_STREAMING:
+                try:
+                    return self.run_stream()
+                except openai.APIStatusError as e:
+                    if self.run is not None:
+                        raise
+                    logging.warning(
+                        f"Could not start run streaming ({e}), falling back to polling."
+                    )
+            return self.run_polling()
+        finally:
+            logging.info(f"Run used {self.count_api_calls()} API calls")
+
+    def run_started(self, run):
+        """Records the run once created, with the thread if it was created along."""
+        self.run = run
+        if self.session.thread is None:
+            self.session.set_thread(
+                Thread(
+                    id=run.thread_id,
+                    created_at=run.created_at,
+                    metadata=None,
+                    object="thread",
+                )
+            )
+        self.sync.thread_id = self.session.id
+        # the pending messages have been added to the thread by the run
+        messages = self.session.pop_pending_messages()
+        if messages:
+            self.run_message_key = get_message_key(messages[-1])
+
+    def leave_run(self, reason: str = None):
+        """Leaves the run running past the max waiting time, with a handle
+        in the session for the next turn to resume or cancel it (see take_pending_run):
+        the run, the cursors of what was already sent, and the messages not sent yet.
+
+        Args:
+            reason (str): Why the run is left running, logged.
+        """
+        if self.run is None:
+            return
+        reason = (
+            reason
+            or f"exceeded max_waiting_time={self.config.ORCHESTRATOR_MAX_WAITING_TIME}"
+        )
+        logging.warning(f"Run {self.run.id} {reason}, leaving it running")
+        self.session.pending_run = {
+            "run_id": self.run.id,
+            "last_step_id": self.last_step_id,
+            "last_message_id": self.last_message_id,
+            "message_key": self.run_message_key,
+            "conversation_key": self.session.conversation_key,
+            "pending_messages": self.session.pending_messages,
+        }
+
+    def take_pending_run(self) -> tuple:
+        """Takes the handle of the run the previous turn left running, if any.
+
+        The messages the handle held back are recorded again, before the ones
+        of this turn. If this turn is a retry of the one that left the run running,
+        sending the same conversation, its messages repeating them are dropped.
+
+        Returns:
+            tuple: The handle, None if there's none, and whether to resume the run
+                rather than cancel it. A retry always resumes it, otherwise it
+                depends on ORCHESTRATOR_PENDING_RUN_POLICY.
+        """
+        pending_run, self.session.pending_run = self.session.pending_run, None
+        if not pending_run:
+            return None, False
+
+        held_messages = pending_run.get("pending_messages") or []
+        new_messages = self.session.pending_messages
+        conversation_key = pending_run.get("conversation_key")
+        if conversation_key and conversation_key == self.session.conversation_key:
+            known_keys = {pending_run.get("message_key")}
+            known_keys.update(get_message_key(message) for message in held_messages)
+            new_messages = [
+                message
+                for message in new_messages
+                if get_message_key(message) not in known_keys
+            ]
+        self.session.pending_messages = held_messages + new_messages
+
+        resume = (
+            not new_messages or self.config.ORCHESTRATOR_PENDING_RUN_POLICY != "cancel"
+        )
+        return pending_run, resume
+
+    def restore_run(self, pending_run: dict):
+        """Restores the cursors of a run from the handle left by leave_run."""
+        self.last_step_id = pending_run.get("last_step_id")
+        self.last_message_id = pending_run.get("last_message_id")
+        self.run_message_key = pending_run.get("message_key")
+        self.sync.thread_id = self.session.id
+
+    def is_resumable(self) -> bool:
+        """Checks that the run to resume can still produce something."""
+        if self.run.status in FINAL_RUN_STATUSES and self.run.status != "completed":
+            logging.warning(f"Run to resume {self.run.id} ended as {self.run.status}")
+            return False
+        return True
+
+    @trace
+    def resume_run(self, pending_run: dict) -> bool:
+        """Resumes a run left running by the previous turn, sending what it produced since.
+
+        Returns:
+            bool: True if the run ended, False if it was left running again.
+        """
+        logging.info(f"Resuming run {pending_run['run_id']}")
+        self.restore_run(pending_run)
+        self.run = self.client.beta.threads.runs.retrieve(
+            thread_id=self.session.id, run_id=pending_run["run_id"]
+        )
+        self.api_calls += 1
+        return not self.is_resumable() or self.poll_run()
+
+    @trace
+    def cancel_run(self, pending_run: dict):
+        """Cancels a run left running by the previous turn, and waits for it to end
+        so that a new run can start on the thread."""
+        logging.info(f"Cancelling run {pending_run['run_id']}")
+        self.api_calls += 1
+        try:
+            run = self.client.beta.threads.runs.cancel(
+                thread_id=self.session.id, run_id=pending_run["run_id"]
+            )
+        except openai.APIStatusError as e:
+            # the run has already ended
+            logging.info(f"Run {pending_run['run_id']} not cancelled: {e}")
+            return
+
+        start_time = time.time()
+        while (
+            run.status not in FINAL_RUN_STATUSES
+            and (time.time() - start_time) < self.config.ORCHESTRATOR_MAX_WAITING_TIME
+        ):
+            time.sleep(0.25)
+            run = self.client.beta.threads.runs.retrieve(
+                thread_id=self.session.id, run_id=run.id
+            )
+            self.api_calls += 1
+        logging.info(f"Run {run.id} status: {run.status}")
+
+    def submit_tool_outputs(self, tool_call_outputs):
+        """Submits the tool outputs of the run, without streaming what follows."""
+        self.log_tool_outputs(tool_call_outputs)
+        self.client.beta.threads.runs.submit_tool_outputs(
+            thread_id=self.session.id,
+            run_id=self.run.id,
+            tool_outputs=tool_call_outputs,
+        )
+        self.api_calls += 1
+
+    def get_run_kwargs(self) -> dict:
+        """Gets the arguments to start a run on the session in a single call.
+
+        For a new session, the thread is created with the run and the recorded messages,
+        otherwise the recorded messages are added to the thread by the run."""
+        if self.session.thread is None:
+            return dict(
+                assistant_id=self.assistant_id,
+                thread={"messages": self.session.pending_messages},
+            )
+        return dict(
+            thread_id=self.session.id,
+            assistant_id=self.assistant_id,
+            additional_messages=self.session.pending_messages or openai.NOT_GIVEN,
+        )
+
+    @trace
+    def start_run(self):
+        """Starts a run on the session in a single call."""
         logging.info(f"Creating the run")
-        self.run = self.client.beta.threads.runs.create(
-            thread_id=self.thread.id, assistant_id=self.assistant.id
+        if self.session.thread is None:
+            run = self.client.beta.threads.create_and_run(**self.get_run_kwargs())
+        else:
+            run = self.client.beta.threads.runs.create(**self.get_run_kwargs())
+        self.api_calls += 1
+        self.run_started(run)
+
+    def get_stream_timeout(self, deadline: float) -> httpx.Timeout:
+        """Gets the timeout of a stream request, so that waiting for its next event
+        doesn't outlast the max waiting time of the turn.
+
+        Args:
+            deadline (float): The time the turn stops waiting for the run at.
+        """
+        return httpx.Timeout(
+            connect=openai.DEFAULT_TIMEOUT.connect,
+            read=max(deadline - time.time(), 0.1),
+            write=openai.DEFAULT_TIMEOUT.write,
+            pool=openai.DEFAULT_TIMEOUT.pool,
+        )
+
+    def stream_run(self, timeout: httpx.Timeout = openai.NOT_GIVEN):
+        """Gets a stream manager starting a run on the session in a single call."""
+        logging.info(f"Creating the run (streaming)")
+        self.api_calls += 1
+        if self.session.thread is None:
+            return self.client.beta.threads.create_and_run_stream(
+                **self.get_run_kwargs(), timeout=timeout
+            )
+        return self.client.beta.threads.runs.stream(
+            **self.get_run_kwargs(), timeout=timeout
         )
+
+    @trace
+    def run_stream(self):
+        """Drives the run from the Assistants API event stream.
+
+        The read timeout of each stream is the time left to the max waiting time,
+        so a stalled stream is left running like a long one (see poll_run)."""
+        start_time = time.time()
+        deadline = start_time + self.config.ORCHESTRATOR_MAX_WAITING_TIME
+        stream_manager = self.stream_run(timeout=self.get_stream_timeout(deadline))
+
+        # each stream ends when the run completes or requires action,
+        # in the latter case submitting the tool outputs opens a new stream
+        while stream_manager is not None:
+            tool_call_outputs = None
+            stalled = False
+            try:
+                with stream_manager as stream:
+                    for event in stream:
+                        if event.event == "thread.run.requires_action":
+                            self.run = event.data
+                            logging.info(f"Run requires action.")
+                            tool_call_outputs = self.requires_action()
+                        else:
+                            self.process_event(event)
+                        # waits for the reader to catch up with the output sent
+                        self.session.drain()
+
+                        if time.time() >= deadline:
+                            break
+            except STREAM_TIMEOUT_ERRORS as e:
+                if self.run is None:
+                    raise
+                logging.warning(f"Run stream timed out: {e!r}")
+                stalled = True
+
+            if (
+                stalled or time.time() >= deadline
+            ) and self.run.status not in FINAL_RUN_STATUSES:
+                if tool_call_outputs:
+                    # the run can go on without us
+                    self.submit_tool_outputs(tool_call_outputs)
+                return self.leave_run()
+
+            stream_manager = None
+            if tool_call_outputs:
+                self.log_tool_outputs(tool_call_outputs)
+                stream_manager = (
+                    self.client.beta.threads.runs.submit_tool_outputs_stream(
+                        thread_id=self.session.id,
+                        run_id=self.run.id,
+                        tool_outputs=tool_call_outputs,
+                        timeout=self.get_stream_timeout(deadline),
+                    )
+                )
+                self.api_calls += 1
+
+        if self.run.status == "completed":
+            return self.completed()
+
+    def process_event(self, event):
+        """Process an event from the run stream"""
+        if event.event.startswith("thread.run.step."):
+            if event.event == "thread.run.step.completed":
+                logging.info(
+                    "The assistant has moved forward to step {}".format(event.data.id)
+                )
+                self.process_step(event.data)
+                self.last_step_id = event.data.id
+        elif event.event.startswith("thread.message."):
+            if event.event == "thread.message.delta":
+                self.process_message_delta(event.data)
+            elif event.event == "thread.message.completed":
+                self.process_message(event.data)
+                self.last_message_id = event.data.id
+        elif event.event.startswith("thread.run."):
+            if self.run is None:
+                self.run_started(event.data)
+            else:
+                self.run = event.data
+            logging.info(f"Run status: {self.run.status}")
+            if event.event == "thread.run.completed":
+                logging.info(f"Run completed.")
+            elif event.event == "thread.run.cancelled":
+                raise Exception(f"Run was cancelled: {self.run.status}")
+            elif event.event == "thread.run.expired":
+                raise Exception(f"Run expired: {self.run.status}")
+            elif event.event == "thread.run.failed":
+                raise ValueError(
+                    f"Run failed with status: {self.run.status}, last_error: {self.run.last_error}"
+                )
+        elif event.event == "thread.created":
+            self.session.set_thread(event.data)
+        elif event.event == "error":
+            raise ValueError(f"Run stream error: {event.data}")
+
+    @trace
+    def run_polling(self):
+        """Drives the run by polling the Assistants API."""
+        self.start_run()
         logging.info(f"Pre loop run status: {self.run.status}")
+        if self.poll_run():
+            return self.completed()
 
+    def poll_run(self) -> bool:
+        """Polls the run until it completes, or leaves it running past the max waiting time.
+
+        Returns:
+            bool: True if the run completed, False if it was left running.
+        """
         start_time = time.time()
 
         # loop until max_waiting_time is reached
         while (time.time() - start_time) < self.config.ORCHESTRATOR_MAX_WAITING_TIME:
             # checks the run regularly
             self.run = self.client.beta.threads.runs.retrieve(
-                thread_id=self.thread.id, run_id=self.run.id
+                thread_id=self.session.id, run_id=self.run.id
             )
+            self.api_calls += 1
             logging.info(
                 f"Run status: {self.run.status} (time={int(time.time() - start_time)}s, max_waiting_time={self.config.ORCHESTRATOR_MAX_WAITING_TIME})"
             )
 
-            # check if a step has been completed
-            run_steps = self.client.beta.threads.runs.steps.list(
-                thread_id=self.thread.id, run_id=self.run.id, after=self.last_step_id
-            )
-            for step in run_steps:
+            # check if steps have been added since the last poll
+            for step in self.sync.new_steps(self.run.id):
                 logging.info(
                     "The assistant has moved forward to step {}".format(step.id)
                 )
                 self.process_step(step)
-                self.last_step_id = step.id
 
-            # check if there are messages
-            for message in self.client.beta.threads.messages.list(
-                thread_id=self.thread.id, order="asc", after=self.last_message_id
-            ):
-                message = self.client.beta.threads.messages.retrieve(
-                    thread_id=self.thread.id, message_id=message.id
-                )
+            # check if messages have been completed since the last poll
+            for message in self.sync.new_messages(self.run.id):
                 self.process_message(message)
-                # self.session.send(message)
-                self.last_message_id = message.id
+            # waits for the reader to catch up with the output sent
+            self.session.drain()
 
             if self.run.status == "completed":
                 logging.info(f"Run completed.")
-                return self.completed()
+                return True
             elif self.run.status == "requires_action":
                 logging.info(f"Run requires action.")
-                self.requires_action()
+                tool_call_outputs = self.requires_action()
+                if tool_call_outputs:
+                    self.submit_tool_outputs(tool_call_outputs)
             elif self.run.status == "cancelled":
                 raise Exception(f"Run was cancelled: {self.run.status}")
             elif self.run.status == "expired":
@@ -94,17 +483,32 @@ class Orchestrator:
                 raise ValueError(
                     f"Run failed with status: {self.run.status}, last_error: {self.run.last_error}"
                 )
-            elif self.run.status in ["in_progress", "queued"]:
+            elif self.run.status in ["in_progress", "queued", "cancelling"]:
                 time.sleep(0.25)
             else:
                 raise ValueError(f"Unknown run status: {self.run.status}")
 
+        self.leave_run()
+        return False
+
+    def process_message_delta(self, message_delta):
+        """Sends the text of a message delta to the user as soon as it arrives"""
+        for entry in message_delta.delta.content or []:
+            if entry.type == "text" and entry.text and entry.text.value:
+                self.streamed_message_ids.add(message_delta.id)
+                self.session.send(
+                    TextResponse(role="assistant", content=entry.text.value)
+                )
+
     @trace
     def process_message(self, message):
         for entry in message.content:
             if message.role == "user":
                 # this means a message we just added
                 pass
+            elif entry.type == "text" and message.id in self.streamed_message_ids:
+                # the text has already been sent from the message deltas
+                pass
             elif entry.type == "text":
                 self.session.send(
                     TextResponse(role=message.role, content=entry.text.value)
@@ -114,6 +518,7 @@ class Orchestrator:
                 self.session.send(
                     ImageResponse.from_bytes(self.client.files.content(file_id).read())
                 )
+                self.api_calls += 1
             else:
                 logging.critical("Unknown content type: {}".format(entry.type))
 
@@ -122,7 +527,7 @@ class Orchestrator:
         """Process a step from the run"""
         if step.type == "tool_calls":
             for tool_call in step.step_details.tool_calls:
-                if tool_call.type == "code":
+                if tool_call.type == "code_interpreter":
                     self.session.send(
                         StepNotification(
                             type=step.type, content=str(tool_call.model_dump())
@@ -144,58 +549,437 @@ class Orchestrator:
         """What to do when run.status == 'completed'"""
         self.session.close()
 
-    @trace
-    def requires_action(self):
-        """What to do when run.status == 'requires_action'"""
-        # if the run requires us to run a tool
-        tool_call_outputs = []
+    def parse_tool_calls(self):
+        """Decodes the function calls required by the run,
+        and notifies the user about them in order.
+
+        Returns:
+            list: (tool_call, extension_args) tuples, extension_args is None
+            when the arguments could not be decoded.
+        """
+        tool_calls = []
 
         for tool_call in self.run.required_action.submit_tool_outputs.tool_calls:
-            if tool_call.type == "function":
-                # let's keep sync for now
-                logging.info(
-                    f"Calling tool: {tool_call.function.name} with args: {tool_call.function.arguments}"
-                )
-                # decode the arguments from the api
-                try:
-                    extension_args = json.loads(tool_call.function.arguments)
-                except json.JSONDecodeError as e:
-                    logging.critical(f"Error decoding extension arguments: {e}")
-                    continue
+            if tool_call.type != "function":
+                raise ValueError(f"Unsupported tool call type: {tool_call.type}")
 
+            logging.info(
+                f"Calling tool: {tool_call.function.name} with args: {tool_call.function.arguments}"
+            )
+            # decode the arguments from the api
+            try:
+                extension_args = json.loads(tool_call.function.arguments)
+            except json.JSONDecodeError as e:
+                logging.critical(f"Error decoding extension arguments: {e}")
+                extension_args = None
+            else:
                 # send some early message to the user
                 self.session.send(
                     ExtensionCallMessage(
                         name=tool_call.function.name, args=extension_args
                     )
                 )
+            tool_calls.append((tool_call, extension_args))
 
-                # invoke the extension
-                tool_call_output = self.extensions.get_extension(
-                    tool_call.function.name
-                ).invoke(**extension_args)
+        return tool_calls
 
-                # send success to the user
-                self.session.send(
-                    ExtensionReturnMessage(
-                        name=tool_call.function.name, content=tool_call_output
+    def get_tool_call_extension(self, tool_call, extension_args):
+        """Gets the extension to invoke for a tool call.
+
+        Returns:
+            tuple: (extension, error), one of them being None.
+        """
+        if extension_args is None:
+            return None, "Error: the arguments are not valid JSON."
+        extension = self.extensions.get_extension(tool_call.function.name)
+        if extension is None:
+            return None, f"Error: unknown extension `{tool_call.function.name}`."
+        return extension, None
+
+    @trace
+    def invoke_tool_call(self, tool_call, extension_args):
+        """Invokes the extension of a tool call, errors are returned as the output
+        so that one failing call doesn't fail the others."""
+        extension, error = self.get_tool_call_extension(tool_call, extension_args)
+        if error:
+            return error
+        try:
+            return extension.invoke(**extension_args)
+        except Exception as e:
+            logging.critical(
+                f"Error invoking extension {tool_call.function.name}: {traceback.format_exc()}"
+            )
+            return f"Error: {e}"
+
+    def collect_tool_outputs(self, tool_calls, outputs):
+        """Notifies the user about the outputs of the tool calls in order,
+        and formats them for submission."""
+        tool_call_outputs = []
+
+        for (tool_call, _), tool_call_output in zip(tool_calls, outputs):
+            # send success to the user
+            self.session.send(
+                ExtensionReturnMessage(
+                    name=tool_call.function.name, content=tool_call_output
+                )
+            )
+
+            # store the output for the tool
+            tool_call_outputs.append(
+                {
+                    "tool_call_id": tool_call.id,
+                    "output": json.dumps(tool_call_output),
+                }
+            )
+
+        return tool_call_outputs
+
+    def log_tool_outputs(self, tool_call_outputs):
+        """Logs the size of the tool outputs about to be submitted,
+        and their content at debug level only, as they can be large."""
+        logging.info(
+            f"Submitting {len(tool_call_outputs)} tool outputs ("
+            + ", ".join(
+                f"{output['tool_call_id']}: {len(output['output'])} chars"
+                for output in tool_call_outputs
+            )
+            + ")"
+        )
+        logging.debug(f"Submitting tool outputs: {tool_call_outputs}")
+
+    @trace
+    def requires_action(self):
+        """What to do when run.status == 'requires_action'
+
+        The tool calls of the step are invoked concurrently, up to
+        ORCHESTRATOR_MAX_CONCURRENT_TOOL_CALLS at a time.
+
+        Returns:
+            list: the tool outputs to submit for the run.
+        """
+        tool_calls = self.parse_tool_calls()
+
+        if len(tool_calls) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(
+                    len(tool_calls), self.config.ORCHESTRATOR_MAX_CONCURRENT_TOOL_CALLS
+                )
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        self.invoke_tool_call,
+                        tool_call,
+                        extension_args,
+                    )
+                    for tool_call, extension_args in tool_calls
+                ]
+                outputs = [future.result() for future in futures]
+        else:
+            outputs = [
+                self.invoke_tool_call(tool_call, extension_args)
+                for tool_call, extension_args in tool_calls
+            ]
+
+        return self.collect_tool_outputs(tool_calls, outputs)
+
+
+class AsyncOrchestrator(Orchestrator):
+    """Orchestrator running the assistant from an event loop,
+    with an AsyncAzureOpenAI client, an AsyncSession and async extension calls."""
+
+    delta_sync_class = AsyncRunDeltaSync
+
+    async def get_assistant(self) -> Assistant:
+        """Gets the definition of the assistant, from the process-wide cache."""
+        return await get_assistant_cache().aget(self.client, self.assistant_id)
+
+    @trace
+    async def run_loop(self):
+        """Runs the assistant on the thread until the run reaches a final status.
+
+        Consumes the run event stream when ORCHESTRATOR_STREAMING is enabled,
+        and falls back to polling if the stream could not be started.
+
+        A run the previous turn left running is resumed or cancelled first."""
+        try:
+            pending_run, resume = self.take_pending_run()
+            if pending_run is not None:
+                if resume:
+                    if not await self.resume_run(pending_run):
+                        return
+                else:
+                    await self.cancel_run(pending_run)
+                if not self.session.pending_messages:
+                    return self.completed()
+
+            if self.config.ORCHESTRATOR_STREAMING:
+                try:
+                    return await self.run_stream()
+                except openai.APIStatusError as e:
+                    if self.run is not None:
+                        raise
+                    logging.warning(
+                        f"Could not start run streaming ({e}), falling back to polling."
+                    )
+            return await self.run_polling()
+        finally:
+            logging.info(f"Run used {self.count_api_calls()} API calls")
+
+    @trace
+    async def start_run(self):
+        """Starts a run on the session in a single call."""
+        logging.info(f"Creating the run")
+        if self.session.thread is None:
+            run = await self.client.beta.threads.create_and_run(**self.get_run_kwargs())
+        else:
+            run = await self.client.beta.threads.runs.create(**self.get_run_kwargs())
+        self.api_calls += 1
+        self.run_started(run)
+
+    @trace
+    async def resume_run(self, pending_run: dict) -> bool:
+        """Resumes a run left running by the previous turn, sending what it produced since.
+
+        Returns:
+            bool: True if the run ended, False if it was left running again.
+        """
+        logging.info(f"Resuming run {pending_run['run_id']}")
+        self.restore_run(pending_run)
+        self.run = await self.client.beta.threads.runs.retrieve(
+            thread_id=self.session.id, run_id=pending_run["run_id"]
+        )
+        self.api_calls += 1
+        return not self.is_resumable() or await self.poll_run()
+
+    @trace
+    async def cancel_run(self, pending_run: dict):
+        """Cancels a run left running by the previous turn, and waits for it to end
+        so that a new run can start on the thread."""
+        logging.info(f"Cancelling run {pending_run['run_id']}")
+        self.api_calls += 1
+        try:
+            run = await self.client.beta.threads.runs.cancel(
+                thread_id=self.session.id, run_id=pending_run["run_id"]
+            )
+        except openai.APIStatusError as e:
+            # the run has already ended
+            logging.info(f"Run {pending_run['run_id']} not cancelled: {e}")
+            return
+
+        start_time = time.time()
+        while (
+            run.status not in FINAL_RUN_STATUSES
+            and (time.time() - start_time) < self.config.ORCHESTRATOR_MAX_WAITING_TIME
+        ):
+            await asyncio.sleep(0.25)
+            run = await self.client.beta.threads.runs.retrieve(
+                thread_id=self.session.id, run_id=run.id
+            )
+            self.api_calls += 1
+        logging.info(f"Run {run.id} status: {run.status}")
+
+    async def submit_tool_outputs(self, tool_call_outputs):
+        """Submits the tool outputs of the run, without streaming what follows."""
+        self.log_tool_outputs(tool_call_outputs)
+        await self.client.beta.threads.runs.submit_tool_outputs(
+            thread_id=self.session.id,
+            run_id=self.run.id,
+            tool_outputs=tool_call_outputs,
+        )
+        self.api_calls += 1
+
+    @trace
+    async def run_stream(self):
+        """Drives the run from the Assistants API event stream.
+
+        Waiting for each event is bounded by the max waiting time,
+        so a stalled stream is left running like a long one (see poll_run)."""
+        start_time = time.time()
+        deadline = start_time + self.config.ORCHESTRATOR_MAX_WAITING_TIME
+        stream_manager = self.stream_run(timeout=self.get_stream_timeout(deadline))
+
+        # each stream ends when the run completes or requires action,
+        # in the latter case submitting the tool outputs opens a new stream
+        while stream_manager is not None:
+            tool_call_outputs = None
+            stalled = False
+            try:
+                async with stream_manager as stream:
+                    async for event in aiter_until(stream, deadline):
+                        if event.event == "thread.run.requires_action":
+                            self.run = event.data
+                            logging.info(f"Run requires action.")
+                            tool_call_outputs = await self.requires_action()
+                        else:
+                            await self.process_event(event)
+                        # waits for the reader to catch up with the output sent
+                        await self.session.drain()
+
+                        if time.time() >= deadline:
+                            break
+            except (asyncio.TimeoutError,) + STREAM_TIMEOUT_ERRORS as e:
+                if self.run is None:
+                    raise
+                logging.warning(f"Run stream timed out: {e!r}")
+                stalled = True
+
+            if (
+                stalled or time.time() >= deadline
+            ) and self.run.status not in FINAL_RUN_STATUSES:
+                if tool_call_outputs:
+                    # the run can go on without us
+                    await self.submit_tool_outputs(tool_call_outputs)
+                return self.leave_run()
+
+            stream_manager = None
+            if tool_call_outputs:
+                self.log_tool_outputs(tool_call_outputs)
+                stream_manager = (
+                    self.client.beta.threads.runs.submit_tool_outputs_stream(
+                        thread_id=self.session.id,
+                        run_id=self.run.id,
+                        tool_outputs=tool_call_outputs,
+                        timeout=self.get_stream_timeout(deadline),
                     )
                 )
+                self.api_calls += 1
 
-                # store the output for the tool
-                tool_call_outputs.append(
-                    {
-                        "tool_call_id": tool_call.id,
-                        "output": json.dumps(tool_call_output),
-                    }
+        if self.run.status == "completed":
+            return self.completed()
+
+    async def process_event(self, event):
+        """Process an event from the run stream"""
+        if event.event == "thread.message.completed":
+            await self.process_message(event.data)
+            self.last_message_id = event.data.id
+        else:
+            super().process_event(event)
+
+    @trace
+    async def run_polling(self):
+        """Drives the run by polling the Assistants API."""
+        await self.start_run()
+        logging.info(f"Pre loop run status: {self.run.status}")
+        if await self.poll_run():
+            return self.completed()
+
+    async def poll_run(self) -> bool:
+        """Polls the run until it completes, or leaves it running past the max waiting time.
+
+        Returns:
+            bool: True if the run completed, False if it was left running.
+        """
+        start_time = time.time()
+
+        # loop until max_waiting_time is reached
+        while (time.time() - start_time) < self.config.ORCHESTRATOR_MAX_WAITING_TIME:
+            # checks the run regularly
+            self.run = await self.client.beta.threads.runs.retrieve(
+                thread_id=self.session.id, run_id=self.run.id
+            )
+            self.api_calls += 1
+            logging.info(
+                f"Run status: {self.run.status} (time={int(time.time() - start_time)}s, max_waiting_time={self.config.ORCHESTRATOR_MAX_WAITING_TIME})"
+            )
+
+            # check if steps have been added since the last poll
+            for step in await self.sync.new_steps(self.run.id):
+                logging.info(
+                    "The assistant has moved forward to step {}".format(step.id)
+                )
+                self.process_step(step)
+
+            # check if messages have been completed since the last poll
+            for message in await self.sync.new_messages(self.run.id):
+                await self.process_message(message)
+            # waits for the reader to catch up with the output sent
+            await self.session.drain()
+
+            if self.run.status == "completed":
+                logging.info(f"Run completed.")
+                return True
+            elif self.run.status == "requires_action":
+                logging.info(f"Run requires action.")
+                tool_call_outputs = await self.requires_action()
+                if tool_call_outputs:
+                    await self.submit_tool_outputs(tool_call_outputs)
+            elif self.run.status == "cancelled":
+                raise Exception(f"Run was cancelled: {self.run.status}")
+            elif self.run.status == "expired":
+                raise Exception(f"Run expired: {self.run.status}")
+            elif self.run.status == "failed":
+                raise ValueError(
+                    f"Run failed with status: {self.run.status}, last_error: {self.run.last_error}"
                 )
+            elif self.run.status in ["in_progress", "queued", "cancelling"]:
+                await asyncio.sleep(0.25)
             else:
-                raise ValueError(f"Unsupported tool call type: {tool_call.type}")
+                raise ValueError(f"Unknown run status: {self.run.status}")
+
+        self.leave_run()
+        return False
+
+    @trace
+    async def process_message(self, message):
+        for entry in message.content:
+            if message.role == "user":
+                # this means a message we just added
+                pass
+            elif entry.type == "text" and message.id in self.streamed_message_ids:
+                # the text has already been sent from the message deltas
+                pass
+            elif entry.type == "text":
+                self.session.send(
+                    TextResponse(role=message.role, content=entry.text.value)
+                )
+            elif entry.type == "image_file":
+                file_id = entry.image_file.file_id
+                file_content = await self.client.files.content(file_id)
+                self.api_calls += 1
+                self.session.send(ImageResponse.from_bytes(file_content.read()))
+            else:
+                logging.critical("Unknown content type: {}".format(entry.type))
 
-        if tool_call_outputs:
-            logging.info(f"Submitting tool outputs: {tool_call_outputs}")
-            _ = self.client.beta.threads.runs.submit_tool_outputs(
-                thread_id=self.thread.id,
-                run_id=self.run.id,
-                tool_outputs=tool_call_outputs,
+    @trace
+    async def invoke_tool_call(self, tool_call, extension_args):
+        """Invokes the extension of a tool call, errors are returned as the output
+        so that one failing call doesn't fail the others."""
+        extension, error = self.get_tool_call_extension(tool_call, extension_args)
+        if error:
+            return error
+        try:
+            return await extension.ainvoke(**extension_args)
+        except Exception as e:
+            logging.critical(
+                f"Error invoking extension {tool_call.function.name}: {traceback.format_exc()}"
             )
+            return f"Error: {e}"
+
+    @trace
+    async def requires_action(self):
+        """What to do when run.status == 'requires_action'
+
+        The tool calls of the step are invoked concurrently, up to
+        ORCHESTRATOR_MAX_CONCURRENT_TOOL_CALLS at a time.
+
+        Returns:
+            list: the tool outputs to submit for the run.
+        """
+        tool_calls = self.parse_tool_calls()
+        semaphore = asyncio.Semaphore(
+            self.config.ORCHESTRATOR_MAX_CONCURRENT_TOOL_CALLS
+        )
+
+        async def invoke_tool_call(tool_call, extension_args):
+            async with semaphore:
+                return await self.invoke_tool_call(tool_call, extension_args)
+
+        outputs = await asyncio.gather(
+            *[
+                invoke_tool_call(tool_call, extension_args)
+                for tool_call, extension_args in tool_calls
+            ]
+        )
+
+        return self.collect_tool_outputs(tool_calls, outputs)
@@ -0,0 +1,416 @@
+"""Streams the output of a session to its reader, in bounded memory.
+
+The orchestrator sends the output of a turn (text deltas, tool calls, images encoded
+in base64) faster than a client may read it, and the output of a turn that isn't
+streamed is only read once the turn has ended. So that a worker serving many
+sessions doesn't hold all of it in memory:
+- outputs are counted in bytes, and read back in chunks of at most chunk_size
+  characters, a large output never being copied as a whole again,
+- outputs of spill_min_bytes or more (ex: images), and those beyond max_bytes held
+  in memory, are written to a temporary file in spill_dir rather than kept in memory,
+- the orchestrator calls drain() between events, which waits while a reader is more
+  than max_bytes behind (backpressure), for at most max_wait seconds in a row in case
+  the reader went away.
+
+The output is kept until the stream is released, so that the retries of a turn
+can read it from the start (see Session.follow), each reader with its own cursor.
+Each session replying with the stream holds it (acquire) until its reply has been
+read (release), the spill file is closed once the last one released it."""
+
+import time
+import codecs
+import asyncio
+import logging
+import tempfile
+import threading
+from typing import Optional
+
+# returned while the next chunk hasn't been put yet
+WAIT = object()
+
+
+class LoopEvent:
+    """An event set from any thread and awaited from any event loop.
+
+    The turns of a thread, and the retries following the output of a turn, are
+    served by different event loops (promptflow runs each line with asyncio.run),
+    which asyncio.Event doesn't support."""
+
+    def __init__(self):
+        self._flag = False
+        # (event loop, future) of each waiter
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def is_set(self) -> bool:
+        return self._flag
+
+    def set(self):
+        with self._lock:
+            self._flag = True
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_set_result, future)
+            except RuntimeError:
+                # the loop of the waiter is closed
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._flag = False
+
+    async def wait(self) -> bool:
+        """Waits until the event is set."""
+        with self._lock:
+            if self._flag:
+                return True
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append((asyncio.get_running_loop(), future))
+        try:
+            await future
+        finally:
+            with self._lock:
+                self._waiters = [
+                    waiter for waiter in self._waiters if waiter[1] is not future
+                ]
+        return True
+
+
+def _set_result(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class OutputCursor:
+    """The position of a reader in the stream."""
+
+    def __init__(self):
+        self.index = 0
+        self.offset = 0
+        self.read_bytes = 0
+        self.decoder = None
+
+
+class OutputStream:
+    """Bounded, chunked stream of the output of a session, spilled to disk if needed."""
+
+    def __init__(
+        self,
+        max_bytes: int = 1024 * 1024,
+        chunk_size: int = 64 * 1024,
+        spill_dir: str = "",
+        spill_min_bytes: int = 256 * 1024,
+        max_wait: float = 60.0,
+        hasher=None,
+    ):
+        """Initializes a new output stream.
+
+        Args:
+            max_bytes (int): Maximum bytes held in memory, and maximum bytes a reader
+                can be behind before drain() waits for it.
+            chunk_size (int): Maximum size of the chunks read, in characters.
+            spill_dir (str): Directory of the temporary file outputs are spilled to,
+                an empty string keeps them all in memory.
+            spill_min_bytes (int): Size from which an output is always spilled.
+            max_wait (float): Maximum time drain() waits for a reader, in seconds.
+            hasher: A hashlib object updated with the output, if any.
+        """
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.spill_dir = spill_dir
+        self.spill_min_bytes = spill_min_bytes
+        self.max_wait = max_wait
+        self.hasher = hasher
+
+        # (text, file offset, size in bytes), text is None if spilled to the file
+        self.entries = []
+        self.readers = []
+        self.closed = False
+        self.error = None
+        self._file = None
+        self._cond = threading.Condition()
+        # the sessions replying with the stream, see acquire and release
+        self.holders = 1
+
+        self.size = 0
+        self.read_bytes = 0
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self.max_queued_bytes = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        # set when drain() gave up on the reader, until it reads again
+        self.stalled = False
+
+    @property
+    def queued_bytes(self) -> int:
+        """Gets the bytes put but not read yet by the furthest reader."""
+        return self.size - self.read_bytes
+
+    def _notify(self):
+        self._cond.notify_all()
+
+    def _spill(self, data: bytes) -> Optional[int]:
+        """Appends data to the spill file.
+
+        Returns:
+            int: The offset of the data in the file, None if it couldn't be written.
+        """
+        try:
+            if self._file is None:
+                self._file = tempfile.TemporaryFile(
+                    dir=self.spill_dir, prefix="session-output-"
+                )
+            offset = self._file.seek(0, 2)
+            self._file.write(data)
+            return offset
+        except OSError as e:
+            logging.warning(f"Could not spill output to {self.spill_dir}: {e}")
+            return None
+
+    def put(self, text: str):
+        """Puts an output in the stream, never waiting (see drain)."""
+        if not text:
+            return
+        data = text.encode("utf-8")
+        with self._cond:
+            if self.closed:
+                logging.warning("Output put in a closed stream, dropped")
+                return
+            if self.hasher is not None:
+                self.hasher.update(data)
+
+            offset = None
+            if self.spill_dir and (
+                len(data) >= self.spill_min_bytes
+                or self.memory_bytes + len(data) > self.max_bytes
+            ):
+                offset = self._spill(data)
+            if offset is None:
+                self.entries.append((text, None, len(data)))
+                self.memory_bytes += len(data)
+            else:
+                self.entries.append((None, offset, len(data)))
+                self.spilled_bytes += len(data)
+
+            self.size += len(data)
+            self.max_queued_bytes = max(self.max_queued_bytes, self.queued_bytes)
+            self._notify()
+
+    def _next_chunk(self, cursor: OutputCursor):
+        """Gets the next chunk for a reader.
+
+        Returns:
+            The chunk, None at the end of the stream, or WAIT.
+        """
+        while cursor.index < len(self.entries):
+            text, offset, size = self.entries[cursor.index]
+            if text is not None and cursor.offset < len(text):
+                chunk = text[cursor.offset : cursor.offset + self.chunk_size]
+                cursor.offset += len(chunk)
+                if cursor.offset >= len(text):
+                    self._read(cursor, size)
+                return chunk
+            if text is None and cursor.offset < size:
+                self._file.seek(offset + cursor.offset)
+                data = self._file.read(min(self.chunk_size, size - cursor.offset))
+                cursor.offset += len(data)
+                if cursor.decoder is None:
+                    cursor.decoder = codecs.getincrementaldecoder("utf-8")()
+                chunk = cursor.decoder.decode(data, final=cursor.offset >= size)
+                self._read(cursor, len(data))
+                if chunk:
+                    return chunk
+                continue
+            cursor.index += 1
+            cursor.offset = 0
+            cursor.decoder = None
+
+        return None if self.closed else WAIT
+
+    def _read(self, cursor: OutputCursor, n_bytes: int):
+        """Records the progress of a reader."""
+        cursor.read_bytes += n_bytes
+        if cursor.read_bytes > self.read_bytes:
+            self.read_bytes = cursor.read_bytes
+            self.stalled = False
+            self._notify()
+
+    def _attach(self) -> OutputCursor:
+        cursor = OutputCursor()
+        with self._cond:
+            self.readers.append(cursor)
+        return cursor
+
+    def _detach(self, cursor: OutputCursor):
+        with self._cond:
+            self.readers.remove(cursor)
+            self._notify()
+
+    def _must_wait(self) -> bool:
+        return (
+            bool(self.readers)
+            and not self.closed
+            and not self.stalled
+            and self.queued_bytes > self.max_bytes
+        )
+
+    def _stall(self):
+        self.stalled = True
+        logging.warning(
+            f"Output reader {self.queued_bytes} bytes behind for {self.max_wait}s, not waiting for it anymore"
+        )
+
+    def read(self):
+        """Yields the chunks of the stream from its start, as soon as they're put,
+        until the stream is closed.
+
+        Raises:
+            Exception: the error the stream was closed with, if any.
+        """
+        cursor = self._attach()
+        try:
+            while True:
+                with self._cond:
+                    chunk = self._next_chunk(cursor)
+                    while chunk is WAIT:
+                        self._cond.wait()
+                        chunk = self._next_chunk(cursor)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            self._detach(cursor)
+
+        if self.error is not None:
+            raise self.error
+
+    def drain(self):
+        """Waits while a reader is more than max_bytes behind, see max_wait."""
+        start = time.monotonic()
+        with self._cond:
+            if not self._must_wait():
+                return
+            self.waits += 1
+            while self._must_wait():
+                remaining = self.max_wait - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._stall()
+                    break
+                self._cond.wait(remaining)
+            self.wait_time += time.monotonic() - start
+
+    def close(self, error: Exception = None):
+        """Closes the stream, signaling the end of the output to the readers.
+
+        Args:
+            error (Exception): The error to raise to the readers, if any.
+        """
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.error = error
+            self._notify()
+        if self.spilled_bytes:
+            logging.info(f"Output stream closed: {self.get_stats()}")
+
+    def acquire(self):
+        """Holds the stream for another session replying with it, see release."""
+        with self._cond:
+            self.holders += 1
+
+    def release(self):
+        """Releases the stream once a session replying with it has been read,
+        closing the spill file once the last session released it."""
+        with self._cond:
+            self.holders -= 1
+            if self.holders > 0 or self._file is None:
+                return
+            file, self._file = self._file, None
+        try:
+            file.close()
+        except OSError as e:
+            logging.warning(f"Could not close the spill file of an output: {e}")
+
+    def get_content_hash(self) -> Optional[str]:
+        """Gets the hash of the output put so far, None without hasher."""
+        with self._cond:
+            return self.hasher.hexdigest() if self.hasher is not None else None
+
+    def get_stats(self) -> dict:
+        """Gets the bytes put, queued, held in memory and spilled, and the waits."""
+        with self._cond:
+            return {
+                "bytes": self.size,
+                "queued_bytes": self.queued_bytes,
+                "max_queued_bytes": self.max_queued_bytes,
+                "memory_bytes": self.memory_bytes,
+                "spilled_bytes": self.spilled_bytes,
+                "readers": len(self.readers),
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+            }
+
+
+class AsyncOutputStream(OutputStream):
+    """Bounded, chunked stream of the output of a session, read from an event loop."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # replaced each time it's set, so that waiters wait for the next change
+        self._changed = LoopEvent()
+
+    def _notify(self):
+        super()._notify()
+        self._changed.set()
+        self._changed = LoopEvent()
+
+    async def read(self):
+        """Yields the chunks of the stream from its start, as soon as they're put,
+        until the stream is closed.
+
+        Raises:
+            Exception: the error the stream was closed with, if any.
+        """
+        cursor = self._attach()
+        try:
+            while True:
+                with self._cond:
+                    chunk = self._next_chunk(cursor)
+                    changed = self._changed
+                if chunk is WAIT:
+                    await changed.wait()
+                    continue
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            self._detach(cursor)
+
+        if self.error is not None:
+            raise self.error
+
+    async def drain(self):
+        """Waits while a reader is more than max_bytes behind, see max_wait."""
+        start = time.monotonic()
+        with self._cond:
+            if not self._must_wait():
+                return
+            self.waits += 1
+        while True:
+            with self._cond:
+                if not self._must_wait():
+                    break
+                remaining = self.max_wait - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._stall()
+                    break
+                changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        with self._cond:
+            self.wait_time += time.monotonic() - start
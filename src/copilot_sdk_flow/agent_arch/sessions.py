@@ -1,12 +1,17 @@
-from typing import Union
+from typing import List, Union
+import os
+import time
+import tempfile
 import logging
-from openai import AzureOpenAI
+from openai import AzureOpenAI, AsyncAzureOpenAI
 from openai.types.chat.chat_completion_message import ChatCompletionMessage
 from openai.types.beta.thread import Thread
 import traceback
 from typing import Any
 from promptflow.tracing import trace
-from collections import deque
+import threading
+import asyncio
+from collections import OrderedDict
 from agent_arch.messages import (
     ExtensionCallMessage,
     ExtensionReturnMessage,
@@ -14,28 +19,63 @@ from agent_arch.messages import (
     TextResponse,
     ImageResponse,
 )
+from agent_arch.mirror import (
+    ThreadMirror,
+    get_common_length,
+    get_content_hash,
+    get_content_hasher,
+)
+from agent_arch.output import OutputStream, AsyncOutputStream, LoopEvent
 
 
 class Session:
     """Represents a session with the assistant."""
 
-    def __init__(self, thread: Thread, client: AzureOpenAI):
+    output_class = OutputStream
+
+    def __init__(
+        self, thread: Thread, client: AzureOpenAI, output_settings: dict = None
+    ):
         """Initializes a new session with the assistant.
 
         Args:
-            thread (Thread): The thread associated with the session.
+            thread (Thread): The thread associated with the session,
+                None for a new session whose thread is created with its first run.
             client (AzureOpenAI): The AzureOpenAI client.
+            output_settings (dict): The settings of the output stream, see OutputStream.
         """
-        self.id = thread.id
+        self.id = thread.id if thread else None
         self.thread = thread
         self.client = client
-        self.output_queue = deque()
-        self.open = True
+        # the output of the turn, hashed as the reply recorded in the mirror
+        self.output = self.output_class(
+            hasher=get_content_hasher("assistant"), **(output_settings or {})
+        )
+
+        # messages recorded since the last run, sent when the next run starts
+        self.pending_messages = []
+        # the handle of a run left running past the max waiting time, for the next turn
+        self.pending_run = None
+        self.thread_ready = threading.Event()
+        if thread:
+            self.thread_ready.set()
+
+        # the turn runs once the previous turns of the thread have ended
+        self.turn_ready = threading.Event()
+        self.turn_ready.set()
+        # the message starting the turn, to recognize the retries of the turn
+        self.turn_key = None
+        # the conversation sent with the turn, to recognize the retries of a turn
+        # which left its run running, see Orchestrator.take_pending_run
+        self.conversation_key = None
 
     @trace
     def record_message(self, message: Union[dict, ChatCompletionMessage]):
         """Appends a message to the session.
 
+        The message is added to the thread when the next run starts,
+        so that starting a turn takes a single API call.
+
         Args:
             message (ChatCompletionMessage): The message to append.
 
@@ -45,18 +85,44 @@ class Session:
         if isinstance(message, dict):
             assert "role" in message, "role is required"
             assert "content" in message, "content is required"
-            self.client.beta.threads.messages.create(
-                thread_id=self.thread.id,
-                role=message["role"],
-                content=message["content"],
+            self.pending_messages.append(
+                {"role": message["role"], "content": message["content"]}
             )
         elif isinstance(message, ChatCompletionMessage):
-            self.client.beta.threads.messages.create(
-                thread_id=self.thread.id,
-                role=message.role,
-                content=message.content,
+            self.pending_messages.append(
+                {"role": message.role, "content": message.content}
             )
 
+    def pop_pending_messages(self) -> list:
+        """Gets the messages to add to the thread with the next run."""
+        pending_messages, self.pending_messages = self.pending_messages, []
+        return pending_messages
+
+    def set_thread(self, thread: Thread):
+        """Sets the thread of the session, once created with its first run."""
+        self.id = thread.id
+        self.thread = thread
+        self.thread_ready.set()
+
+    def wait_for_thread(self):
+        """Waits until the thread of the session exists, or the session is closed."""
+        self.thread_ready.wait()
+
+    def wait_for_turn(self):
+        """Waits until the previous turns of the thread have ended."""
+        self.turn_ready.wait()
+
+    def follow(self, session: "Session"):
+        """Replies with the output of another session running the same turn:
+        reads its output stream from the start, until it's closed.
+        The stream must be held for it, see SessionManager.queue_turn."""
+        self.output.release()
+        self.output = session.output
+
+    def drain(self):
+        """Waits for the reader of the output to catch up, see OutputStream.drain."""
+        self.output.drain()
+
     @trace
     def send(self, message: Any):
         """Sends a message back to the user.
@@ -78,7 +144,14 @@ class Session:
         elif isinstance(message, TextResponse):
             output_message = message.content
         elif isinstance(message, ImageResponse):
-            output_message = "![image](" + message.content + ")\n\n"
+            # put apart, not to copy the image, which is likely spilled to disk
+            logging.info(
+                f"Queueing message type=ImageResponse len={len(message.content)}"
+            )
+            self.output.put("![image](")
+            self.output.put(message.content)
+            self.output.put(")\n\n")
+            output_message = None
         else:
             logging.critical(f"Unknown message type: {type(message)}")
             output_message = f"`Unknown message type: {type(message)}`\n\n"
@@ -86,54 +159,459 @@ class Session:
             logging.info(
                 f"Queueing message type={message.__class__.__name__} len={len(output_message)}"
             )
-            self.output_queue.append(output_message)
+            self.output.put(output_message)
 
     def close(self):
-        """Closes the session."""
-        self.open = False
+        """Closes the session, signaling the end of the output."""
+        self.output.close()
+        self.thread_ready.set()
+
+    def fail(self, error: Exception):
+        """Closes the session with an error, to be raised to the reader of the output."""
+        self.output.close(error)
+        self.close()
+
+    def iterate_output(self):
+        """Yields the chunks of the output as soon as they are sent,
+        until the session is closed, then releases the output.
+
+        Raises:
+            Exception: the error the session failed with, if any.
+        """
+        try:
+            yield from self.output.read()
+        finally:
+            self.output.release()
+
+
+def get_thread_size(thread: Thread) -> int:
+    """Gets the approximate size of a thread in memory, in bytes."""
+    if hasattr(thread, "model_dump_json"):
+        return len(thread.model_dump_json())
+    return len(repr(thread))
+
+
+class SessionBusyError(Exception):
+    """Raised when too many turns are already waiting on the thread of a session."""
+
+
+class SessionCache:
+    """LRU cache of the threads of the sessions, by session ID.
+
+    Bounded by entry count and bytes, entries idle for longer than idle_ttl
+    are dropped. Thread-safe, it's shared by all the turns served by the process."""
+
+    def __init__(self, max_entries: int, max_bytes: int, idle_ttl: float):
+        """Initializes a new cache.
+
+        Args:
+            max_entries (int): Maximum number of threads kept, 0 disables the cache.
+            max_bytes (int): Maximum total size of the threads kept.
+            idle_ttl (float): How long a thread is kept after its last use, in seconds.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+
+    def _pop(self, session_id: str):
+        _, _, size = self.entries.pop(session_id)
+        self.size -= size
+
+    def _expire(self, now: float):
+        # the least recently used entries come first
+        while self.entries:
+            session_id, (last_used, _, _) = next(iter(self.entries.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            self._pop(session_id)
+            self.expirations += 1
+
+    def get(self, session_id: str) -> Union[Thread, None]:
+        """Gets the thread of a session, if cached, and marks it as used."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self.entries.get(session_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[session_id] = (now, entry[1], entry[2])
+            self.entries.move_to_end(session_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, session_id: str, thread: Thread):
+        """Caches the thread of a session, evicting the least recently used ones."""
+        size = get_thread_size(thread)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if session_id in self.entries:
+                self._pop(session_id)
+            self.entries[session_id] = (now, thread, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def pop(self, session_id: str):
+        """Drops the thread of a session, if cached."""
+        with self._lock:
+            if session_id in self.entries:
+                self._pop(session_id)
+
+    def get_stats(self) -> dict:
+        """Gets the hit/miss/eviction counters and the current size of the cache."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
 
 
 class SessionManager:
-    """Manages assistant sessions."""
+    """Manages assistant sessions.
+
+    A session only lasts for a turn, but the thread it continues is kept in a cache
+    across turns, so that a follow-up turn doesn't need to retrieve it again.
+    Use get_instance to get the manager of the process, whose cache is long-lived.
+    It's shared by all the clients, each call taking the client of the caller.
+
+    A thread can only have one active run, so the turns of a thread run one at a time,
+    in the order they arrived. A retry of a turn still queued or running follows the
+    output of that turn instead of starting another run."""
 
-    def __init__(self, aoai_client: AzureOpenAI):
+    session_class = Session
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(
+        self,
+        cache: SessionCache = None,
+        mirror: ThreadMirror = None,
+    ):
         """Initializes a new session manager.
 
         Args:
-            aoai_client (AzureOpenAI): The AzureOpenAI client.
+            cache (SessionCache): The cache of the threads, configured from
+                the SESSIONS_CACHE_* environment variables by default.
+            mirror (ThreadMirror): The local mirror of the messages of the threads,
+                configured from the SESSIONS_MIRROR_* environment variables by default.
         """
-        self.aoai_client = aoai_client
-        self.sessions = {}
+        self.sessions = cache or SessionCache(
+            max_entries=int(os.getenv("SESSIONS_CACHE_MAX_ENTRIES", "1024")),
+            max_bytes=int(os.getenv("SESSIONS_CACHE_MAX_BYTES", str(4 * 1024 * 1024))),
+            idle_ttl=float(os.getenv("SESSIONS_CACHE_IDLE_TTL", "1800")),
+        )
+        self.mirror = mirror or ThreadMirror(
+            os.getenv(
+                "SESSIONS_MIRROR_PATH",
+                os.path.join(tempfile.gettempdir(), "sessions_mirror.db"),
+            ),
+            max_age=float(os.getenv("SESSIONS_MIRROR_MAX_AGE", str(30 * 24 * 3600))),
+        )
+        # the mirror is shared by all the clients of the host, and a conversation
+        # doesn't tell who sent it: finding threads back is opt-in
+        self.recover_sessions = os.getenv(
+            "SESSIONS_MIRROR_RECOVER", "false"
+        ).lower() in ["true", "1", "yes"]
+        # the settings of the output streams of the sessions, see OutputStream
+        self.output_settings = {
+            "max_bytes": int(os.getenv("SESSIONS_OUTPUT_MAX_BYTES", str(1024 * 1024))),
+            "chunk_size": int(os.getenv("SESSIONS_OUTPUT_CHUNK_SIZE", str(64 * 1024))),
+            "spill_dir": os.getenv("SESSIONS_OUTPUT_SPILL_DIR", tempfile.gettempdir()),
+            "spill_min_bytes": int(
+                os.getenv("SESSIONS_OUTPUT_SPILL_MIN_BYTES", str(256 * 1024))
+            ),
+            "max_wait": float(os.getenv("SESSIONS_OUTPUT_MAX_WAIT", "60")),
+        }
+
+        # the turns of each thread, the first one runs while the others wait
+        self.turns = {}
+        self.max_queued_turns = int(os.getenv("SESSIONS_MAX_QUEUED_TURNS", "8"))
+        self.waited_turns = 0
+        self.coalesced_turns = 0
+        self.rejected_turns = 0
+        self._turns_lock = threading.Lock()
+
+        # the handles of the runs left running, for the next turn of their thread:
+        # a streamed reply returns its context before the run is left running
+        self.pending_runs = OrderedDict()
+        self.max_pending_runs = self.sessions.max_entries or 1024
+
+    @classmethod
+    def get_instance(cls):
+        """Gets the session manager of the process, created on first use."""
+        with cls._instances_lock:
+            if cls not in cls._instances:
+                cls._instances[cls] = cls()
+            return cls._instances[cls]
 
     @trace
-    def create_session(self) -> Session:
-        """Creates a new session."""
-        thread = self.aoai_client.beta.threads.create()
-        return Session(thread=thread, client=self.aoai_client)
+    def create_session(self, aoai_client: AzureOpenAI) -> Session:
+        """Creates a new session, its thread is created with its first run."""
+        return self.session_class(
+            thread=None, client=aoai_client, output_settings=self.output_settings
+        )
 
     @trace
-    def get_session(self, session_id: str) -> Union[Session, None]:
+    def get_session(
+        self, session_id: str, aoai_client: AzureOpenAI
+    ) -> Union[Session, None]:
         """Gets a session by its ID."""
-        if session_id in self.sessions:
-            return self.sessions[session_id]
-
-        try:
-            thread = self.aoai_client.beta.threads.retrieve(session_id)
-        except Exception as e:
-            logging.critical(
-                f"Error retrieving thread {session_id}: {traceback.format_exc()}"
-            )
-            return None
+        thread = self.sessions.get(session_id)
+        if thread is None:
+            try:
+                thread = aoai_client.beta.threads.retrieve(session_id)
+            except Exception as e:
+                logging.critical(
+                    f"Error retrieving thread {session_id}: {traceback.format_exc()}"
+                )
+                return None
 
-        self.sessions[session_id] = Session(thread=thread, client=self.aoai_client)
-
-        return self.sessions[thread.id]
+        return self.session_class(
+            thread=thread, client=aoai_client, output_settings=self.output_settings
+        )
 
     def set_session(self, session_id, session: Session):
-        """Sets a session."""
-        self.sessions[session_id] = session
+        """Sets a session, once its thread exists.
+
+        The only writer of the cache: a thread is cached after a turn on it succeeded.
+        """
+        if session.thread is not None:
+            self.sessions.put(session_id, session.thread)
 
     def clear_session(self, session_id):
         """Clears a session."""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        self.sessions.pop(session_id)
+
+    def find_session(self, messages: List[dict]) -> Union[str, None]:
+        """Finds the thread of a conversation sent without its session_id,
+        see ThreadMirror.find_session.
+
+        Only if SESSIONS_MIRROR_RECOVER is set, and never a thread with a turn
+        queued or running, or a run left running: its client is still around."""
+        if not self.recover_sessions:
+            return None
+        session_id, known = self.mirror.find_session(messages)
+        if session_id is None:
+            return None
+        with self._turns_lock:
+            active = session_id in self.turns or session_id in self.pending_runs
+        if active:
+            logging.info(f"Not finding back thread {session_id}, it has an active turn")
+            return None
+        logging.info(
+            f"Found thread {session_id} holding {known} messages of the conversation"
+        )
+        return session_id
+
+    def get_new_messages(self, session_id: str, messages: List[dict]) -> List[dict]:
+        """Gets the messages of a conversation its thread doesn't have yet.
+
+        The replies in the conversation are already on the thread, a new
+        message is sent again if it's the retry of a turn. The last message
+        only is sent if the thread isn't mirrored, or differs from the conversation.
+        """
+        mirrored = self.mirror.get_hashes(session_id)
+        known = get_common_length(
+            mirrored, [get_content_hash(message) for message in messages]
+        )
+        if not mirrored or known < min(len(mirrored), len(messages)):
+            if mirrored:
+                logging.warning(
+                    f"Conversation differs from thread {session_id} after {known} messages"
+                )
+            return messages[-1:]
+        new_messages = [
+            message for message in messages[known:] if message["role"] != "assistant"
+        ]
+        return new_messages or messages[-1:]
+
+    def record_turn(
+        self, session: Session, messages: List[dict], message_id: str = None
+    ):
+        """Records the messages of a turn in the mirror, followed by its reply
+        unless the run was left running.
+
+        Args:
+            session (Session): The session of the turn.
+            messages (List[dict]): The messages of the conversation, from its start.
+            message_id (str): The id of the last message of the run, if known.
+        """
+        if session.pending_run is None:
+            messages = messages + [
+                {"role": "assistant", "content_hash": session.output.get_content_hash()}
+            ]
+        self.mirror.record(session.id, messages, message_id)
+
+    def set_pending_run(self, session_id, pending_run: Union[dict, None]):
+        """Sets the handle of the run a session left running, None if it ended."""
+        with self._turns_lock:
+            self.pending_runs.pop(session_id, None)
+            if session_id is None or not pending_run:
+                return
+            self.pending_runs[session_id] = pending_run
+            while len(self.pending_runs) > self.max_pending_runs:
+                self.pending_runs.popitem(last=False)
+
+    def pop_pending_run(
+        self, session_id, pending_run: Union[dict, None] = None
+    ) -> Union[dict, None]:
+        """Pops the handle of the run a session left running, preferring the one
+        recorded in this process over the one passed back in the context."""
+        with self._turns_lock:
+            return self.pending_runs.pop(session_id, None) or pending_run
+
+    def queue_turn(self, session: Session) -> Union[Session, None]:
+        """Queues the turn of a session after the turns of its thread
+        already queued or running, see Session.wait_for_turn.
+
+        Returns:
+            Session: The session of the same turn if it's already queued or running,
+                that is a turn started by the same message, None if the turn was queued.
+
+        Raises:
+            SessionBusyError: If max_queued_turns turns are already waiting on the thread.
+        """
+        if session.id is None:
+            # a new thread, created by the run
+            return None
+
+        key = session.pending_messages[-1] if session.pending_messages else None
+        with self._turns_lock:
+            turns = self.turns.get(session.id, [])
+            for turn in turns:
+                if key is not None and turn.turn_key == key:
+                    self.coalesced_turns += 1
+                    logging.info(f"Retry of a turn in progress on thread {session.id}")
+                    # held before the turn can end, released once the retry is read
+                    turn.output.acquire()
+                    return turn
+            if self.max_queued_turns and len(turns) > self.max_queued_turns:
+                self.rejected_turns += 1
+                raise SessionBusyError(
+                    f"Too many turns waiting on thread {session.id}, try again later"
+                )
+
+            session.turn_key = key
+            turns.append(session)
+            self.turns[session.id] = turns
+            if len(turns) > 1:
+                self.waited_turns += 1
+                session.turn_ready.clear()
+                logging.info(
+                    f"Turn waiting for {len(turns) - 1} turns on thread {session.id}"
+                )
+        return None
+
+    def end_turn(self, session: Session):
+        """Ends the turn of a session, the next turn of its thread can run."""
+        with self._turns_lock:
+            turns = self.turns.get(session.id, [])
+            if session not in turns:
+                return
+            turns.remove(session)
+            if turns:
+                turns[0].turn_ready.set()
+            else:
+                del self.turns[session.id]
+
+    def get_turn_stats(self) -> dict:
+        """Gets the counters of the turns that waited, were coalesced or rejected."""
+        with self._turns_lock:
+            return {
+                "active_threads": len(self.turns),
+                "queued": sum(len(turns) - 1 for turns in self.turns.values()),
+                "waited": self.waited_turns,
+                "coalesced": self.coalesced_turns,
+                "rejected": self.rejected_turns,
+            }
+
+
+class AsyncSession(Session):
+    """Represents a session with the assistant, used from an event loop."""
+
+    output_class = AsyncOutputStream
+
+    def __init__(
+        self, thread: Thread, client: AsyncAzureOpenAI, output_settings: dict = None
+    ):
+        """Initializes a new session with the assistant.
+
+        Args:
+            thread (Thread): The thread associated with the session.
+            client (AsyncAzureOpenAI): The AsyncAzureOpenAI client.
+            output_settings (dict): The settings of the output stream, see OutputStream.
+        """
+        super().__init__(thread=thread, client=client, output_settings=output_settings)
+        # set from the event loop serving the previous turn, see LoopEvent
+        self.thread_ready = LoopEvent()
+        if thread:
+            self.thread_ready.set()
+        self.turn_ready = LoopEvent()
+        self.turn_ready.set()
+
+    async def wait_for_thread(self):
+        """Waits until the thread of the session exists, or the session is closed."""
+        await self.thread_ready.wait()
+
+    async def wait_for_turn(self):
+        """Waits until the previous turns of the thread have ended."""
+        await self.turn_ready.wait()
+
+    async def drain(self):
+        """Waits for the reader of the output to catch up, see OutputStream.drain."""
+        await self.output.drain()
+
+    async def iterate_output(self):
+        """Yields the chunks of the output as soon as they are sent,
+        until the session is closed, then releases the output.
+
+        Raises:
+            Exception: the error the session failed with, if any.
+        """
+        try:
+            async for chunk in self.output.read():
+                yield chunk
+        finally:
+            self.output.release()
+
+
+class AsyncSessionManager(SessionManager):
+    """Manages assistant sessions, used from an event loop."""
+
+    session_class = AsyncSession
+
+    @trace
+    async def get_session(
+        self, session_id: str, aoai_client: AsyncAzureOpenAI
+    ) -> Union[AsyncSession, None]:
+        """Gets a session by its ID."""
+        thread = self.sessions.get(session_id)
+        if thread is None:
+            try:
+                thread = await aoai_client.beta.threads.retrieve(session_id)
+            except Exception as e:
+                logging.critical(
+                    f"Error retrieving thread {session_id}: {traceback.format_exc()}"
+                )
+                return None
+
+        return self.session_class(
+            thread=thread, client=aoai_client, output_settings=self.output_settings
+        )
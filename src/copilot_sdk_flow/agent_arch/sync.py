@@ -0,0 +1,139 @@
+"""Fetches what's new in a run (steps, messages) with as few API calls as possible.
+
+The list endpoints already return the full objects, so items are never retrieved
+one by one. Cursors are kept between calls so that each poll only returns items
+created since the previous one, in pages as large as the API allows."""
+
+from typing import List
+from openai import AzureOpenAI, AsyncAzureOpenAI
+from openai.types.beta.threads import Message
+from openai.types.beta.threads.runs import RunStep
+
+# maximum page size of the Assistants API list endpoints
+PAGE_SIZE = 100
+
+
+class RunDeltaSync:
+    """Tracks the steps and messages of a run already seen, using cursors."""
+
+    def __init__(
+        self,
+        client: AzureOpenAI,
+        thread_id: str,
+        last_step_id: str = None,
+        last_message_id: str = None,
+    ):
+        """Initializes a new delta sync.
+
+        Args:
+            client (AzureOpenAI): The AzureOpenAI client.
+            thread_id (str): The thread of the run.
+            last_step_id (str): The last step already seen, if any.
+            last_message_id (str): The last message already seen, if any.
+        """
+        self.client = client
+        self.thread_id = thread_id
+        self.last_step_id = last_step_id
+        self.last_message_id = last_message_id
+        self.api_calls = 0
+
+    def new_steps(self, run_id: str) -> List[RunStep]:
+        """Lists the steps of the run created since the last call."""
+        steps = []
+        while True:
+            page = self.client.beta.threads.runs.steps.list(
+                thread_id=self.thread_id,
+                run_id=run_id,
+                after=self.last_step_id,
+                limit=PAGE_SIZE,
+                order="asc",
+            )
+            self.api_calls += 1
+            if not self.add_steps(steps, page.data):
+                return steps
+
+    def new_messages(self, run_id: str) -> List[Message]:
+        """Lists the completed messages of the run created since the last call."""
+        messages = []
+        while True:
+            page = self.client.beta.threads.messages.list(
+                thread_id=self.thread_id,
+                run_id=run_id,
+                after=self.last_message_id,
+                limit=PAGE_SIZE,
+                order="asc",
+            )
+            self.api_calls += 1
+            if not self.add_messages(messages, page.data):
+                return messages
+
+    def add_steps(self, steps: List[RunStep], page: List[RunStep]) -> bool:
+        """Adds a page of steps and moves the cursor.
+
+        Returns:
+            bool: True if there might be more steps to list.
+        """
+        steps.extend(page)
+        if page:
+            self.last_step_id = page[-1].id
+        return len(page) == PAGE_SIZE
+
+    def add_messages(self, messages: List[Message], page: List[Message]) -> bool:
+        """Adds the completed messages of a page and moves the cursor.
+
+        The cursor stops before the first message still being written,
+        so that it is listed again, complete, by a later call.
+
+        Returns:
+            bool: True if there might be more messages to list.
+        """
+        for message in page:
+            if message.status == "in_progress":
+                return False
+            messages.append(message)
+            self.last_message_id = message.id
+        return len(page) == PAGE_SIZE
+
+
+class AsyncRunDeltaSync(RunDeltaSync):
+    """Tracks the steps and messages of a run already seen, using cursors,
+    with an AsyncAzureOpenAI client."""
+
+    def __init__(
+        self,
+        client: AsyncAzureOpenAI,
+        thread_id: str,
+        last_step_id: str = None,
+        last_message_id: str = None,
+    ):
+        super().__init__(client, thread_id, last_step_id, last_message_id)
+
+    async def new_steps(self, run_id: str) -> List[RunStep]:
+        """Lists the steps of the run created since the last call."""
+        steps = []
+        while True:
+            page = await self.client.beta.threads.runs.steps.list(
+                thread_id=self.thread_id,
+                run_id=run_id,
+                after=self.last_step_id,
+                limit=PAGE_SIZE,
+                order="asc",
+            )
+            self.api_calls += 1
+            if not self.add_steps(steps, page.data):
+                return steps
+
+    async def new_messages(self, run_id: str) -> List[Message]:
+        """Lists the completed messages of the run created since the last call."""
+        messages = []
+        while True:
+            page = await self.client.beta.threads.messages.list(
+                thread_id=self.thread_id,
+                run_id=run_id,
+                after=self.last_message_id,
+                limit=PAGE_SIZE,
+                order="asc",
+            )
+            self.api_calls += 1
+            if not self.add_messages(messages, page.data):
+                return messages
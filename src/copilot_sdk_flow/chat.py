@@ -2,6 +2,11 @@
 an entry point for our demo."""
 
 import os
+import asyncio
+import logging
+import threading
+import traceback
+import contextvars
 from promptflow.tracing import trace
 
 # local imports
@@ -10,11 +15,103 @@ import sys
 # TODO: using sys.path as hotfix to be able to run the script from 3 different locations
 sys.path.append(os.path.join(os.path.dirname(__file__)))
 
-from agent_arch.aoai import get_azure_openai_client
+from agent_arch.aoai import get_azure_openai_client, get_async_azure_openai_client
 from agent_arch.config import Configuration
-from agent_arch.sessions import SessionManager
-from agent_arch.orchestrator import Orchestrator
-from agent_arch.extensions.manager import ExtensionsManager
+from agent_arch.sessions import (
+    SessionManager,
+    AsyncSession,
+    AsyncSessionManager,
+    SessionBusyError,
+)
+from agent_arch.mirror import get_conversation_key
+from agent_arch.orchestrator import Orchestrator, AsyncOrchestrator
+from agent_arch.extensions.manager import ExtensionsManager, load_extensions
+
+# discover and validate the extensions once, when the worker starts
+load_extensions()
+
+
+def run_turn(
+    session_manager: SessionManager,
+    orchestrator: Orchestrator,
+    messages: list[dict],
+    pending_run: dict = None,
+    raise_errors: bool = False,
+):
+    """Runs the turn of a session, once the previous turns of its thread have ended,
+    records it, and closes the session.
+
+    Args:
+        session_manager (SessionManager): The session manager of the process.
+        orchestrator (Orchestrator): The orchestrator of the session.
+        messages (list[dict]): The messages of the conversation, from its start.
+        pending_run (dict): The handle of a run the previous turn left running,
+            passed back in the context.
+        raise_errors (bool): Raises the error of the run, rather than only logging
+            it when the output is read by a reply streamed in the background.
+    """
+    session = orchestrator.session
+    try:
+        session.wait_for_turn()
+        session.pending_run = session_manager.pop_pending_run(session.id, pending_run)
+        orchestrator.run_loop()
+        session_manager.record_turn(session, messages, orchestrator.last_message_id)
+        # cached once the run succeeded, a failed thread is retrieved again
+        session_manager.set_session(session.id, session)
+    except Exception as e:
+        if not raise_errors:
+            logging.critical(f"Error during the run: {traceback.format_exc()}")
+        # the thread may be gone, retrieve it again on the next turn
+        session_manager.clear_session(session.id)
+        # the readers of the output and the retries of the turn get the error
+        session.fail(e)
+        if raise_errors:
+            # its output isn't returned, so won't be read
+            session.output.release()
+            raise
+    finally:
+        session_manager.set_pending_run(session.id, session.pending_run)
+        session_manager.end_turn(session)
+        session.close()
+
+
+async def arun_turn(
+    session_manager: AsyncSessionManager,
+    orchestrator: AsyncOrchestrator,
+    messages: list[dict],
+    pending_run: dict = None,
+):
+    """Async variant of run_turn, which always raises the error of the run.
+
+    If the turn is cancelled, along with the event loop running it, its run is left
+    running for the next turn of the thread (see Orchestrator.leave_run).
+    """
+    session = orchestrator.session
+    try:
+        await session.wait_for_turn()
+        session.pending_run = session_manager.pop_pending_run(session.id, pending_run)
+        await orchestrator.run_loop()
+        session_manager.record_turn(session, messages, orchestrator.last_message_id)
+        # cached once the run succeeded, a failed thread is retrieved again
+        session_manager.set_session(session.id, session)
+    except asyncio.CancelledError:
+        orchestrator.leave_run(reason="was cancelled with its turn")
+        # the retries of the turn get an error, rather than an empty reply
+        session.fail(RuntimeError("The turn was cancelled"))
+        session.output.release()
+        raise
+    except Exception as e:
+        # the thread may be gone, retrieve it again on the next turn
+        session_manager.clear_session(session.id)
+        # the retries of the turn get the error too
+        session.fail(e)
+        # its output isn't returned, so won't be read
+        session.output.release()
+        raise
+    finally:
+        session_manager.set_pending_run(session.id, session.pending_run)
+        session_manager.end_turn(session)
+        session.close()
 
 
 @trace
@@ -30,23 +127,47 @@ def chat_completion(
     # loads the system config from the environment variables
     # with overrides from the context
     config = Configuration.from_env_and_context(context)
+    # the handle of a run the previous turn left running, see Orchestrator.leave_run
+    context_pending_run = context.pop("pending_run", None)
 
     # get the Azure OpenAI client
-    aoai_client = get_azure_openai_client(stream=False)  # TODO: Assistants Streaming
+    aoai_client = get_azure_openai_client(stream=False)
 
     # the session manager is responsible for creating and storing sessions
-    session_manager = SessionManager(aoai_client)
+    # it's long-lived, so that follow-up turns find their thread in its cache
+    session_manager = SessionManager.get_instance()
 
-    if "session_id" not in context:
-        session = session_manager.create_session()
-        context["session_id"] = session.id
+    session = None
+    session_id = context.get("session_id")
+    if session_id is None:
+        # a client which lost its session_id finds its thread back by the conversation
+        session_id = session_manager.find_session(messages)
+    if session_id is not None:
+        session = session_manager.get_session(session_id, aoai_client)
+
+    if session is None:
+        # the thread of the session is created along with the first run
+        session = session_manager.create_session(aoai_client)
         # record all messages so far
         for message in messages:
             session.record_message(message)
     else:
-        session = session_manager.get_session(context.get("session_id"))
-        # record the user message into the session
-        session.record_message(messages[-1])
+        # record the messages the thread doesn't have yet, usually the user message
+        for message in session_manager.get_new_messages(session.id, messages):
+            session.record_message(message)
+
+        # the turns of a thread run one at a time, in order
+        try:
+            retried_session = session_manager.queue_turn(session)
+        except SessionBusyError as e:
+            return {"error": str(e)}
+        if retried_session is not None:
+            # a retry of a turn in progress replies with its output, without another run
+            session.follow(retried_session)
+            return {"reply": session.iterate_output(), "context": context}
+
+    # a retry sends the same conversation, see Orchestrator.take_pending_run
+    session.conversation_key = get_conversation_key(messages)
 
     # the extension manager is responsible for loading and invoking extensions
     extensions = ExtensionsManager(config)
@@ -54,11 +175,122 @@ def chat_completion(
 
     # the orchestrator is responsible for managing the assistant run
     orchestrator = Orchestrator(config, aoai_client, session, extensions)
-    orchestrator.run_loop()
 
-    # for now we'll use this trick for outputs
-    def output_queue_iterate():
-        while session.output_queue:
-            yield session.output_queue.popleft()
+    if stream:
+        # run in the background, the reply yields outputs as soon as they're sent
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(
+                run_turn,
+                session_manager,
+                orchestrator,
+                messages,
+                context_pending_run,
+            ),
+            daemon=True,
+        ).start()
+        # a new session gets its id once the run has created its thread
+        session.wait_for_thread()
+    else:
+        run_turn(
+            session_manager,
+            orchestrator,
+            messages,
+            context_pending_run,
+            raise_errors=True,
+        )
+        if session.pending_run:
+            # for the next turn to resume the run, wherever it's served
+            context["pending_run"] = session.pending_run
+
+    if session.id:
+        context["session_id"] = session.id
+
+    return {"reply": session.iterate_output(), "context": context}
+
+
+@trace
+async def achat_completion(
+    messages: list[dict],
+    stream: bool = False,
+    context: dict[str, any] = {},
+):
+    """Async variant of chat_completion, to serve many conversations
+    concurrently from a single event loop.
+
+    The reply is always returned whole, as a string, even if streamed: promptflow
+    runs an async entry with asyncio.run for each line and only drains sync
+    generators, so an async generator returned would never be read, and a task
+    running the turn past the return would be cancelled along with the loop."""
+    # a couple basic checks
+    if not messages:
+        return {"error": "No messages provided."}
+
+    # loads the system config from the environment variables
+    # with overrides from the context
+    config = Configuration.from_env_and_context(context)
+    # the handle of a run the previous turn left running, see Orchestrator.leave_run
+    context_pending_run = context.pop("pending_run", None)
+
+    # get the Azure OpenAI client
+    aoai_client = get_async_azure_openai_client()
+
+    # the session manager is responsible for creating and storing sessions
+    # it's long-lived, so that follow-up turns find their thread in its cache
+    session_manager = AsyncSessionManager.get_instance()
+
+    session = None
+    session_id = context.get("session_id")
+    if session_id is None:
+        # a client which lost its session_id finds its thread back by the conversation
+        session_id = session_manager.find_session(messages)
+    if session_id is not None:
+        session = await session_manager.get_session(session_id, aoai_client)
+
+    if session is None:
+        # the thread of the session is created along with the first run
+        session = session_manager.create_session(aoai_client)
+        # record all messages so far
+        for message in messages:
+            session.record_message(message)
+    else:
+        # record the messages the thread doesn't have yet, usually the user message
+        for message in session_manager.get_new_messages(session.id, messages):
+            session.record_message(message)
+
+        # the turns of a thread run one at a time, in order
+        try:
+            retried_session = session_manager.queue_turn(session)
+        except SessionBusyError as e:
+            return {"error": str(e)}
+        if retried_session is not None:
+            # a retry of a turn in progress replies with its output, without another run
+            session.follow(retried_session)
+            return {"reply": await aread_output(session), "context": context}
+
+    # a retry sends the same conversation, see Orchestrator.take_pending_run
+    session.conversation_key = get_conversation_key(messages)
+
+    # the extension manager is responsible for loading and invoking extensions
+    extensions = ExtensionsManager(config)
+    extensions.load()
+
+    # the orchestrator is responsible for managing the assistant run
+    orchestrator = AsyncOrchestrator(config, aoai_client, session, extensions)
+
+    if stream:
+        logging.info("Streaming isn't supported by the async entry, replying whole")
+    await arun_turn(session_manager, orchestrator, messages, context_pending_run)
+    if session.pending_run:
+        # for the next turn to resume the run, wherever it's served
+        context["pending_run"] = session.pending_run
+
+    if session.id:
+        context["session_id"] = session.id
+
+    return {"reply": await aread_output(session), "context": context}
+
 
-    return {"reply": output_queue_iterate(), "context": context}
+async def aread_output(session: AsyncSession) -> str:
+    """Reads the whole output of a session, once it's closed."""
+    return "".join([chunk async for chunk in session.iterate_output()])
@@ -24,7 +24,27 @@ import sys
 
 # TODO: using sys.path as hotfix to be able to run the script from 3 different locations
 sys.path.append(os.path.join(os.path.dirname(__file__)))
-from chat import chat_completion
+from chat import chat_completion, achat_completion
+
+
+def _build_conversation(chat_input: str, chat_history: list) -> list:
+    # each turn of the chat_history holds the user input and the reply to it,
+    # chat_completion only sends the messages the thread doesn't have yet
+    conversation = []
+    for turn in chat_history:
+        if "inputs" in turn:
+            conversation.append(
+                {"role": "user", "content": turn["inputs"]["chat_input"]}
+            )
+        if "outputs" in turn:
+            conversation.append(
+                {"role": "assistant", "content": turn["outputs"]["chat_output"]}
+            )
+
+    # add the user input as last message in the conversation
+    conversation.append({"role": "user", "content": chat_input})
+
+    return conversation
 
 
 # The inputs section will change based on the arguments of the tool function, after you save the code
@@ -37,20 +57,18 @@ def flow_entry_copilot_assistants(
     # json parse context as dict
     context = json.loads(context) if context else {}
 
-    # refactor the whole chat_history thing
-    conversation = [
-        {
-            "role": "user" if "inputs" in message else "assistant",
-            "content": (
-                message["inputs"]["chat_input"]
-                if "inputs" in message
-                else message["outputs"]["chat_output"]
-            ),
-        }
-        for message in chat_history
-    ]
-
-    # add the user input as last message in the conversation
-    conversation.append({"role": "user", "content": chat_input})
+    conversation = _build_conversation(chat_input, chat_history)
 
     return chat_completion(conversation, stream=stream, context=context)
+
+
+@tool
+async def flow_entry_copilot_assistants_async(
+    chat_input: str, stream=False, chat_history: list = [], context: str = None
+) -> ChatResponse:
+    # json parse context as dict
+    context = json.loads(context) if context else {}
+
+    conversation = _build_conversation(chat_input, chat_history)
+
+    return await achat_completion(conversation, stream=stream, context=context)
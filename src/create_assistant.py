@@ -5,6 +5,7 @@ Once the assistant is created, you can interact with it using the OpenAI API (se
 """
 
 import os
+import sys
 import json
 import logging
 import argparse
@@ -14,6 +15,11 @@ from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 from dotenv import load_dotenv, dotenv_values
 load_dotenv(override=True)
 
+sys.path.append(os.path.join(os.path.dirname(__file__), "copilot_sdk_flow"))
+
+from agent_arch.extensions.order_data.config import OrderDataConfiguration
+from agent_arch.extensions.order_data.engines import get_tool_spec
+
 
 def get_arg_parser(parser: argparse.ArgumentParser = None) -> argparse.ArgumentParser:
     """Get the argument parser for the script."""
@@ -56,7 +62,7 @@ def main():
         client = AzureOpenAI(
             azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
             api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview"),
+            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-05-01-preview"),
         )
     else:
         logging.info("Using Azure AD authentification [recommended]")
@@ -66,7 +72,7 @@ def main():
         )
         client = AzureOpenAI(
             azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview"),
+            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-05-01-preview"),
             azure_ad_token_provider=token_provider,
         )
 
@@ -79,7 +85,10 @@ def main():
             "query_order_data.json",
         )
     ) as f:
-        custom_function_spec = json.load(f)
+        # the SQL dialect the assistant writes is the one of ORDER_DATA_ENGINE
+        custom_function_spec = get_tool_spec(
+            json.load(f), OrderDataConfiguration.from_env().ENGINE
+        )
 
     logging.info(f"Creating assistant...")
     assistant = client.beta.assistants.create(
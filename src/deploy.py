@@ -172,7 +172,7 @@ def main(cli_args: List[str] = None):
         "AZURE_OPENAI_ASSISTANT_ID"
     )
     deployment_env_vars["AZURE_OPENAI_API_VERSION"] = os.getenv(
-        "AZURE_OPENAI_API_VERSION", "2024-02-15-preview"
+        "AZURE_OPENAI_API_VERSION", "2024-05-01-preview"
     )
     deployment_env_vars["AZURE_OPENAI_CHAT_DEPLOYMENT"] = os.getenv(
         "AZURE_OPENAI_CHAT_DEPLOYMENT"
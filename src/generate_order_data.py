@@ -0,0 +1,97 @@
+"""Generates a synthetic order data database, with the schema of the order_data table.
+
+The repository doesn't ship the order data, use this script to create a database
+to develop against (at the default ORDER_DATA_DB_PATH), or datasets of any scale to
+measure the query_order_data extension on (see src/benchmark_order_data.py).
+The distributions of the data are described in
+src/copilot_sdk_flow/agent_arch/extensions/order_data/synthetic.py.
+"""
+
+import os
+import sys
+import sqlite3
+import logging
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "copilot_sdk_flow"))
+
+from agent_arch.extensions.order_data.config import OrderDataConfiguration
+from agent_arch.extensions.order_data.rollups import build_rollup, get_dimension_sets
+from agent_arch.extensions.order_data.synthetic import create_order_data
+
+
+def get_arg_parser(parser: argparse.ArgumentParser = None) -> argparse.ArgumentParser:
+    """Get the argument parser for the script."""
+    if parser is None:
+        parser = argparse.ArgumentParser(description=__doc__)
+
+    config = OrderDataConfiguration.from_env()
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=config.DB_PATH,
+        help="Path to the SQLite database to create",
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=100_000,
+        help="Number of rows to generate, e.g. 10_000 to 100_000_000",
+    )
+    parser.add_argument("--start-year", type=int, default=2019)
+    parser.add_argument(
+        "--years", type=int, default=5, help="Number of years covered by the data"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--table", type=str, default="order_data")
+    parser.add_argument(
+        "--rollups",
+        action="store_true",
+        help="Also build the rollup tables of ORDER_DATA_ROLLUP_DIMENSION_SETS",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Replace the database if it already exists",
+    )
+
+    return parser
+
+
+def main():
+    """Generate the database."""
+    logging.basicConfig(level=logging.INFO)
+
+    parser = get_arg_parser()
+    args = parser.parse_args()
+
+    if os.path.exists(args.output):
+        if not args.overwrite:
+            parser.error(
+                f"{args.output} already exists, pass --overwrite to replace it"
+            )
+        os.remove(args.output)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+
+    total_rows = create_order_data(
+        args.output,
+        args.rows,
+        table=args.table,
+        start_year=args.start_year,
+        years=args.years,
+        seed=args.seed,
+    )
+    logging.info(f"Generated {total_rows} rows of {args.table} in {args.output}")
+
+    if args.rollups:
+        conn = sqlite3.connect(args.output)
+        for dimensions in get_dimension_sets(
+            OrderDataConfiguration.from_env().ROLLUP_DIMENSION_SETS
+        ):
+            rollup = build_rollup(conn, dimensions, table=args.table)
+            logging.info(f"Built {rollup.table} ({rollup.row_count} rows)")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()